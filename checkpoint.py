@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+from writers import atomic_write
+
+
+__author__ = "Jonathan Sage"
+__email__ = "jsage8@gmail.com"
+
+
+class Checkpoint(object):
+    """
+    The last committed position of a newline delimited json conversion. Everything in the input
+    before input_offset has been converted into the first output_offset bytes of the output, which
+    hold records records. A conversion can resume from there as long as the key, which identifies
+    the input, output and conversion options, still matches.
+    """
+
+    version = 1
+
+    def __init__(self, key, input_offset=0, output_offset=0, records=0):
+        self.key = key
+        self.input_offset = input_offset
+        self.output_offset = output_offset
+        self.records = records
+
+    @classmethod
+    def load(cls, checkpoint_file, key):
+        """
+        Load a checkpoint, if there is one for key.
+
+        :param checkpoint_file: The path of the checkpoint.
+        :ptype checkpoint_file: str
+        :param key: Identifies the conversion, see make_key.
+        :ptype key: list
+        :return: The checkpoint, or None if it is missing, unreadable or for another conversion.
+        :rtype: Checkpoint
+        """
+        try:
+            with open(checkpoint_file, 'r') as checkpoint_in:
+                checkpoint_dict = json.load(checkpoint_in)
+        except (IOError, ValueError):
+            return None
+        if checkpoint_dict.get('version') != cls.version or checkpoint_dict.get('key') != key:
+            return None
+        return cls(
+            key, checkpoint_dict['input_offset'], checkpoint_dict['output_offset'],
+            checkpoint_dict['records']
+        )
+
+    @classmethod
+    def make_key(cls, xml_file, json_file, *options):
+        """
+        Identify a conversion by its input file, by path, size and modification time, its output
+        path and any options that shape the output.
+
+        :param xml_file: The path to the xml file.
+        :ptype xml_file: str
+        :param json_file: The path to the output file.
+        :ptype json_file: str
+        :rtype: list
+        """
+        stat = os.stat(xml_file)
+        # Round trip through json so the key compares equal to a loaded one
+        return json.loads(json.dumps([
+            os.path.abspath(xml_file), stat.st_size, stat.st_mtime, os.path.abspath(json_file)
+        ] + [repr(option) for option in options]))
+
+    def save(self, checkpoint_file):
+        """
+        Write the checkpoint to a json file, replacing it atomically.
+
+        :param checkpoint_file: The path of the checkpoint.
+        :ptype checkpoint_file: str
+        :rtype: void
+        """
+        with atomic_write(checkpoint_file, sync=True) as checkpoint_out:
+            json.dump({
+                'version': self.version,
+                'key': self.key,
+                'input_offset': self.input_offset,
+                'output_offset': self.output_offset,
+                'records': self.records
+            }, checkpoint_out)
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+import csv
+import os
+import time
+from writers import CountingWriter, open_output
+
+
+__author__ = "Jonathan Sage"
+__email__ = "jsage8@gmail.com"
+
+
+# Columns linking each row to its record and parent row, written first in every table
+LINK_COLUMNS = ('_id', '_record', '_parent', '_index')
+
+
+class CSVTableWriter(object):
+    """
+    Flatten records into one csv table for the records themselves and one for each repeated
+    element, such as identifiers.identifier or the injected openfda classifications, written in
+    batches of part files.
+
+    Nested dicts are flattened into their row with dotted column names, e.g.
+    device_sizes.device_size.size_type. Lists become rows of a child table named by their path,
+    whose _record and _parent columns hold the _id of the record and of the parent row, and whose
+    _index column holds the position in the list. Lists of plain values have a single value column.
+
+    A repeated element that happens to occur once is a dict rather than a list. Each path seen as a
+    list is remembered and treated as a child table from the batch it is first seen in on. Paths
+    known to repeat upfront can be given as repeated so every batch agrees.
+
+    Each table is a directory of part files, part-00000.csv and so on, one per batch. Every part
+    has its own header with the columns used in that batch. Part files left in the table's
+    directories by a previous run are removed when the writer is opened, so they never mix with
+    the current ones.
+    """
+
+    def __init__(self, output_dir, table, batch_size=10000, compress=False, repeated=(), stats=None):
+        """
+        :param output_dir: The directory to write the tables to.
+        :ptype output_dir: str
+        :param table: The name of the records' table, e.g. the search tag.
+        :ptype table: str
+        :param batch_size: The number of records per part file.
+        :ptype batch_size: int
+        :param compress: Gzip compress the part files.
+        :ptype compress: bool
+        :param repeated: Dotted paths, relative to the record, to always write as child tables.
+        :ptype repeated: iterable
+        :param stats: If provided, write time and bytes are reported to it.
+        :ptype stats: ParserStats
+        """
+        self.output_dir = output_dir
+        self.table = table
+        self.batch_size = batch_size
+        self.compress = compress
+        self.stats = stats
+        self.records = 0
+        self.parts = 0
+        self.repeated = set(tuple(path.split('.')) for path in repeated)
+        self._batch = []
+        # The next _id of each table
+        self._ids = {}
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def open(self):
+        """
+        Remove the part files of a previous run from the directories of this writer's tables.
+
+        :rtype: void
+        """
+        if not os.path.isdir(self.output_dir):
+            return
+        for name in os.listdir(self.output_dir):
+            table_dir = os.path.join(self.output_dir, name)
+            if (name == self.table or name.startswith(self.table + '.')) and os.path.isdir(table_dir):
+                for part in os.listdir(table_dir):
+                    if part.startswith('part-') and '.csv' in part:
+                        os.remove(os.path.join(table_dir, part))
+
+    def write(self, record):
+        """
+        Add a record, writing a batch of part files once batch_size records are buffered.
+
+        :param record: The record to write.
+        :ptype record: dict
+        :rtype: void
+        """
+        self._batch.append(record)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def close(self):
+        """
+        Write any buffered records.
+
+        :rtype: void
+        """
+        self.flush()
+
+    def flush(self):
+        """
+        Write the buffered records as one part file per table.
+
+        :rtype: void
+        """
+        if not self._batch:
+            return
+        start = time.time()
+        for record in self._batch:
+            self._find_repeated(record, ())
+        tables = {}
+        for record in self._batch:
+            record_id = self.records
+            self.records += 1
+            row = {'_id': record_id}
+            self._flatten(record, (), (), row, tables, record_id)
+            tables.setdefault((), []).append(row)
+        bytes_written = 0
+        for path, rows in tables.iteritems():
+            if rows:
+                bytes_written += self._write_part(path, rows)
+        self.parts += 1
+        self._batch = []
+        if self.stats is not None:
+            self.stats.add_time('write', time.time() - start)
+            self.stats.incr('bytes_written', bytes_written)
+
+    def table_dir(self, path):
+        """
+        The directory of a table's part files.
+
+        :param path: The table's path relative to the record, empty for the records' table.
+        :ptype path: tuple
+        :rtype: str
+        """
+        return os.path.join(self.output_dir, '.'.join((self.table,) + path))
+
+    def _find_repeated(self, value, path):
+        """
+        Remember every path below a value that holds a list.
+
+        :param value: A record or part of one.
+        :ptype value: dict
+        :param path: The value's path.
+        :ptype path: tuple
+        :rtype: void
+        """
+        for key, child in value.iteritems():
+            if isinstance(child, list):
+                self.repeated.add(path + (key,))
+                for item in child:
+                    if isinstance(item, dict):
+                        self._find_repeated(item, path + (key,))
+            elif isinstance(child, dict):
+                self._find_repeated(child, path + (key,))
+
+    def _flatten(self, value, path, table_path, row, tables, record_id):
+        """
+        Flatten a dict into a row, adding rows to child tables for its repeated elements.
+
+        :param value: The dict to flatten.
+        :ptype value: dict
+        :param path: The dict's path relative to the record.
+        :ptype path: tuple
+        :param table_path: The path of the table the row belongs to.
+        :ptype table_path: tuple
+        :param row: The row to add columns to.
+        :ptype row: dict
+        :param tables: The rows of each table in the current batch, by path.
+        :ptype tables: dict
+        :param record_id: The _id of the record the dict belongs to.
+        :ptype record_id: int
+        :rtype: void
+        """
+        prefix = path[len(table_path):]
+        for key, child in value.iteritems():
+            child_path = path + (key,)
+            if isinstance(child, list) or (isinstance(child, dict) and child_path in self.repeated):
+                items = child if isinstance(child, list) else [child]
+                child_rows = tables.setdefault(child_path, [])
+                for index, item in enumerate(items):
+                    # Classification misses are injected as None
+                    if item is None:
+                        continue
+                    child_id = self._ids.get(child_path, 0)
+                    self._ids[child_path] = child_id + 1
+                    child_row = {'_id': child_id, '_record': record_id, '_parent': row['_id'], '_index': index}
+                    if isinstance(item, dict):
+                        self._flatten(item, child_path, child_path, child_row, tables, record_id)
+                    else:
+                        child_row['value'] = item
+                    child_rows.append(child_row)
+            elif isinstance(child, dict):
+                self._flatten(child, child_path, table_path, row, tables, record_id)
+            else:
+                row['.'.join(prefix + (key,))] = child
+
+    def _write_part(self, path, rows):
+        """
+        Write a table's rows of the current batch to a part file.
+
+        :param path: The table's path relative to the record.
+        :ptype path: tuple
+        :param rows: The rows.
+        :ptype rows: list
+        :return: The number of bytes written, before compression.
+        :rtype: int
+        """
+        table_dir = self.table_dir(path)
+        if not os.path.isdir(table_dir):
+            os.makedirs(table_dir)
+        columns = set()
+        for row in rows:
+            columns.update(row)
+        header = [column for column in LINK_COLUMNS if column in columns]
+        header.extend(sorted(columns.difference(LINK_COLUMNS)))
+        part_file = os.path.join(
+            table_dir, 'part-%05d.csv%s' % (self.parts, '.gz' if self.compress else '')
+        )
+        with open_output(part_file, self.compress) as part_out:
+            counter = CountingWriter(part_out)
+            writer = csv.writer(counter)
+            writer.writerow(header)
+            for row in rows:
+                writer.writerow([_encode(row.get(column, '')) for column in header])
+        return counter.bytes_written
+
+
+def _encode(value):
+    """
+    Encode a cell as utf-8, which the csv module needs for anything but ascii.
+
+    :param value: The cell's value.
+    :ptype value: object
+    :rtype: str
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+import collections
+
+
+__author__ = "Jonathan Sage"
+__email__ = "jsage8@gmail.com"
+
+
+class _Layout(object):
+    """
+    The keys of a record in order and the position of each, shared by every record with the same
+    keys.
+    """
+
+    __slots__ = ('keys', 'positions')
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.positions = {key: position for position, key in enumerate(keys)}
+
+
+class CompactRecord(object):
+    """
+    A read-only mapping that stores its values in a tuple and shares its keys with every record of
+    the same layout, which takes a fraction of the memory of a dict. It supports the read-only
+    dict methods, compares equal to the dict it was made from and can be converted back with
+    to_dict. json can encode it by passing to_json_default as the default.
+    """
+
+    __slots__ = ('_layout', '_values')
+
+    # Hashing is not supported, as with dicts
+    __hash__ = None
+
+    def __init__(self, layout, values):
+        self._layout = layout
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._layout.positions[key]]
+
+    def __contains__(self, key):
+        return key in self._layout.positions
+
+    def __iter__(self):
+        return iter(self._layout.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        if not isinstance(other, (CompactRecord, dict)):
+            return NotImplemented
+        return dict(self.iteritems()) == dict(other.iteritems())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, dict(self.iteritems()))
+
+    def get(self, key, default=None):
+        position = self._layout.positions.get(key)
+        return default if position is None else self._values[position]
+
+    def keys(self):
+        return list(self._layout.keys)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self._layout.keys, self._values)
+
+    def iterkeys(self):
+        return iter(self._layout.keys)
+
+    def itervalues(self):
+        return iter(self._values)
+
+    def iteritems(self):
+        return iter(zip(self._layout.keys, self._values))
+
+    def to_dict(self):
+        """
+        Convert the record, and every record nested in it, back to plain dicts.
+
+        :rtype: dict
+        """
+        return {key: _to_plain(value) for key, value in self.iteritems()}
+
+
+collections.Mapping.register(CompactRecord)
+
+
+class RecordCompactor(object):
+    """
+    Convert records into CompactRecords for keeping large numbers of them in memory. Records with
+    the same keys share a layout, short strings that repeat across records, such as flags and
+    product codes, are stored once and values that are the same object in the source records,
+    such as the openfda lists injected by FDAClassificationParser, stay shared.
+    """
+
+    # Strings longer than this are rarely repeated and not worth looking up
+    max_shared_length = 64
+    # The number of distinct strings and shared values kept. Each cache is emptied if it fills up.
+    cache_size = 65536
+
+    def __init__(self, shared_keys=('openfda',)):
+        """
+        :param shared_keys: Keys whose values are often the same object in many records.
+        :ptype shared_keys: tuple
+        """
+        self.shared_keys = frozenset(shared_keys)
+        self._layouts = {}
+        self._strings = {}
+        # Compacted values by the id of their source, which is kept alive so the id is not reused
+        self._shared = {}
+
+    def compact(self, obj):
+        """
+        Compact a record, or any value of one.
+
+        :param obj: The record.
+        :ptype obj: dict
+        :return: The compacted record. Lists stay lists.
+        :rtype: CompactRecord
+        """
+        kind = type(obj)
+        if kind is dict:
+            return self._compact_dict(obj)
+        if kind is list:
+            return [self.compact(value) for value in obj]
+        if (kind is str or kind is unicode) and len(obj) <= self.max_shared_length:
+            return self._share_string(obj)
+        return obj
+
+    def _compact_dict(self, obj):
+        """
+        Compact a dict. Its string values are handled inline, since they make up most of a record.
+
+        :param obj: The dict.
+        :ptype obj: dict
+        :rtype: CompactRecord
+        """
+        keys = tuple(obj)
+        layout = self._layouts.get(keys)
+        if layout is None:
+            layout = self._layouts[keys] = _Layout(keys)
+        strings = self._strings
+        shared_keys = self.shared_keys
+        max_length = self.max_shared_length
+        values = []
+        append = values.append
+        for key, value in obj.iteritems():
+            kind = type(value)
+            if kind is str or kind is unicode:
+                if len(value) <= max_length:
+                    value = strings.get(value) or self._share_string(value)
+            elif key in shared_keys:
+                value = self._compact_shared(value)
+            elif kind is dict:
+                value = self._compact_dict(value)
+            elif kind is list:
+                value = [self.compact(item) for item in value]
+            append(value)
+        return CompactRecord(layout, tuple(values))
+
+    def _share_string(self, string):
+        """
+        The first copy seen of a string.
+
+        :param string: The string.
+        :ptype string: str
+        :rtype: str
+        """
+        shared = self._strings.get(string)
+        if shared is None:
+            if len(self._strings) >= self.cache_size:
+                self._strings.clear()
+            shared = self._strings[string] = string
+        return shared
+
+    def _compact_shared(self, obj):
+        """
+        Compact a value that is likely to be the same object in other records only once.
+
+        :param obj: The value.
+        :ptype obj: object
+        :rtype: object
+        """
+        shared = self._shared.get(id(obj))
+        if shared is None:
+            if len(self._shared) >= self.cache_size:
+                self._shared.clear()
+            shared = self._shared[id(obj)] = (obj, self.compact(obj))
+        return shared[1]
+
+
+def to_json_default(obj):
+    """
+    The json default for encoding CompactRecords, e.g. json.dumps(records, default=to_json_default).
+
+    :param obj: An object json cannot encode by itself.
+    :ptype obj: object
+    :rtype: dict
+    """
+    if isinstance(obj, CompactRecord):
+        return _JSONRecord(obj._layout.keys, obj._values)
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+
+class _JSONRecord(dict):
+    """
+    A dict that json encodes its items in the order of the record it was made from, rather than in
+    its own hash order, so the json of a CompactRecord matches that of its source dict.
+    """
+
+    __slots__ = ('_keys', '_values')
+
+    def __init__(self, keys, values):
+        dict.__init__(self, zip(keys, values))
+        self._keys = keys
+        self._values = values
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def iteritems(self):
+        return iter(zip(self._keys, self._values))
+
+
+def _to_plain(value):
+    """
+    Convert CompactRecords in a value back to dicts.
+
+    :param value: A value of a record.
+    :ptype value: object
+    :rtype: object
+    """
+    if isinstance(value, CompactRecord):
+        return value.to_dict()
+    if isinstance(value, list):
+        return [_to_plain(item) for item in value]
+    return value
@@ -1,15 +1,90 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import json
 import re
+import multiprocessing
+import os
+import time
+from collections import Counter, deque
 from xml.etree import cElementTree as ElementTree
-from collections import defaultdict
+from xml.sax.saxutils import unescape
+from checkpoint import Checkpoint
+from columnar import CSVTableWriter
+from compact import RecordCompactor, to_json_default
+from manifest import RecordManifest
 from parser_interface import XMLParserInterface
+from parser_stats import stage_timer
+from pipeline import RecordPipeline
+from readers import document_names, iter_documents, open_document
+from record_index import RecordIndexWriter, index_path
+from writers import CountingWriter, NDJSONWriter, ShardedNDJSONWriter, open_output, write_json
+from xml_backends import get_backend
+from xml_splitter import XMLRecordSplitter
 
 
 __author__ = "Jonathan Sage"
 __email__ = "jsage8@gmail.com"
 
 
+class TagCache(object):
+    """
+    A bounded cache of raw, possibly namespaced, element tags and their snake_case keys. A
+    document typically only has a few dozen distinct tags repeated millions of times, so nearly
+    every lookup is a hit. If the cache ever fills up it is simply emptied.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = {}
+
+    def get(self, tag, convert):
+        """
+        Get the key for a tag, converting and caching it on a miss.
+
+        :param tag: The element tag.
+        :ptype tag: str
+        :param convert: Converts the tag to its key on a miss.
+        :ptype convert: callable
+        :return: The key.
+        :rtype: str
+        """
+        try:
+            key = self._cache[tag]
+        except KeyError:
+            self.misses += 1
+            if len(self._cache) >= self.maxsize:
+                self._cache.clear()
+            key = self._cache[tag] = convert(tag)
+            return key
+        self.hits += 1
+        return key
+
+    def info(self):
+        """
+        The cache statistics.
+
+        :rtype: dict
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._cache),
+            'maxsize': self.maxsize
+        }
+
+    def clear(self):
+        """
+        Empty the cache and reset its statistics.
+
+        :rtype: void
+        """
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+
 class XMLDocParser(XMLParserInterface):
     """
     An XML document parser.
@@ -19,10 +94,45 @@ class XMLDocParser(XMLParserInterface):
         json
     """
 
-    def __init__(self, class_parser=None):
+    # The number of records handed to a worker process at a time
+    parallel_batch_size = 500
+    # The most bytes of an uncompressed file a worker process splits and converts at a time
+    parallel_range_size = 4 << 20
+    # The number of records written between checkpoints
+    checkpoint_interval = 10000
+    # The number of elements sampled to detect the record tag
+    detect_sample_size = 1000
+
+    # Shared by all parser instances
+    _tag_cache = TagCache()
+    _first_cap_pattern = re.compile('(.)([A-Z][a-z])')
+    _all_cap_pattern = re.compile('([a-z0-9])([A-Z])')
+    # A leaf element in raw xml: its tag and its text
+    _leaf_pattern = re.compile(r'<([^\s/>!?]+)[^>]*>([^<]*)</\1\s*>')
+
+    def __init__(self, class_parser=None, stats=None, record_filter=None, backend='etree',
+                 compact_records=False):
+        """
+        :param class_parser: If provided, classification information is injected into records.
+        :ptype class_parser: FDAClassificationParser
+        :param stats: If provided, timings and counters are reported to it.
+        :ptype stats: ParserStats
+        :param record_filter: If provided, elements that match a search tag are filtered and
+            projected before they are converted.
+        :ptype record_filter: RecordFilter
+        :param backend: The xml backend, by name or as an XMLBackend. One of etree, lxml or
+            expat, which builds dicts without creating elements.
+        :ptype backend: str
+        :param compact_records: Keep the records parse stores in the dict property as read-only
+            CompactRecords, which take much less memory than dicts. See compact.RecordCompactor.
+        :ptype compact_records: bool
+        """
         self._dict = {}
-        self._json = None
         self.class_parser = class_parser
+        self.stats = stats
+        self.record_filter = record_filter
+        self.backend = get_backend(backend) if isinstance(backend, basestring) else backend
+        self.compact_records = compact_records
 
     @property
     def dict(self):
@@ -36,43 +146,466 @@ class XMLDocParser(XMLParserInterface):
     @property
     def json(self):
         """
-        The xml document's json representation.
+        The xml document's json representation. It is built on every access rather than kept
+        around, since it is as large as the document itself. Use to_json_file to write json
+        without building it in memory.
         """
-        if not self._json:
-            self._json = self._dict_to_json(self.dict)
-        return self._json
+        return self._dict_to_json(self.dict)
 
-    def parse(self, xml_file, search_tag=None):
+    def parse(self, xml_file, search_tag=None, workers=1):
         """
         Parse an xml file that is located at the path represented by xml_file. This can be done in
         one of two ways. With apriori knowledge of the file structure we can use iterparse, which
         can help reduce memory usage. Without we have to parse starting at the root element and load
         the full object into memory. Both functions store the result in the dict property.
 
-        :param xml_file: The path to the xml file to parse.
+        The xml file may be gzip compressed or a zip archive and is decompressed as it is parsed.
+        A zip archive with several xml members, such as a GUDID release, is parsed as the records
+        of each member in turn, so it requires a search_tag.
+
+        :param xml_file: The path to the xml file to parse, which may end in .gz or .zip.
         :ptype xml_file: str
-        :param search_tag: The tag we know about apriori.
+        :param search_tag: The tag we know about apriori, or 'auto' to detect the repeating record
+            tag with detect_record_tag and only parse the whole document if there is none. A list
+            of tags collects the records of each under its own key of data in a single pass.
         :ptype search_tag: str
+        :param workers: The number of processes used to convert elements. Requires search_tag.
+        :ptype workers: int
         :rtype: void
         """
+        if search_tag == 'auto':
+            search_tag = self.detect_record_tag(xml_file)
         # Assume apriori knowledge of the xml structure to reduce memory footprint
         if search_tag:
-            self._iter_parse(xml_file, search_tag)
+            self._iter_parse(xml_file, search_tag, workers)
         # Parse starting from root element
         else:
             self._std_parse(xml_file)
 
-    def to_json_file(self, json_file, pretty=False):
+    def detect_record_tag(self, xml_file):
         """
-        Write the xml document as json to a file.
+        Guess the tag of the element that repeats throughout a document, such as device in a
+        GUDID release, by sampling the first detect_sample_size elements below the root. The most
+        common child of the root is picked if it repeats, otherwise the most common grandchild.
+
+        :param xml_file: The path to the xml file.
+        :ptype xml_file: str
+        :return: The snake_case tag or None if nothing repeats near the root.
+        :rtype: str
+        """
+        # Counts of the tags of the root's children and grandchildren
+        counts = (Counter(), Counter())
+        depth = 0
+        sampled = 0
+        with open_document(xml_file, document_names(xml_file)[0]) as xml_in:
+            for event, element in ElementTree.iterparse(xml_in, events=("start", "end")):
+                if event == "end":
+                    depth -= 1
+                    if depth == 1:
+                        element.clear()
+                    continue
+                depth += 1
+                if depth in (2, 3):
+                    counts[depth - 2][self._normalize_tag(element.tag)] += 1
+                    sampled += 1
+                    if sampled >= self.detect_sample_size:
+                        break
+        for level_counts in counts:
+            if level_counts:
+                tag, count = level_counts.most_common(1)[0]
+                if count > 1:
+                    return tag
+        return None
+
+    def to_json_file(self, json_file, pretty=False, compress=None):
+        """
+        Write the xml document as json to a file. Compact json is encoded and written in chunks
+        rather than built as one string first.
 
         :param pretty: Pretty print json?
         :ptype pretty: bool
+        :param compress: Gzip compress the output. Defaults to compressing paths ending in .gz.
+        :ptype compress: bool
+        """
+        with stage_timer(self.stats, 'write'):
+            if pretty:
+                bytes_written = self._dict_to_json_file(self.dict, json_file, compress)
+            else:
+                bytes_written = self._dict_to_compact_json_file(self.dict, json_file, compress)
+        if self.stats is not None:
+            self.stats.incr('bytes_written', bytes_written)
+
+    def iter_parse(self, xml_file, search_tag, workers=1):
+        """
+        Lazily parse an xml file that is located at the path represented by xml_file. Yield the
+        dict for each element that matches the search_tag, with classification information
+        injected if a class_parser was provided. Nothing is stored in the dict property, so memory
+        stays flat regardless of the size of the input.
+
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :param workers: The number of processes used to convert elements. Records are still
+            yielded in input order.
+        :ptype workers: int
+        :return: A generator of record dicts.
+        :rtype: generator
+        """
+        if workers > 1:
+            for records in self._parallel_parse(xml_file, search_tag, workers):
+                for record in records:
+                    yield record
+            return
+        for record in self.backend.iter_records(self, xml_file, search_tag):
+            yield record
+
+    def iter_parse_tags(self, xml_file, search_tags):
+        """
+        Like iter_parse, but yield the records of several tags in a single pass over the xml
+        file, e.g. the header and the devices of a GUDID release, each along with its tag so it
+        can be routed to its own output.
+
+        An element nested in a record of another tag, such as an identifier in a device, is
+        yielded before that record and stays part of it too.
+
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param search_tags: The tags we know about apriori.
+        :ptype search_tags: iterable
+        :return: A generator of (tag, record) tuples in document order of the elements' ends.
+        :rtype: generator
+        """
+        if self.record_filter is not None:
+            # Filter paths are relative to a single kind of record, and would prune nested matches
+            raise ValueError("Record filters are not supported when parsing several tags at once")
+        return self.backend.iter_tagged_records(self, xml_file, search_tags)
+
+    def pipeline(self, xml_file, search_tag, workers=1, maxsize=8, batch_size=100):
+        """
+        Parse an xml file in a background thread, handing batches of records over through a
+        bounded queue. See RecordPipeline. Use this to consume records without blocking, e.g. from
+        an event loop.
+
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :param workers: The number of processes used to convert elements.
+        :ptype workers: int
+        :param maxsize: The number of batches that may be waiting for the consumer.
+        :ptype maxsize: int
+        :param batch_size: The number of records per batch.
+        :ptype batch_size: int
+        :return: The pipeline, not yet started.
+        :rtype: RecordPipeline
+        """
+        return RecordPipeline(self, xml_file, search_tag, workers, maxsize, batch_size)
+
+    def stream_to_file(self, xml_file, json_file, search_tag, workers=1, compress=None, id_tag=None):
+        """
+        Parse an xml file and write each element that matches the search_tag straight to a file as
+        newline delimited json. Nothing is stored in the dict property.
+
+        If an id_tag is given, a sidecar index of each record's offset in the output is written
+        next to it, see record_index.RecordReader for looking records up through it.
+
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param json_file: The path of the ndjson file to write to.
+        :ptype json_file: str
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :param workers: The number of processes used to convert elements.
+        :ptype workers: int
+        :param compress: Gzip compress the output. Defaults to compressing paths ending in .gz.
+        :ptype compress: bool
+        :param id_tag: The key that identifies each record in the index, e.g.
+            public_device_record_key. Requires uncompressed output.
+        :ptype id_tag: str
+        :return: The number of records written.
+        :rtype: int
+        """
+        index = RecordIndexWriter(index_path(json_file), id_tag) if id_tag is not None else None
+        with NDJSONWriter(json_file, compress, self.stats, index=index) as writer:
+            if workers > 1:
+                # Let the workers do the json encoding too, and pick out each record's key for the
+                # index, see _convert_document
+                for lines in self._parallel_parse(
+                        xml_file, search_tag, workers, encode=True, id_tag=id_tag):
+                    if id_tag is None:
+                        for line in lines:
+                            writer.write_line(line)
+                    else:
+                        for key, line in lines:
+                            writer.write_line(line, key)
+            else:
+                for record in self.iter_parse(xml_file, search_tag):
+                    writer.write(record)
+        return writer.records
+
+    def stream_to_shards(self, xml_file, output_dir, search_tag, workers=1, max_records=None,
+                         max_bytes=None, compress=False):
+        """
+        Parse an xml file and write each element that matches the search_tag as newline delimited
+        json to a directory of shards, rolling over to a new shard every max_records records or
+        max_bytes bytes, with a manifest of the shards. See ShardedNDJSONWriter.
+
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param output_dir: The directory to write the shards to.
+        :ptype output_dir: str
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :param workers: The number of processes used to convert elements.
+        :ptype workers: int
+        :param max_records: The most records per shard.
+        :ptype max_records: int
+        :param max_bytes: The most bytes per shard, before compression.
+        :ptype max_bytes: int
+        :param compress: Gzip compress the shards.
+        :ptype compress: bool
+        :return: The shards written, each a dict of its file name, records and bytes.
+        :rtype: list
+        """
+        with ShardedNDJSONWriter(output_dir, max_records, max_bytes, compress, self.stats) as writer:
+            if workers > 1:
+                for lines in self._parallel_parse(xml_file, search_tag, workers, encode=True):
+                    for line in lines:
+                        writer.write_line(line)
+            else:
+                for record in self.iter_parse(xml_file, search_tag):
+                    writer.write(record)
+        return writer.shards
+
+    def stream_tags_to_files(self, xml_file, output_dir, search_tags, compress=False):
+        """
+        Parse an xml file in a single pass and write the records of each of the search_tags to a
+        newline delimited json file of its own, named after the tag, e.g. device.ndjson. See
+        iter_parse_tags.
+
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param output_dir: The directory to write the files to. Created if it does not exist.
+        :ptype output_dir: str
+        :param search_tags: The tags we know about apriori. Repeated tags are written once.
+        :ptype search_tags: iterable
+        :param compress: Gzip compress the files.
+        :ptype compress: bool
+        :return: The number of records written for each tag.
+        :rtype: dict
+        """
+        tagged = self.iter_parse_tags(xml_file, search_tags)
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        writers = {}
+        try:
+            for tag in search_tags:
+                if tag in writers:
+                    # A repeated tag would open a second writer on the same file
+                    continue
+                json_file = os.path.join(output_dir, '%s.ndjson%s' % (tag, '.gz' if compress else ''))
+                writers[tag] = NDJSONWriter(json_file, compress, self.stats)
+                writers[tag].open()
+            for tag, record in tagged:
+                writers[tag].write(record)
+        finally:
+            for writer in writers.itervalues():
+                writer.close()
+        return {tag: writer.records for tag, writer in writers.iteritems()}
+
+    def iter_changes(self, xml_file, search_tag, id_tag, manifest):
+        """
+        Compare the elements that match the search_tag against the content hashes of a previous
+        conversion and yield only what changed. Each element is hashed as raw xml, so unchanged
+        elements are never parsed, converted or injected. Elements are identified by the text of
+        their first descendant whose key is id_tag, e.g. public_device_record_key.
+
+        Once the generator is exhausted the manifest holds the hashes of the current file. If the
+        classification file, search_tag or id_tag differ from the manifest's, every element is
+        reported as changed.
+
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :param id_tag: The key of the element that identifies each record.
+        :ptype id_tag: str
+        :param manifest: The hashes of the previous conversion.
+        :ptype manifest: RecordManifest
+        :return: A generator of change dicts. Each has an op of add, change or delete and the
+            record's id. Adds and changes also have the converted record.
+        :rtype: generator
+        """
+        source_key = self.class_parser.source_key if self.class_parser is not None else None
+        salt = hashlib.sha1(repr((search_tag, id_tag, source_key, self.record_filter))).hexdigest()
+        previous = manifest.hashes if manifest.salt == salt else {}
+        current = {}
+        splitter = XMLRecordSplitter(search_tag, self._normalize_tag)
+        for _, _, raw in splitter.iter_records(xml_file):
+            record_id = self._record_id(raw, id_tag)
+            digest = hashlib.sha1(raw).hexdigest()
+            current[record_id] = digest
+            if previous.get(record_id) == digest:
+                if self.stats is not None:
+                    self.stats.incr('records_unchanged')
+                continue
+            op = 'change' if record_id in manifest.hashes else 'add'
+            records = self.backend.convert_document(self, splitter.wrap([raw]), search_tag)
+            record = records[0] if records else None
+            if record is None:
+                # Filtered out, so it is not part of the output
+                del current[record_id]
+                continue
+            if self.stats is not None:
+                self.stats.incr('records_' + ('changed' if op == 'change' else 'added'))
+            yield {'op': op, 'id': record_id, 'record': record}
+        for record_id in sorted(set(manifest.hashes) - set(current)):
+            if self.stats is not None:
+                self.stats.incr('records_deleted')
+            yield {'op': 'delete', 'id': record_id}
+        manifest.hashes = current
+        manifest.salt = salt
+
+    def stream_changes_to_file(self, xml_file, json_file, search_tag, id_tag, manifest_file,
+                               compress=None):
+        """
+        Write the changes since the previous conversion as newline delimited json, see
+        iter_changes, and update the manifest file once the output is complete.
+
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param json_file: The path of the ndjson file to write to.
+        :ptype json_file: str
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :param id_tag: The key of the element that identifies each record.
+        :ptype id_tag: str
+        :param manifest_file: The path of the manifest. A missing manifest reports every record
+            as added.
+        :ptype manifest_file: str
+        :param compress: Gzip compress the output. Defaults to compressing paths ending in .gz.
+        :ptype compress: bool
+        :return: The number of records added, changed, deleted and unchanged.
+        :rtype: dict
+        """
+        manifest = RecordManifest.load(manifest_file)
+        counts = {'add': 0, 'change': 0, 'delete': 0}
+        with NDJSONWriter(json_file, compress, self.stats) as writer:
+            for change in self.iter_changes(xml_file, search_tag, id_tag, manifest):
+                counts[change['op']] += 1
+                writer.write(change)
+        manifest.save(manifest_file)
+        return {
+            'added': counts['add'],
+            'changed': counts['change'],
+            'deleted': counts['delete'],
+            'unchanged': len(manifest.hashes) - counts['add'] - counts['change']
+        }
+
+    @classmethod
+    def _record_id(cls, raw, id_tag):
+        """
+        Find the identifier of a raw xml element: the text of its first leaf whose key is id_tag.
+
+        :param raw: The raw xml element.
+        :ptype raw: str
+        :param id_tag: The key of the identifying element.
+        :ptype id_tag: str
+        :rtype: str
+        """
+        for match in cls._leaf_pattern.finditer(raw):
+            if cls._normalize_tag(match.group(1).rsplit(':', 1)[-1]) == id_tag:
+                return unescape(match.group(2).strip())
+        raise ValueError("Record without a %s: %s" % (id_tag, raw[:200]))
+
+    def stream_to_tables(self, xml_file, output_dir, search_tag, workers=1, compress=False,
+                         repeated=(), batch_size=10000):
+        """
+        Parse an xml file and write the elements that match the search_tag as flattened csv
+        tables, one for the records and one per repeated element, in batches of part files. See
+        CSVTableWriter.
+
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param output_dir: The directory to write the tables to.
+        :ptype output_dir: str
+        :param search_tag: The tag we know about apriori. Also the name of the records' table.
+        :ptype search_tag: str
+        :param workers: The number of processes used to convert elements.
+        :ptype workers: int
+        :param compress: Gzip compress the part files.
+        :ptype compress: bool
+        :param repeated: Dotted paths, relative to the record, to always write as child tables.
+        :ptype repeated: iterable
+        :param batch_size: The number of records per part file.
+        :ptype batch_size: int
+        :return: The number of records written.
+        :rtype: int
+        """
+        with CSVTableWriter(output_dir, search_tag, batch_size, compress, repeated, self.stats) as writer:
+            for record in self.iter_parse(xml_file, search_tag, workers):
+                writer.write(record)
+        return writer.records
+
+    def checkpointed_stream_to_file(self, xml_file, json_file, search_tag, checkpoint_file,
+                                    workers=1, compress=None):
+        """
+        Like stream_to_file, but commit a checkpoint of the input and output position every
+        checkpoint_interval records. If the conversion dies, calling this again with the same
+        arguments truncates the output back to the last checkpoint and resumes from the element
+        that follows it. The checkpoint file is removed once the conversion is complete.
+
+        The input is split into elements with XMLRecordSplitter, so the same caveats apply.
+
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param json_file: The path of the ndjson file to write to.
+        :ptype json_file: str
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :param checkpoint_file: The path of the checkpoint.
+        :ptype checkpoint_file: str
+        :param workers: The number of processes used to convert elements.
+        :ptype workers: int
+        :param compress: Gzip compress the output. Defaults to compressing paths ending in .gz.
+        :ptype compress: bool
+        :return: The total number of records written, including those written before resuming.
+        :rtype: int
         """
-        if pretty:
-            self._dict_to_json_file(self.dict, json_file)
+        if compress is None:
+            compress = json_file.endswith('.gz')
+        source_key = self.class_parser.source_key if self.class_parser is not None else None
+        key = Checkpoint.make_key(
+            xml_file, json_file, search_tag, compress, self.backend.name, source_key,
+            self.record_filter
+        )
+        checkpoint = Checkpoint.load(checkpoint_file, key)
+        if checkpoint is not None and os.path.exists(json_file) and \
+                os.path.getsize(json_file) >= checkpoint.output_offset:
+            # Drop whatever was written after the checkpoint
+            with open(json_file, 'r+b') as json_out:
+                json_out.truncate(checkpoint.output_offset)
+            append = True
         else:
-            self._json_to_file(self.json, json_file)
+            checkpoint = Checkpoint(key)
+            append = False
+        records = 0
+        with NDJSONWriter(json_file, compress, self.stats, append) as writer:
+            for end, lines in self._convert_batches(
+                    xml_file, search_tag, workers, encode=True, offset=checkpoint.input_offset):
+                for line in lines:
+                    writer.write_line(line)
+                records += len(lines)
+                if records >= self.checkpoint_interval:
+                    checkpoint.output_offset = writer.sync()
+                    checkpoint.input_offset = end
+                    checkpoint.records += records
+                    checkpoint.save(checkpoint_file)
+                    records = 0
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        return checkpoint.records + records
 
     def _std_parse(self, xml_file):
         """
@@ -84,32 +617,367 @@ class XMLDocParser(XMLParserInterface):
         :ptype xml_file: str
         :rtype: void
         """
-        tree = ElementTree.parse(xml_file)
-        root = tree.getroot()
-        self._dict = self._tree_to_dict(root)
+        tree_dict = self.backend.parse(self, xml_file)
+        if self.compact_records:
+            compactor = RecordCompactor()
+            tree_dict = {key: compactor.compact(value) for key, value in tree_dict.iteritems()}
+        self._dict = tree_dict
 
-    def _iter_parse(self, xml_file, search_tag):
+    def _iter_parse(self, xml_file, search_tag, workers=1):
         """
         Parse an xml file that is located at the path represented by xml_file. Parse each element
         that matches the search_tag. Clear elements from the tree structure that have already been
         parsed to reduce memeory load. Parse the tree structure into a dict and store it in the
         dict property.
 
-        NOTE: This could probably benefit greatly from concurrency.
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param search_tag: The tag we know about apriori, or a list of tags, see _collect_tags.
+        :ptype search_tag: str
+        :param workers: The number of processes used to convert elements.
+        :ptype workers: int
+        :rtype: void
+        """
+        if not isinstance(search_tag, basestring):
+            self._dict['data'] = self._collect_tags(xml_file, search_tag, workers)
+            return
+        records = []
+        if self.compact_records:
+            compact = RecordCompactor().compact
+            for record in self.iter_parse(xml_file, search_tag, workers):
+                records.append(compact(record))
+        else:
+            for record in self.iter_parse(xml_file, search_tag, workers):
+                records.append(record)
+        self._dict['data'] = {search_tag: records}
+
+    def _collect_tags(self, xml_file, search_tags, workers=1):
+        """
+        Collect the records of several tags in a single pass, see iter_parse_tags.
+
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param search_tags: The tags we know about apriori.
+        :ptype search_tags: iterable
+        :param workers: Must be 1, elements are only split at the boundaries of a single tag.
+        :ptype workers: int
+        :return: The records of each tag by tag. Every tag is present, even without records.
+        :rtype: dict
+        """
+        if workers > 1:
+            raise ValueError("Parsing several tags at once is done in a single process")
+        tagged = self.iter_parse_tags(xml_file, search_tags)
+        records = {tag: [] for tag in search_tags}
+        compact = RecordCompactor().compact if self.compact_records else None
+        for tag, record in tagged:
+            records[tag].append(compact(record) if compact is not None else record)
+        return records
+
+    def _parallel_parse(self, xml_file, search_tag, workers, encode=False, id_tag=None):
+        """
+        Convert the elements of an xml file that match the search_tag in a pool of worker
+        processes. An uncompressed file is handed out as byte ranges that the workers split
+        themselves, see _convert_ranges. Compressed input cannot be seeked into, so it is split
+        into batches of elements in this process, see _convert_batches.
 
         :param xml_file: The path to the xml file to parse.
         :ptype xml_file: str
         :param search_tag: The tag we know about apriori.
         :ptype search_tag: str
-        :rtype: void
+        :param workers: The number of worker processes.
+        :ptype workers: int
+        :param encode: Have the workers encode each record as a line of json.
+        :ptype encode: bool
+        :param id_tag: With encode, pair each line with the value of the record's top level id_tag
+            key, see _convert_document.
+        :ptype id_tag: str
+        :return: A generator of lists of records, one list per batch.
+        :rtype: generator
         """
-        self._dict['data'] = {search_tag: []}
-        for event, element in ElementTree.iterparse(xml_file, events=("end",)):
-            tag = self._strip_namespace(element.tag)
-            snake_tag = self._camel_to_snake(tag)
-            if event == "end" and snake_tag == search_tag:
-                self._dict['data'][search_tag].append(self._tree_to_dict(element)[search_tag])
-                element.clear()
+        if xml_file.endswith(('.gz', '.zip')):
+            for _, records in self._convert_batches(
+                    xml_file, search_tag, workers, encode, id_tag=id_tag):
+                yield records
+            return
+        for records in self._convert_ranges(xml_file, search_tag, workers, encode, id_tag):
+            yield records
+
+    def _convert_ranges(self, xml_file, search_tag, workers, encode=False, id_tag=None):
+        """
+        Cut an uncompressed xml file into byte ranges and have a pool of worker processes split
+        each range into elements, see XMLRecordSplitter.iter_range, and convert them. The file is
+        never scanned in this process, so scanning scales with the workers too. Only a bounded
+        number of ranges are in flight at a time and results are yielded in input order.
+
+        :param xml_file: The path to the uncompressed xml file to parse.
+        :ptype xml_file: str
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :param workers: The number of worker processes.
+        :ptype workers: int
+        :param encode: Have the workers encode each record as a line of json.
+        :ptype encode: bool
+        :param id_tag: With encode, pair each line with the value of the record's top level id_tag
+            key, see _convert_document.
+        :ptype id_tag: str
+        :return: A generator of lists of records, one list per range.
+        :rtype: generator
+        """
+        splitter = XMLRecordSplitter(search_tag, self._normalize_tag)
+        splitter.read_prolog(xml_file)
+        prolog = (splitter.declaration, splitter.namespaces)
+        size = os.path.getsize(xml_file)
+        # Several ranges per worker even for small files, so the workers stay busy
+        range_size = max(splitter.block_size, min(self.parallel_range_size, size // (workers * 4) + 1))
+        pool = multiprocessing.Pool(workers, _init_worker, (self,))
+        try:
+            pending = deque()
+            for start in xrange(0, size, range_size):
+                task = (xml_file, start, start + range_size, search_tag, prolog, encode, id_tag)
+                pending.append(pool.apply_async(_convert_range, task))
+                if len(pending) >= workers * 2:
+                    yield self._collect_batch(pending.popleft())
+            while pending:
+                yield self._collect_batch(pending.popleft())
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _convert_batches(self, xml_file, search_tag, workers=1, encode=False, offset=0, id_tag=None):
+        """
+        Split an xml file at the boundaries of elements that match the search_tag and convert
+        batches of elements, either in this process or in a pool of worker processes. Only a
+        bounded number of batches are in flight at a time and results are yielded in input order.
+
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :param workers: The number of worker processes, or 1 to convert in this process.
+        :ptype workers: int
+        :param encode: Encode each record as a line of json.
+        :ptype encode: bool
+        :param offset: The byte offset to start at. It must fall between elements.
+        :ptype offset: int
+        :param id_tag: With encode, pair each line with the value of the record's top level id_tag
+            key, see _convert_document.
+        :ptype id_tag: str
+        :return: A generator of (end offset, records) tuples, one per batch. The end offset is
+            where the input after the batch's last element starts.
+        :rtype: generator
+        """
+        splitter = XMLRecordSplitter(search_tag, self._normalize_tag)
+        batches = splitter.iter_batches(xml_file, self.parallel_batch_size, offset)
+        if workers == 1:
+            while True:
+                with stage_timer(self.stats, 'split'):
+                    batch = next(batches, None)
+                if batch is None:
+                    return
+                yield batch[1], self._convert_document(batch[3], search_tag, encode, id_tag)
+        pool = multiprocessing.Pool(workers, _init_worker, (self,))
+        try:
+            pending = deque()
+            while True:
+                with stage_timer(self.stats, 'split'):
+                    batch = next(batches, None)
+                if batch is None:
+                    break
+                end, document = batch[1], batch[3]
+                task = (document, search_tag, encode, id_tag)
+                pending.append((end, pool.apply_async(_convert_batch, task)))
+                if len(pending) >= workers * 2:
+                    end, result = pending.popleft()
+                    yield end, self._collect_batch(result)
+            while pending:
+                end, result = pending.popleft()
+                yield end, self._collect_batch(result)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _collect_batch(self, result):
+        """
+        Wait for a batch converted by a worker process and merge the worker's stats.
+
+        :param result: The pending result of _convert_batch or _convert_range.
+        :ptype result: AsyncResult
+        :return: The converted records.
+        :rtype: list
+        """
+        records, stats_dict = result.get()
+        if stats_dict is not None:
+            self.stats.merge(stats_dict)
+        return records
+
+    def _convert_document(self, document, search_tag, encode=False, id_tag=None):
+        """
+        Convert every child of the root of an xml document, such as a batch produced by
+        XMLRecordSplitter.
+
+        :param document: The xml document.
+        :ptype document: str
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :param encode: Encode each record as a line of json.
+        :ptype encode: bool
+        :param id_tag: With encode, return (key, line) tuples instead of lines, where the key is
+            the value of the record's top level id_tag key, so the lines can be indexed without
+            decoding them again.
+        :ptype id_tag: str
+        :return: The converted records.
+        :rtype: list
+        """
+        records = []
+        for record in self.backend.convert_document(self, document, search_tag):
+            if record is None:
+                continue
+            if encode:
+                with stage_timer(self.stats, 'write'):
+                    line = json.dumps(record)
+                record = (record.get(id_tag), line) if id_tag is not None else line
+            records.append(record)
+        return records
+
+    def _convert_element(self, element, search_tag):
+        """
+        Convert an element that matches the search_tag to a dict, injecting classification
+        information along the way.
+
+        :param element: The element to convert.
+        :ptype element: Element
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :return: The record or None if the element is empty or filtered out.
+        :rtype: dict
+        """
+        if self.record_filter is not None and not self.record_filter.apply(element):
+            if self.stats is not None:
+                self.stats.incr('records_filtered')
+            return None
+        if self.stats is None:
+            return self._tree_to_dict(element, self.class_parser).get(search_tag)
+        record = self._timed_tree_to_dict(element).get(search_tag)
+        if record is not None:
+            self.stats.incr('records')
+        return record
+
+    def _timed_tree_to_dict(self, element):
+        """
+        Convert an element with _tree_to_dict and report the time spent, not counting injection,
+        to the stats.
+
+        :param element: The element to convert.
+        :ptype element: Element
+        :rtype: dict
+        """
+        injecting = self.stats.seconds['inject']
+        start = time.time()
+        tree_dict = self._tree_to_dict(element, self.class_parser)
+        elapsed = time.time() - start - (self.stats.seconds['inject'] - injecting)
+        self.stats.add_time('tree_to_dict', elapsed)
+        return tree_dict
+
+    def _iter_elements(self, xml_file, search_tag):
+        """
+        Yield each element of an xml file that matches the search_tag, parsed with an element
+        building backend. Once the caller is done with an element the backend releases it, so
+        neither the element nor an empty husk of it stays attached to the tree.
+
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :return: A generator of matching elements.
+        :rtype: generator
+        """
+        for _, element in self._iter_tagged_elements(xml_file, (search_tag,)):
+            yield element
+
+    def _iter_tagged_elements(self, xml_file, search_tags):
+        """
+        Yield each element of an xml file that matches one of the search_tags along with its tag,
+        parsed with an element building backend, in a single pass. Elements are released like in
+        _iter_elements, except for an element nested in a match of another tag, such as an
+        identifier in a device. It is yielded and then left in place, so it is also part of the
+        outer record.
+
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param search_tags: The tags we know about apriori.
+        :ptype search_tags: iterable
+        :return: A generator of (tag, element) tuples.
+        :rtype: generator
+        """
+        search_tags = frozenset(search_tags)
+        # Only several tags can nest in one another
+        nested = len(search_tags) > 1
+        elements = 0
+        # Time spent between yields is parsing, the rest belongs to the caller
+        parsing = 0
+        start = time.time()
+        for xml_in in iter_documents(xml_file):
+            # Track open elements so a finished element can be removed from its parent
+            stack = []
+            # The tags of the open matches, outermost first
+            open_tags = []
+            for event, element in self.backend.iterparse(xml_in, ("start", "end")):
+                if event == "start":
+                    stack.append(element)
+                    if nested:
+                        tag = self._normalize_tag(element.tag)
+                        if tag in search_tags:
+                            open_tags.append(tag)
+                    continue
+                stack.pop()
+                elements += 1
+                tag = self._normalize_tag(element.tag)
+                if tag in search_tags:
+                    if nested:
+                        open_tags.pop()
+                    parsing += time.time() - start
+                    yield tag, element
+                    start = time.time()
+                    if not open_tags or open_tags[0] == tag:
+                        self.backend.release(element, stack[-1] if stack else None)
+        if self.stats is not None:
+            self.stats.add_time('parse', parsing + time.time() - start)
+            self.stats.incr('elements', elements)
+
+    @classmethod
+    def tag_cache_info(cls):
+        """
+        Hit and miss counters of the tag normalization cache shared by all parser instances.
+
+        :rtype: dict
+        """
+        return cls._tag_cache.info()
+
+    @classmethod
+    def _normalize_tag(cls, tag):
+        """
+        Convert a possibly namespaced camelCase tag to a snake_case key. Results are cached.
+
+        :param tag: The element tag.
+        :ptype tag: str
+        :return: The snake_case key.
+        :rtype: str
+        """
+        return cls._tag_cache.get(tag, cls._convert_tag)
+
+    @classmethod
+    def _convert_tag(cls, tag):
+        """
+        Convert a possibly namespaced camelCase tag to a snake_case key without the cache.
+
+        :param tag: The element tag.
+        :ptype tag: str
+        :return: The snake_case key.
+        :rtype: str
+        """
+        return cls._camel_to_snake(cls._strip_namespace(tag))
 
     @classmethod
     def _camel_to_snake(cls, name):
@@ -123,10 +991,10 @@ class XMLDocParser(XMLParserInterface):
         """
         # Add an underscore between any character followed by an uppercase letter and a lowercase
         # letter
-        temp = re.sub('(.)([A-Z][a-z])', r'\1_\2', name)
+        temp = cls._first_cap_pattern.sub(r'\1_\2', name)
         # Add an underscore between any lowercase character or number followed by an uppercase
         # letter, then lowercase the whole string
-        return re.sub('([a-z0-9])([A-Z])', r'\1_\2', temp).lower()
+        return cls._all_cap_pattern.sub(r'\1_\2', temp).lower()
 
     @classmethod
     def _strip_namespace(cls, name):
@@ -144,10 +1012,10 @@ class XMLDocParser(XMLParserInterface):
         :return: A json representation of the dict.
         :rtype: json
         """
-        return json.dumps(dict_obj)
+        return json.dumps(dict_obj, default=to_json_default)
 
     @classmethod
-    def _dict_to_json_file(cls, dict_obj, json_file):
+    def _dict_to_json_file(cls, dict_obj, json_file, compress=None):
         """
         Pretty print a dictionary to a json file.
 
@@ -155,71 +1023,217 @@ class XMLDocParser(XMLParserInterface):
         :ptype dict_obj: dict_obj
         :param json_file: The path of the json file to write to.
         :ptype json_file: str
+        :param compress: Gzip compress the output. Defaults to compressing paths ending in .gz.
+        :ptype compress: bool
+        :return: The number of bytes of json written, before compression.
+        :rtype: int
         """
-        with open(json_file, 'w') as json_out:
-            json.dump(dict_obj, json_out, indent=2)
+        with open_output(json_file, compress) as json_out:
+            counter = CountingWriter(json_out)
+            json.dump(dict_obj, counter, indent=2, default=to_json_default)
+        return counter.bytes_written
 
     @classmethod
-    def _json_to_file(cls, json_obj, json_file):
+    def _dict_to_compact_json_file(cls, dict_obj, json_file, compress=None):
         """
-        Write raw json to file.
+        Write a dictionary to a json file without whitespace, encoding it incrementally.
 
         :param dict_obj: The dictionary object to print to file.
         :ptype dict_obj: dict_obj
         :param json_file: The path of the json file to write to.
         :ptype json_file: str
+        :param compress: Gzip compress the output. Defaults to compressing paths ending in .gz.
+        :ptype compress: bool
+        :return: The number of bytes of json written, before compression.
+        :rtype: int
         """
-        with open(json_file, 'w') as json_out:
-            json_out.write(json_obj)
+        with open_output(json_file, compress) as json_out:
+            counter = CountingWriter(json_out)
+            write_json(dict_obj, counter)
+        return counter.bytes_written
 
     @classmethod
-    def _tree_to_dict(cls, tree):
+    def _tree_to_dict(cls, tree, class_parser=None):
         """
         Convert an ElementTree object to a dictionary
 
+        The tree is walked with an explicit stack rather than recursion. Each child's key and
+        value are grouped straight into its parent's dict, repeated keys becoming lists, so no
+        intermediate containers are built per child.
+
         :param tree: A parsed XML object. Each tree element may contain child trees. Each tree
             element may have attribute values. Each tree element may have associated text.
         :ptype tree: ElementTree
+        :param class_parser: If provided, classification information is injected into each
+            subtree under the class_parser's inject_key as soon as it is converted.
+        :ptype class_parser: FDAClassificationParser
         :return: A dictionary representation of the parsed XML tree object. Note that order is not
             maintained.
         :rtype: dict
         """
-        attributes = tree.attrib
-        children = list(tree)
-        text = tree.text
-        # Omit empty elements
+        normalize = cls._normalize_tag
         tree_dict = {}
-        if text or children or attributes:
-            tag = cls._strip_namespace(tree.tag)
-            # Convert the camelCase tree.tag to snake_case
-            snake_tag = cls._camel_to_snake(tag)
-            tree_dict = {snake_tag: {} if attributes else None}
-            # Recursively build the dict for child trees
-            if children:
-                dd = defaultdict(list)
-                for child_tree_dict in map(cls._tree_to_dict, children):
-                    for k, v in child_tree_dict.iteritems():
-                        dd[k].append(v)
-                tree_dict = {snake_tag: {k:v[0] if len(v) == 1 else v for k, v in dd.iteritems()}}
-            # Check if the element has attributes and add them to an 'attribs' key in the dict
-            if attributes:
-                tree_dict[snake_tag]['attribs'] = {attrib: value for attrib, value in attributes.iteritems()}
-            # Check if the element has text
-            if text:
-                strip_text = text.strip()
-                if children or attributes:
+        # Each frame holds an element, the dict its converted children are grouped into and an
+        # iterator over the children that are left to convert. The bottom frame stands in for the
+        # parent of the tree.
+        stack = [(None, tree_dict, iter((tree,)))]
+        while True:
+            element, grouped, children = stack[-1]
+            for child in children:
+                # Descend into children that have children of their own
+                if len(child):
+                    stack.append((child, {}, iter(child)))
+                    break
+                # Convert leaves in place
+                attributes = child.attrib
+                text = child.text
+                if not attributes:
+                    # Plain text leaves are by far the most common, so group them inline
+                    if text:
+                        value = text.strip()
+                        snake_tag = normalize(child.tag)
+                        existing = grouped.get(snake_tag)
+                        if existing is None:
+                            grouped[snake_tag] = value
+                        elif isinstance(existing, list):
+                            existing.append(value)
+                        else:
+                            grouped[snake_tag] = [existing, value]
+                    # Omit empty elements
+                    continue
+                # Insert attributes in sorted order, so their json key order is the same whichever
+                # library built the element
+                value = {'attribs': dict(sorted(attributes.items()))}
+                if text:
+                    strip_text = text.strip()
                     if strip_text:
-                        tree_dict[snake_tag]['text'] = strip_text
-                else:
-                    tree_dict[snake_tag] = strip_text
-        return tree_dict
+                        value['text'] = strip_text
+                cls._group(grouped, normalize(child.tag), value, class_parser)
+            else:
+                stack.pop()
+                if not stack:
+                    return tree_dict
+                # All of the element's children have been converted
+                value = grouped
+                # Check if the element has attributes and add them to an 'attribs' key in the dict
+                attributes = element.attrib
+                if attributes:
+                    value['attribs'] = dict(sorted(attributes.items()))
+                # Check if the element has text
+                text = element.text
+                if text:
+                    strip_text = text.strip()
+                    if strip_text:
+                        value['text'] = strip_text
+                cls._group(stack[-1][1], normalize(element.tag), value, class_parser)
+
+    @classmethod
+    def _group(cls, grouped, snake_tag, value, class_parser):
+        """
+        Add a converted child to its parent's dict. A key seen more than once collects its values
+        in a list, in document order.
+
+        :param grouped: The parent's dict.
+        :ptype grouped: dict
+        :param snake_tag: The child's key.
+        :ptype snake_tag: str
+        :param value: The child's converted value, a str or a dict.
+        :ptype value: object
+        :param class_parser: If provided and the key is its inject_key, classification
+            information is injected into dict values.
+        :ptype class_parser: FDAClassificationParser
+        :rtype: void
+        """
+        # Inject classification information while the subtree is at hand
+        if class_parser is not None and snake_tag == class_parser.inject_key:
+            if isinstance(value, dict):
+                class_parser.inject(value)
+        existing = grouped.get(snake_tag)
+        if existing is None:
+            grouped[snake_tag] = value
+        # Values are only ever strings or dicts, so a list means the key is already grouped
+        elif isinstance(existing, list):
+            existing.append(value)
+        else:
+            grouped[snake_tag] = [existing, value]
 
     def inject_project_code(self):
         """
         Call the class_parser's rec_inject method to inject information into the _dict instance
-        variable.
+        variable. parse already injects classification information as each element is converted,
+        so this is only needed for dicts that were not produced by parse.
 
         :rtype: void
         """
         if self.class_parser is not None:
             self._dict = self.class_parser.rec_inject(self.dict)
+
+
+def _init_worker(parser):
+    """
+    Pool initializer. Keep a copy of the parser around in each worker process.
+
+    :param parser: The parser to convert batches, ranges or files with.
+    :ptype parser: XMLDocParser
+    :rtype: void
+    """
+    global _worker_parser
+    _worker_parser = parser
+
+
+def _convert_batch(document, search_tag, encode, id_tag=None):
+    """
+    Convert a batch of elements in a worker process.
+
+    :param document: The batch as an xml document.
+    :ptype document: str
+    :param search_tag: The tag we know about apriori.
+    :ptype search_tag: str
+    :param encode: Encode each record as a line of json.
+    :ptype encode: bool
+    :param id_tag: With encode, pair each line with the value of the record's top level id_tag key.
+    :ptype id_tag: str
+    :return: The converted records and the stats of the batch, if the parser keeps stats.
+    :rtype: tuple
+    """
+    stats = _worker_parser.stats
+    if stats is None:
+        return _worker_parser._convert_document(document, search_tag, encode, id_tag), None
+    # The worker's copy of the stats only covers the current batch
+    stats.reset()
+    records = _worker_parser._convert_document(document, search_tag, encode, id_tag)
+    return records, stats.to_dict()
+
+
+def _convert_range(xml_file, start, end, search_tag, prolog, encode, id_tag=None):
+    """
+    Split and convert the elements whose start tags begin within a byte range of an xml file in a
+    worker process.
+
+    :param xml_file: The path to the uncompressed xml file.
+    :ptype xml_file: str
+    :param start: The offset of the start of the range.
+    :ptype start: int
+    :param end: The offset just past the end of the range.
+    :ptype end: int
+    :param search_tag: The tag we know about apriori.
+    :ptype search_tag: str
+    :param prolog: The xml declaration and namespace declarations of the document.
+    :ptype prolog: tuple
+    :param encode: Encode each record as a line of json.
+    :ptype encode: bool
+    :param id_tag: With encode, pair each line with the value of the record's top level id_tag key.
+    :ptype id_tag: str
+    :return: The converted records and the stats of the range, if the parser keeps stats.
+    :rtype: tuple
+    """
+    stats = _worker_parser.stats
+    if stats is not None:
+        stats.reset()
+    splitter = XMLRecordSplitter(search_tag, _worker_parser._normalize_tag)
+    splitter.declaration, splitter.namespaces = prolog
+    with stage_timer(stats, 'split'):
+        raw_records = [raw for _, _, raw in splitter.iter_range(xml_file, start, end)]
+        document = splitter.wrap(raw_records) if raw_records else None
+    records = _worker_parser._convert_document(document, search_tag, encode, id_tag) if document else []
+    return records, stats.to_dict() if stats is not None else None
@@ -1,46 +1,335 @@
 # -*- coding: utf-8 -*-
 import copy
+import cPickle
+import os
+import sys
+import time
+from array import array
+from collections import Counter
+from parser_stats import stage_timer
+from writers import atomic_write
 
 
 __author__ = "Jonathan Sage"
 __email__ = "jsage8@gmail.com"
 
 
+class ClassificationColumn(object):
+    """
+    A dictionary encoded column of strings. Each distinct value is stored once, all of them
+    concatenated into a single string, and each row refers to its value by a small integer code.
+    This avoids the overhead of a separate string object per value.
+    """
+
+    __slots__ = ('codes', '_blob', '_offsets', '_lookup', '_values')
+
+    def __init__(self):
+        self.codes = array('H')
+        self._blob = ''
+        self._offsets = array('I', [0])
+        self._lookup = {}
+        self._values = []
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, row):
+        code = self.codes[row]
+        return self._blob[self._offsets[code]:self._offsets[code + 1]]
+
+    def append(self, value):
+        """
+        Append a row. Only valid until the column is frozen.
+
+        :param value: The value of the row.
+        :ptype value: str
+        :rtype: void
+        """
+        code = self._lookup.get(value)
+        if code is None:
+            code = self._lookup[value] = len(self._values)
+            self._values.append(value)
+            # Widen the codes once they no longer fit in two bytes
+            if code > 0xFFFF and self.codes.typecode == 'H':
+                self.codes = array('I', self.codes)
+        self.codes.append(code)
+
+    def freeze(self):
+        """
+        Pack the distinct values into a single string and drop the lookup used while appending.
+
+        :rtype: void
+        """
+        offset = 0
+        for value in self._values:
+            offset += len(value)
+            self._offsets.append(offset)
+        self._blob = ''.join(self._values)
+        self._lookup = None
+        self._values = None
+
+    def is_empty(self, row):
+        """
+        Check if a row's value is the empty string without materializing it.
+
+        :param row: The row number.
+        :ptype row: int
+        :rtype: bool
+        """
+        code = self.codes[row]
+        return self._offsets[code] == self._offsets[code + 1]
+
+    def memory_usage(self):
+        """
+        The approximate number of bytes used by the column.
+
+        :rtype: int
+        """
+        return sys.getsizeof(self.codes) + sys.getsizeof(self._offsets) + sys.getsizeof(self._blob)
+
+
 class FDAClassificationParser(object):
     """
     An FDA Classification document parser.
     """
 
-    def __init__(self, index_field="PRODUCTCODE"):
+    # Dicts stored under this key get classification information injected
+    inject_key = 'fda_product_code'
+    # Bump whenever the parsed state changes shape so stale caches are ignored
+    cache_version = 1
+    # The number of distinct product code combinations whose openfda lists are kept. The cache is
+    # emptied if it ever fills up.
+    products_cache_size = 4096
+
+    def __init__(self, index_field="PRODUCTCODE", secondary_fields=(), stats=None):
         self.index_field = index_field
+        self.secondary_fields = tuple(secondary_fields)
+        self.stats = stats
+        # Identifies the parsed classification file, see _cache_key
+        self.source_key = None
+        self.fields = []
+        self._keys = []
+        self._columns = []
+        # Maps each index_field value to its row number
         self._dict = {}
+        # Maps each secondary field to a dict of its values and the row numbers that have them
+        self._indexes = {}
+        # Product codes without a classification and how often each was injected
+        self.unknown_codes = Counter()
+        # The classification record of each product code injected so far, None if it is unknown
+        self._records = {}
+        # The openfda list and unknown codes of each combination of product codes injected so far
+        self._products = {}
 
     def get(self, class_code):
         """
-        The xml document's python dictionary representation.
+        The classification record whose index_field matches class_code.
+
+        :param class_code: The index_field value to look up.
+        :ptype class_code: str
+        :return: The record or None if there is no match.
+        :rtype: dict
         """
         if not self._dict:
             raise Exception("No document has been parsed. Try calling parse()")
-        return self._dict.get(class_code)
+        row = self._dict.get(class_code)
+        if self.stats is not None:
+            self.stats.incr('classification_lookups')
+            if row is None:
+                self.stats.incr('classification_misses')
+        if row is None:
+            return None
+        return self.record(row)
+
+    def get_by(self, field, value):
+        """
+        All classification records whose field matches value. The field must be the index_field
+        or one of the secondary_fields.
+
+        :param field: The header field to look up by, e.g. REGULATIONNUMBER.
+        :ptype field: str
+        :param value: The value to look up.
+        :ptype value: str
+        :return: The matching records.
+        :rtype: list
+        """
+        if field == self.index_field:
+            record = self.get(value)
+            return [] if record is None else [record]
+        return [self.record(row) for row in self._index(field).get(value, ())]
+
+    def get_many(self, values, field=None):
+        """
+        Look up a batch of values at once.
+
+        :param values: The values to look up.
+        :ptype values: iterable
+        :param field: The header field to look up by. Defaults to the index_field.
+        :ptype field: str
+        :return: A dict of each value and its record, or None if there is no match. When looking
+            up by a secondary field each value maps to a list of records instead.
+        :rtype: dict
+        """
+        if field is None or field == self.index_field:
+            return {value: self.get(value) for value in values}
+        index = self._index(field)
+        return {value: [self.record(row) for row in index.get(value, ())] for value in values}
+
+    def _index(self, field):
+        """
+        The secondary index of a field.
+
+        :param field: One of the secondary_fields.
+        :ptype field: str
+        :rtype: dict
+        """
+        if not self._dict:
+            raise Exception("No document has been parsed. Try calling parse()")
+        if field not in self._indexes:
+            raise ValueError("%s is not an indexed field" % field)
+        return self._indexes[field]
+
+    def record(self, row):
+        """
+        Build the record for a row. Keys are the lowercase header fields and empty fields are
+        omitted.
+
+        :param row: The row number.
+        :ptype row: int
+        :rtype: dict
+        """
+        return {
+            key: column[row] for key, column in zip(self._keys, self._columns)
+            if not column.is_empty(row)
+        }
 
-    def parse(self, classification_file):
+    def memory_usage(self):
         """
-        Parse an xml file that is located at the path represented by xml_file. This can be done in
-        one of two ways. With apriori knowledge of the file structure we can use iterparse, which
-        can help reduce memory usage. Without we have to parse starting at the root element and load
-        the full object into memory. Both functions store the result in the dict property.
+        The approximate number of bytes used to store the classification rows, not counting the
+        index.
 
-        :param xml_file: The path to the xml file to parse.
-        :ptype xml_file: str
-        :param search_tag: The tag we know about apriori.
-        :ptype search_tag: str
+        :rtype: int
+        """
+        return sum(column.memory_usage() for column in self._columns)
+
+    def parse(self, classification_file, cache_file=None):
+        """
+        Parse a pipe delimited FDA classification file into one ClassificationColumn per header
+        field and index the rows by the index_field and each of the secondary_fields in the same
+        pass.
+
+        If a cache_file is given the parsed columns and indexes are loaded from it instead, as long
+        as it was written for the same classification file (by size and modification time) and the
+        same index fields. Otherwise the file is parsed and the cache is rewritten.
+
+        :param classification_file: The path to the classification file to parse.
+        :ptype classification_file: str
+        :param cache_file: The path of the compiled index cache.
+        :ptype cache_file: str
         :rtype: void
         """
+        with stage_timer(self.stats, 'classification'):
+            self._records.clear()
+            self._products.clear()
+            key = self.source_key = self._cache_key(classification_file)
+            if cache_file is not None and self._load_cache(cache_file, key):
+                return
+            self._parse(classification_file)
+            if cache_file is not None:
+                self._write_cache(cache_file, key)
+
+    def _parse(self, classification_file):
+        """
+        Parse a classification file. See parse.
+
+        :param classification_file: The path to the classification file to parse.
+        :ptype classification_file: str
+        :rtype: void
+        """
+        # Row numbers only make sense for the columns being built, so start from scratch
+        self._dict = {}
+        self._indexes = {}
         with open(classification_file, 'r') as class_file:
-            header = next(class_file)
-            index = header.split("|").index(self.index_field)
-            for line in class_file:
-                self._dict[line.split("|")[index]] = line.strip()
+            self.fields = next(class_file).rstrip('\r\n').split("|")
+            index = self.fields.index(self.index_field)
+            secondary = [
+                (self.fields.index(field), self._indexes.setdefault(field, {}))
+                for field in self.secondary_fields
+            ]
+            width = len(self.fields)
+            columns = [ClassificationColumn() for _ in self.fields]
+            for row, line in enumerate(class_file):
+                values = line.rstrip('\r\n').split("|")
+                if len(values) < width:
+                    values.extend([''] * (width - len(values)))
+                for column, value in zip(columns, values):
+                    column.append(value)
+                self._dict[values[index]] = row
+                for field_index, field_rows in secondary:
+                    # Empty values are not worth indexing
+                    if values[field_index]:
+                        field_rows.setdefault(values[field_index], []).append(row)
+        for column in columns:
+            column.freeze()
+        self._columns = columns
+        self._keys = [field.lower() for field in self.fields]
+
+    def _cache_key(self, classification_file):
+        """
+        Identify the classification file and the options that shape the parsed state.
+
+        :param classification_file: The path to the classification file.
+        :ptype classification_file: str
+        :rtype: tuple
+        """
+        stat = os.stat(classification_file)
+        return (
+            self.cache_version,
+            os.path.abspath(classification_file),
+            stat.st_size,
+            stat.st_mtime,
+            self.index_field,
+            self.secondary_fields
+        )
+
+    def _load_cache(self, cache_file, key):
+        """
+        Load the parsed state from a cache file if it matches key.
+
+        :param cache_file: The path of the compiled index cache.
+        :ptype cache_file: str
+        :param key: The cache key of the classification file.
+        :ptype key: tuple
+        :return: Whether the cache was loaded.
+        :rtype: bool
+        """
+        try:
+            with open(cache_file, 'rb') as cache_in:
+                cached_key = cPickle.load(cache_in)
+                if cached_key != key:
+                    return False
+                self.fields, self._columns, self._dict, self._indexes = cPickle.load(cache_in)
+        # A missing, truncated or otherwise unreadable cache just means parsing from scratch
+        except Exception:
+            return False
+        self._keys = [field.lower() for field in self.fields]
+        return True
+
+    def _write_cache(self, cache_file, key):
+        """
+        Write the parsed state to a cache file. The key is written first so a stale cache can be
+        rejected without unpickling the rest. The file is replaced atomically.
+
+        :param cache_file: The path of the compiled index cache.
+        :ptype cache_file: str
+        :param key: The cache key of the classification file.
+        :ptype key: tuple
+        :rtype: void
+        """
+        with atomic_write(cache_file, 'wb') as cache_out:
+            cPickle.dump(key, cache_out, cPickle.HIGHEST_PROTOCOL)
+            state = (self.fields, self._columns, self._dict, self._indexes)
+            cPickle.dump(state, cache_out, cPickle.HIGHEST_PROTOCOL)
 
     def rec_inject(self, obj):
         """
@@ -54,12 +343,12 @@ class FDAClassificationParser(object):
         """
         if isinstance(obj, dict):
             for key, value in obj.iteritems():
-                if key == 'fda_product_code':
+                if key == self.inject_key:
                     if isinstance(value, dict):
-                        obj[key]['openfda'] = self.rec_get_products(value, products=[])
+                        self.inject(value)
                     elif isinstance(value, list):
-                        for index, element in enumerate(value):
-                            obj[key][index]['openfda'] = self.rec_get_products(element, products=[])
+                        for element in value:
+                            self.inject(element)
                 else:
                     obj[key] = self.rec_inject(value)
         elif isinstance(obj, list):
@@ -67,6 +356,100 @@ class FDAClassificationParser(object):
                 obj[index] = self.rec_inject(element)
         return obj
 
+    def inject(self, product):
+        """
+        Inject product code information into a single fda_product_code dict.
+
+        The openfda list is shared by every product with the same product codes, as are the
+        classification records in it, so they must not be modified.
+
+        :param product: The fda_product_code dict.
+        :ptype product: dict
+        :return: The same dict with an openfda value injected.
+        :rtype: dict
+        """
+        if self.stats is None:
+            product['openfda'] = self.get_products(product)
+            return product
+        start = time.time()
+        product['openfda'] = self.get_products(product)
+        self.stats.add_time('inject', time.time() - start)
+        return product
+
+    def get_products(self, product):
+        """
+        The classification records of every product code in a fda_product_code dict, memoized by
+        the combination of codes. Unknown codes are counted in unknown_codes.
+
+        :param product: The fda_product_code dict.
+        :ptype product: dict
+        :return: The records, or None for unknown codes, in the order the codes appear.
+        :rtype: list
+        """
+        codes = tuple(self.rec_get_codes(product, codes=[]))
+        cached = self._products.get(codes)
+        if cached is None:
+            if len(self._products) >= self.products_cache_size:
+                self._products.clear()
+            products = [self._record(code) for code in codes]
+            unknown = tuple(code for code, record in zip(codes, products) if record is None)
+            cached = self._products[codes] = (products, unknown)
+        else:
+            products, unknown = cached
+            if self.stats is not None:
+                # Count the lookups get would have counted
+                self.stats.incr('classification_products_hits')
+                self.stats.incr('classification_lookups', len(codes))
+                if unknown:
+                    self.stats.incr('classification_misses', len(unknown))
+        for code in unknown:
+            self.unknown_codes[code] += 1
+        return products
+
+    def _record(self, class_code):
+        """
+        The classification record of a product code, shared between every lookup of the code.
+
+        :param class_code: The index_field value to look up.
+        :ptype class_code: str
+        :return: The record or None if there is no match.
+        :rtype: dict
+        """
+        try:
+            record = self._records[class_code]
+        except KeyError:
+            if len(self._records) >= self.products_cache_size:
+                self._records.clear()
+            record = self._records[class_code] = self.get(class_code)
+            return record
+        if self.stats is not None:
+            self.stats.incr('classification_lookups')
+            if record is None:
+                self.stats.incr('classification_misses')
+        return record
+
+    def rec_get_codes(self, obj, codes=[]):
+        """
+        Recursively retrieve the product codes.
+
+        :param obj: The dict or list to get product codes out of.
+        :ptype obj: dict or list
+        :param codes: The list to append the product codes to.
+        :ptype codes: list
+        :return: The product codes.
+        :rtype: list
+        """
+        if isinstance(obj, dict):
+            for key, value in obj.iteritems():
+                if key == 'product_code':
+                    codes.append(value)
+                else:
+                    self.rec_get_codes(value, codes)
+        elif isinstance(obj, list):
+            for element in obj:
+                self.rec_get_codes(element, codes)
+        return codes
+
     def rec_get_products(self, obj, products=[]):
         """
         Recursively retrieve the product openfda classifiers.
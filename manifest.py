@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+from writers import atomic_write
+
+
+__author__ = "Jonathan Sage"
+__email__ = "jsage8@gmail.com"
+
+
+class RecordManifest(object):
+    """
+    Content hashes of the records of a previous conversion, keyed by record identifier. The salt
+    identifies everything besides a record's own content that went into converting it, such as the
+    classification file, so a change to those invalidates every hash.
+    """
+
+    version = 1
+
+    def __init__(self, hashes=None, salt=None):
+        self.hashes = hashes if hashes is not None else {}
+        self.salt = salt
+
+    @classmethod
+    def load(cls, manifest_file):
+        """
+        Load a manifest from a json file. A missing file is an empty manifest, so the first run
+        reports every record as added.
+
+        :param manifest_file: The path of the manifest.
+        :ptype manifest_file: str
+        :rtype: RecordManifest
+        """
+        if not os.path.exists(manifest_file):
+            return cls()
+        with open(manifest_file, 'r') as manifest_in:
+            manifest_dict = json.load(manifest_in)
+        if manifest_dict.get('version') != cls.version:
+            return cls()
+        return cls(manifest_dict['hashes'], manifest_dict['salt'])
+
+    def save(self, manifest_file):
+        """
+        Write the manifest to a json file, replacing it atomically.
+
+        :param manifest_file: The path of the manifest.
+        :ptype manifest_file: str
+        :rtype: void
+        """
+        with atomic_write(manifest_file) as manifest_out:
+            json.dump({'version': self.version, 'salt': self.salt, 'hashes': self.hashes}, manifest_out)
@@ -37,3 +37,44 @@ class XMLParserInterface(object):
         Write JSON to file.
         """
         raise NotImplementedError()
+
+
+class XMLBackend(object):
+    """
+    Turns xml into the dicts XMLDocParser produces. Backends differ in the xml library used and in
+    whether elements are built along the way.
+    """
+
+    __metaclass__ = ABCMeta
+
+    # The name the backend is selected by
+    name = None
+
+    @abstractmethod
+    def iter_records(self, xml_parser, xml_file, search_tag):
+        """
+        Yield the record of each element in an xml file that matches the search tag.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def iter_tagged_records(self, xml_parser, xml_file, search_tags):
+        """
+        Yield a (tag, record) tuple for each element in an xml file that matches one of the search
+        tags, in a single pass.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def convert_document(self, xml_parser, document, search_tag):
+        """
+        Convert every child of the root of an xml document string to a record.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def parse(self, xml_parser, xml_file):
+        """
+        Convert a whole xml file to a dict.
+        """
+        raise NotImplementedError()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+__author__ = "Jonathan Sage"
+__email__ = "jsage8@gmail.com"
+
+
+@contextmanager
+def _no_timer():
+    yield
+
+
+def stage_timer(stats, stage):
+    """
+    Time the body of a with statement if stats is not None.
+
+    :param stats: The stats to add the time to, if any.
+    :ptype stats: ParserStats
+    :param stage: The stage name.
+    :ptype stage: str
+    """
+    if stats is None:
+        return _no_timer()
+    return stats.timer(stage)
+
+
+class ParserStats(object):
+    """
+    Opt-in timings and counters for a conversion. Pass the same instance to the parsers and
+    writers involved and each reports the stages and counts it knows about.
+
+    Stages:
+        classification: loading the classification file
+        parse: reading and parsing xml, excluding time spent converting matched elements
+        split: splitting raw xml into batches for worker processes
+        tree_to_dict: converting elements to dicts, excluding injection
+        inject: injecting classification information
+        write: encoding and writing output
+        backpressure: a RecordPipeline's parser waiting for its consumer
+
+    Counters:
+        elements: xml elements parsed
+        records: records converted
+        records_filtered: records skipped by a record filter
+        classification_lookups: classification lookups
+        classification_misses: lookups without a matching classification
+        classification_products_hits: product code combinations whose openfda list was reused
+        bytes_written: bytes of json written, before any compression
+        records_added, records_changed, records_deleted, records_unchanged: the outcome of
+            comparing records against a manifest when converting only changes
+
+    Timings reported by worker processes are summed, so with several workers the stages can add
+    up to more than the elapsed time.
+    """
+
+    def __init__(self, hook=None):
+        """
+        :param hook: Called with the stats dict whenever emit is called.
+        :ptype hook: callable
+        """
+        self.hook = hook
+        self.seconds = defaultdict(float)
+        self.counters = defaultdict(int)
+        self._created = time.time()
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Time the body of a with statement and add it to a stage.
+
+        :param stage: The stage name.
+        :ptype stage: str
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.time() - start
+
+    def add_time(self, stage, seconds):
+        """
+        Add elapsed time to a stage.
+
+        :param stage: The stage name.
+        :ptype stage: str
+        :param seconds: The elapsed time.
+        :ptype seconds: float
+        :rtype: void
+        """
+        self.seconds[stage] += seconds
+
+    def incr(self, counter, count=1):
+        """
+        Increment a counter.
+
+        :param counter: The counter name.
+        :ptype counter: str
+        :param count: The amount to increment by.
+        :ptype count: int
+        :rtype: void
+        """
+        self.counters[counter] += count
+
+    def merge(self, stats_dict):
+        """
+        Add the timings and counters of another stats dict, e.g. one reported by a worker process.
+
+        :param stats_dict: A dict produced by to_dict.
+        :ptype stats_dict: dict
+        :rtype: void
+        """
+        for stage, stage_dict in stats_dict['stages'].iteritems():
+            self.seconds[stage] += stage_dict['seconds']
+        for counter, count in stats_dict['counters'].iteritems():
+            self.counters[counter] += count
+
+    def reset(self):
+        """
+        Zero all timings and counters.
+
+        :rtype: void
+        """
+        self.seconds.clear()
+        self.counters.clear()
+        self._created = time.time()
+
+    def to_dict(self):
+        """
+        The stats as a dict of stages, counters and the total elapsed time.
+
+        :rtype: dict
+        """
+        return {
+            'stages': {stage: {'seconds': seconds} for stage, seconds in self.seconds.iteritems()},
+            'counters': dict(self.counters),
+            'elapsed_seconds': time.time() - self._created
+        }
+
+    def to_json(self):
+        """
+        The stats as machine readable json.
+
+        :rtype: str
+        """
+        return self.dict_to_json(self.to_dict())
+
+    @classmethod
+    def dict_to_json(cls, stats_dict):
+        """
+        Convert a stats dict to json.
+
+        :param stats_dict: A dict produced by to_dict.
+        :ptype stats_dict: dict
+        :rtype: str
+        """
+        return json.dumps(stats_dict, indent=2, sort_keys=True)
+
+    def emit(self):
+        """
+        Pass the stats dict to the hook, if there is one.
+
+        :return: The stats dict.
+        :rtype: dict
+        """
+        stats_dict = self.to_dict()
+        if self.hook is not None:
+            self.hook(stats_dict)
+        return stats_dict
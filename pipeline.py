@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from Queue import Empty, Full, Queue
+
+
+__author__ = "Jonathan Sage"
+__email__ = "jsage8@gmail.com"
+
+
+# Put on the queue once the producer is done
+_DONE = object()
+
+
+class _Failure(object):
+    """
+    Put on the queue when the producer raised an exception.
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+
+class RecordPipeline(object):
+    """
+    Parse and inject records in a background thread and hand them to the consumer in batches
+    through a bounded queue. Once the queue is full the parser waits for the consumer, so a slow
+    sink never causes unbounded buffering. Exceptions raised while parsing are re-raised in the
+    consumer.
+
+    The calling thread is never blocked for longer than it asks to be, which makes the pipeline
+    suitable for embedding in an event loop, e.g. by polling get_batch with a timeout of 0 or by
+    running get_batch in an executor.
+    """
+
+    def __init__(self, xml_parser, xml_file, search_tag, workers=1, maxsize=8, batch_size=100):
+        """
+        :param xml_parser: The parser to produce records with.
+        :ptype xml_parser: XMLDocParser
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :param workers: The number of processes used to convert elements.
+        :ptype workers: int
+        :param maxsize: The number of batches that may be waiting for the consumer.
+        :ptype maxsize: int
+        :param batch_size: The number of records per batch.
+        :ptype batch_size: int
+        """
+        self.xml_parser = xml_parser
+        self.xml_file = xml_file
+        self.search_tag = search_tag
+        self.workers = workers
+        self.batch_size = batch_size
+        self._queue = Queue(maxsize)
+        self._stop = threading.Event()
+        self._thread = None
+        self._done = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        """
+        Block until each record is available.
+
+        :return: A generator of record dicts.
+        :rtype: generator
+        """
+        while True:
+            batch = self.get_batch()
+            if not batch:
+                return
+            for record in batch:
+                yield record
+
+    def start(self):
+        """
+        Start parsing in the background.
+
+        :rtype: void
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._produce, name='RecordPipeline')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def get_batch(self, timeout=None):
+        """
+        Take the next batch of records off the queue.
+
+        :param timeout: The number of seconds to wait for a batch, or None to wait as long as it
+            takes.
+        :ptype timeout: float
+        :return: The next batch, an empty list once every record has been consumed or None if the
+            timeout passed first.
+        :rtype: list
+        """
+        if self._done:
+            return []
+        self.start()
+        try:
+            if timeout is None:
+                # Wait in slices so the consumer stays interruptible
+                while True:
+                    try:
+                        item = self._queue.get(timeout=0.1)
+                        break
+                    except Empty:
+                        continue
+            else:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+        except Empty:
+            return None
+        if item is _DONE:
+            self._done = True
+            return []
+        if isinstance(item, _Failure):
+            self._done = True
+            raise item.error
+        return item
+
+    def close(self):
+        """
+        Stop the producer, whether or not every record was consumed, and wait for it.
+
+        :rtype: void
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._done = True
+
+    def write_to(self, writer):
+        """
+        Consume every record into a writer.
+
+        :param writer: An open writer, e.g. an NDJSONWriter.
+        :ptype writer: NDJSONWriter
+        :return: The number of records written.
+        :rtype: int
+        """
+        count = 0
+        for record in self:
+            writer.write(record)
+            count += 1
+        return count
+
+    def _produce(self):
+        """
+        Parse the file and put batches of records on the queue. Runs in the background thread.
+
+        :rtype: void
+        """
+        try:
+            batch = []
+            for record in self.xml_parser.iter_parse(self.xml_file, self.search_tag, self.workers):
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    if not self._put(batch):
+                        return
+                    batch = []
+            if batch and not self._put(batch):
+                return
+            self._put(_DONE)
+        except Exception as error:
+            self._put(_Failure(error))
+
+    def _put(self, item):
+        """
+        Put an item on the queue, waiting while it is full unless the pipeline is closed.
+
+        :param item: A batch, _DONE or a _Failure.
+        :ptype item: object
+        :return: Whether the item was put on the queue.
+        :rtype: bool
+        """
+        stats = self.xml_parser.stats
+        start = time.time()
+        try:
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+        finally:
+            if stats is not None:
+                stats.add_time('backpressure', time.time() - start)
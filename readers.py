@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import gzip
+import io
+import posixpath
+import zipfile
+
+
+__author__ = "Jonathan Sage"
+__email__ = "jsage8@gmail.com"
+
+
+# Bytes decompressed at a time, so the parsers' small reads are served from memory
+BUFFER_SIZE = 1 << 20
+
+
+def document_names(path):
+    """
+    The xml documents held by an input file. A zip archive, such as a GUDID release download,
+    holds one document per .xml member, leaving out the __MACOSX/ and ._ resource fork members
+    that macOS adds to the archives it creates. Any other file, plain or gzip compressed, is a
+    single document.
+
+    :param path: The path of the input file.
+    :ptype path: str
+    :return: The names of the zip members in archive order, or [None] for a single document.
+    :rtype: list
+    """
+    if not path.endswith('.zip'):
+        return [None]
+    archive = zipfile.ZipFile(path)
+    try:
+        names = [
+            name for name in archive.namelist()
+            if name.lower().endswith('.xml') and not name.startswith('__MACOSX/') and
+            not posixpath.basename(name).startswith('._')
+        ]
+    finally:
+        archive.close()
+    if not names:
+        raise ValueError("%s holds no .xml members" % path)
+    return names
+
+
+def open_document(path, name=None):
+    """
+    Open a single xml document for buffered binary reading, decompressing it on the fly if path
+    ends in .gz or .zip.
+
+    :param path: The path of the input file.
+    :ptype path: str
+    :param name: The zip member to open, see document_names. Required for zip archives.
+    :ptype name: str
+    :return: A readable file object.
+    :rtype: file
+    """
+    if path.endswith('.zip'):
+        return _ZipMemberReader(path, name)
+    if path.endswith('.gz'):
+        return io.BufferedReader(gzip.open(path, 'rb'), BUFFER_SIZE)
+    return open(path, 'rb')
+
+
+def iter_documents(path):
+    """
+    Open each xml document of an input file in turn, closing it once the caller moves on.
+
+    :param path: The path of the input file.
+    :ptype path: str
+    :return: A generator of readable file objects.
+    :rtype: generator
+    """
+    for name in document_names(path):
+        with open_document(path, name) as xml_in:
+            yield xml_in
+
+
+def open_single_document(path):
+    """
+    Open an input file that must hold exactly one xml document, e.g. to parse it whole.
+
+    :param path: The path of the input file.
+    :ptype path: str
+    :return: A readable file object.
+    :rtype: file
+    """
+    names = document_names(path)
+    if len(names) > 1:
+        raise ValueError(
+            "%s holds %d xml documents. Pass a search tag to stream their records" % (path, len(names))
+        )
+    return open_document(path, names[0])
+
+
+def open_input(path, offset=0):
+    """
+    Open the raw bytes of an input file as a single stream, decompressed, with the documents of
+    a zip archive concatenated in archive order, and positioned at a byte offset into that
+    stream. Only compressed input has to be read up to the offset.
+
+    :param path: The path of the input file.
+    :ptype path: str
+    :param offset: The offset to start reading at.
+    :ptype offset: int
+    :return: A readable file object.
+    :rtype: file
+    """
+    if path.endswith('.zip'):
+        stream = io.BufferedReader(_ConcatenatedReader(path, document_names(path)), BUFFER_SIZE)
+    else:
+        stream = open_document(path)
+    if not offset:
+        return stream
+    if not path.endswith(('.gz', '.zip')):
+        stream.seek(offset)
+        return stream
+    while offset > 0:
+        data = stream.read(min(offset, BUFFER_SIZE))
+        if not data:
+            break
+        offset -= len(data)
+    return stream
+
+
+class _ZipMemberReader(io.BufferedReader):
+    """
+    A buffered reader of a zip member that also closes the archive it belongs to.
+    """
+
+    def __init__(self, path, name):
+        archive = zipfile.ZipFile(path)
+        try:
+            member = archive.open(name)
+        except Exception:
+            archive.close()
+            raise
+        io.BufferedReader.__init__(self, member, BUFFER_SIZE)
+        self._archive = archive
+
+    def close(self):
+        try:
+            io.BufferedReader.close(self)
+        finally:
+            self._archive.close()
+
+
+class _ConcatenatedReader(io.RawIOBase):
+    """
+    Read the given members of a zip archive one after the other as if they were a single file.
+    """
+
+    def __init__(self, path, names):
+        io.RawIOBase.__init__(self)
+        self._path = path
+        self._names = list(names)
+        self._member = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while True:
+            if self._member is None:
+                if not self._names:
+                    return 0
+                self._member = open_document(self._path, self._names.pop(0))
+            data = self._member.read(len(buf))
+            if data:
+                buf[:len(data)] = data
+                return len(data)
+            self._member.close()
+            self._member = None
+
+    def close(self):
+        if self._member is not None:
+            self._member.close()
+            self._member = None
+        io.RawIOBase.close(self)
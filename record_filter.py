@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+
+__author__ = "Jonathan Sage"
+__email__ = "jsage8@gmail.com"
+
+
+class RecordFilter(object):
+    """
+    A projection and filter applied to each element that matches the search tag before it is
+    converted. Paths are dotted snake_case keys relative to the record, e.g.
+    product_codes.fda_product_code.product_code.
+
+    Elements that fail a predicate are skipped entirely, and children outside of the projection are
+    removed from the element, so neither is ever converted to a dict or has classification
+    information injected.
+    """
+
+    def __init__(self, normalize, fields=None, where=None):
+        """
+        :param normalize: Converts an element tag to its key.
+        :ptype normalize: callable
+        :param fields: The paths to keep, along with everything below them. Keeps everything if
+            not given.
+        :ptype fields: list
+        :param where: Maps paths to the values allowed there. An element is kept if, for every
+            path, the text of at least one element at that path is among its values.
+        :ptype where: dict
+        """
+        self.normalize = normalize
+        self.fields = list(fields) if fields else []
+        self.where = [(path.split('.'), frozenset(values)) for path, values in (where or {}).items()]
+        # A tree of the keys to keep, where None keeps a whole subtree
+        self._projection = None
+        for field in self.fields:
+            self._projection = self._add_path(self._projection, field.split('.'))
+
+    def __repr__(self):
+        return 'RecordFilter(fields=%r, where=%r)' % (
+            sorted(self.fields), sorted(('.'.join(path), sorted(values)) for path, values in self.where)
+        )
+
+    @classmethod
+    def parse_where(cls, expressions):
+        """
+        Parse command line predicates of the form path=value1,value2.
+
+        :param expressions: The predicates.
+        :ptype expressions: list
+        :rtype: dict
+        """
+        where = {}
+        for expression in expressions:
+            if '=' not in expression:
+                raise ValueError("Expected path=value1,value2 but got %s" % expression)
+            path, values = expression.split('=', 1)
+            where.setdefault(path.strip(), set()).update(value.strip() for value in values.split(','))
+        return where
+
+    def apply(self, element):
+        """
+        Check an element against the predicates and prune it to the projection.
+
+        :param element: The element that matches the search tag.
+        :ptype element: Element
+        :return: Whether the element should be converted.
+        :rtype: bool
+        """
+        for path, values in self.where:
+            if not any((match.text or '').strip() in values for match in self._find(element, path)):
+                return False
+        if self._projection is not None:
+            self._prune(element, self._projection)
+        return True
+
+    def _find(self, element, path):
+        """
+        All elements below an element at a path.
+
+        :param element: The element to search from.
+        :ptype element: Element
+        :param path: The keys of the path.
+        :ptype path: list
+        :rtype: list
+        """
+        matches = [element]
+        for key in path:
+            matches = [child for match in matches for child in match if self.normalize(child.tag) == key]
+        return matches
+
+    def _prune(self, element, projection):
+        """
+        Remove the children of an element that are outside of a projection.
+
+        :param element: The element to prune.
+        :ptype element: Element
+        :param projection: The projection tree for the element's children.
+        :ptype projection: dict
+        :rtype: void
+        """
+        normalize = self.normalize
+        kept = []
+        for child in element:
+            key = normalize(child.tag)
+            if key not in projection:
+                continue
+            if projection[key] is not None:
+                self._prune(child, projection[key])
+            kept.append(child)
+        element[:] = kept
+
+    @classmethod
+    def _add_path(cls, projection, path):
+        """
+        Add a path to a projection tree. A shorter path keeps everything below it.
+
+        :param projection: The projection tree, or None for an empty one.
+        :ptype projection: dict
+        :param path: The keys of the path.
+        :ptype path: list
+        :rtype: dict
+        """
+        if projection is None:
+            projection = {}
+        key = path[0]
+        if len(path) == 1:
+            projection[key] = None
+        elif key not in projection or projection[key] is not None:
+            projection[key] = cls._add_path(projection.get(key), path[1:])
+        return projection
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+import heapq
+import json
+import mmap
+import os
+import tempfile
+from itertools import islice
+from writers import atomic_write
+
+
+__author__ = "Jonathan Sage"
+__email__ = "jsage8@gmail.com"
+
+
+def index_path(json_file):
+    """
+    The path of the sidecar index of a newline delimited json file.
+
+    :param json_file: The path of the ndjson file.
+    :ptype json_file: str
+    :rtype: str
+    """
+    return json_file + '.idx'
+
+
+class RecordIndexWriter(object):
+    """
+    Build the sidecar index of a newline delimited json file as its lines are written. Each line
+    of the index holds a record's json encoded key, the byte offset of its line in the output and
+    the line's length, separated by tabs. The lines are sorted by key, so RecordIndex can binary
+    search the file without loading it.
+
+    Entries are spilled to a temporary file while the output is written and sorted when the index
+    is closed, a sort_size entries at a time, so memory use does not grow with the output.
+    """
+
+    # The number of entries sorted in memory at a time
+    sort_size = 1 << 20
+
+    def __init__(self, index_file, id_tag):
+        """
+        :param index_file: The path of the index to write.
+        :ptype index_file: str
+        :param id_tag: The key that identifies each record, e.g. public_device_record_key.
+        :ptype id_tag: str
+        """
+        self.index_file = index_file
+        self.id_tag = id_tag
+        self.entries = 0
+        self._index_dir = os.path.dirname(os.path.abspath(index_file))
+        # Created on the first entry, so an index that is never written leaves nothing behind
+        self._spill = None
+        self._spill_path = None
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def add(self, key, offset, length):
+        """
+        Index a record by the value of its id_tag key, which callers take from the record itself
+        before encoding it, so a same named key nested deeper in the record is never used.
+
+        :param key: The value of the record's id_tag key.
+        :ptype key: str
+        :param offset: The byte offset of the record's line in the output.
+        :ptype offset: int
+        :param length: The length of the line, without its newline.
+        :ptype length: int
+        :rtype: void
+        """
+        if key is None:
+            raise ValueError("Record without a %s at offset %d" % (self.id_tag, offset))
+        if self._spill is None:
+            handle, self._spill_path = tempfile.mkstemp(dir=self._index_dir)
+            self._spill = os.fdopen(handle, 'w')
+        self._spill.write('%s\t%d\t%d\n' % (json.dumps(key), offset, length))
+        self.entries += 1
+
+    def close(self):
+        """
+        Sort the spilled entries into the index, replacing it atomically.
+
+        :rtype: void
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        runs = []
+        try:
+            with atomic_write(self.index_file) as index_out:
+                with open(self._spill_path or os.devnull, 'r') as spill_in:
+                    chunk = self._read_chunk(spill_in)
+                    if len(chunk) < self.sort_size:
+                        # Small enough to sort in one go
+                        index_out.writelines(_format_entry(entry) for entry in chunk)
+                        chunk = None
+                    while chunk:
+                        run_handle, run_path = tempfile.mkstemp(dir=self._index_dir)
+                        runs.append(run_path)
+                        with os.fdopen(run_handle, 'w') as run_out:
+                            run_out.writelines(_format_entry(entry) for entry in chunk)
+                        chunk = self._read_chunk(spill_in)
+                if runs:
+                    run_files = [open(run_path, 'r') for run_path in runs]
+                    try:
+                        merged = heapq.merge(*[
+                            (_parse_entry(line) for line in run_in) for run_in in run_files
+                        ])
+                        index_out.writelines(_format_entry(entry) for entry in merged)
+                    finally:
+                        for run_in in run_files:
+                            run_in.close()
+        finally:
+            for run_path in runs:
+                os.remove(run_path)
+            if self._spill_path is not None:
+                os.remove(self._spill_path)
+
+    def _read_chunk(self, spill_in):
+        """
+        Read up to sort_size spilled entries and sort them.
+
+        :param spill_in: The open spill file.
+        :ptype spill_in: file
+        :rtype: list
+        """
+        chunk = [_parse_entry(line) for line in islice(spill_in, self.sort_size)]
+        chunk.sort()
+        return chunk
+
+    def discard(self):
+        """
+        Give up on the index, e.g. because writing the output failed. An index left over from a
+        previous output is removed too, since it no longer matches.
+
+        :rtype: void
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+            os.remove(self._spill_path)
+        if os.path.exists(self.index_file):
+            os.remove(self.index_file)
+
+
+class RecordIndex(object):
+    """
+    A sorted sidecar index written by RecordIndexWriter. The index is memory mapped and binary
+    searched, so opening it is instant however many records it holds.
+    """
+
+    def __init__(self, index_file):
+        """
+        :param index_file: The path of the index.
+        :ptype index_file: str
+        """
+        self.index_file = index_file
+        self._file = open(index_file, 'rb')
+        # An empty file cannot be mapped, and has nothing to find anyway
+        self._map = _map_file(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key):
+        """
+        Find a record's line in the output.
+
+        :param key: The value of the record's id_tag.
+        :ptype key: str
+        :return: The byte offset and length of the record's first line with the key, or None if
+            there is none.
+        :rtype: tuple
+        """
+        index = self._map
+        target = json.dumps(key)
+        # Narrow down to the first line whose key is not less than the target
+        low = 0
+        high = len(index)
+        while low < high:
+            middle = (low + high) // 2
+            start = index.rfind('\n', low, middle)
+            start = low if start == -1 else start + 1
+            end = index.find('\n', start)
+            if index[start:index.find('\t', start, end)] < target:
+                low = end + 1
+            else:
+                high = start
+        if low >= len(index):
+            return None
+        entry = _parse_entry(index[low:index.find('\n', low)])
+        if entry[0] != target:
+            return None
+        return entry[1], entry[2]
+
+    def close(self):
+        """
+        Unmap and close the index.
+
+        :rtype: void
+        """
+        if self._map:
+            self._map.close()
+        self._map = ''
+        self._file.close()
+
+
+class RecordReader(object):
+    """
+    Fetch single records from a newline delimited json file by key through its sidecar index. The
+    output is memory mapped rather than read, so only the pages of the records looked up are ever
+    touched.
+    """
+
+    def __init__(self, json_file, index_file=None):
+        """
+        :param json_file: The path of the uncompressed ndjson file.
+        :ptype json_file: str
+        :param index_file: The path of its index. Defaults to index_path(json_file).
+        :ptype index_file: str
+        """
+        self.json_file = json_file
+        self.index = RecordIndex(index_file if index_file is not None else index_path(json_file))
+        self._file = open(json_file, 'rb')
+        self._map = _map_file(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, key):
+        record = self.get(key)
+        if record is None:
+            raise KeyError(key)
+        return record
+
+    def get(self, key):
+        """
+        The record with a key.
+
+        :param key: The value of the record's id_tag.
+        :ptype key: str
+        :return: The record or None if there is none.
+        :rtype: dict
+        """
+        line = self.get_line(key)
+        return json.loads(line) if line is not None else None
+
+    def get_line(self, key):
+        """
+        The json encoded record with a key.
+
+        :param key: The value of the record's id_tag.
+        :ptype key: str
+        :return: The line, without its newline, or None if there is none.
+        :rtype: str
+        """
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        offset, length = entry
+        return self._map[offset:offset + length]
+
+    def close(self):
+        """
+        Unmap and close the output and its index.
+
+        :rtype: void
+        """
+        if self._map:
+            self._map.close()
+        self._map = ''
+        self._file.close()
+        self.index.close()
+
+
+def _map_file(file_in):
+    """
+    Memory map an open file for reading.
+
+    :param file_in: The open file.
+    :ptype file_in: file
+    :return: The map, or an empty string for an empty file.
+    :rtype: mmap
+    """
+    if not os.fstat(file_in.fileno()).st_size:
+        return ''
+    return mmap.mmap(file_in.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _parse_entry(line):
+    """
+    Split an index line into its encoded key, offset and length.
+
+    :param line: The index line.
+    :ptype line: str
+    :rtype: tuple
+    """
+    key, offset, length = line.rstrip('\n').split('\t')
+    return key, int(offset), int(length)
+
+
+def _format_entry(entry):
+    """
+    Join an encoded key, offset and length into an index line.
+
+    :param entry: The key, offset and length.
+    :ptype entry: tuple
+    :rtype: str
+    """
+    return '%s\t%d\t%d\n' % entry
@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+import gzip
+import io
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from compact import CompactRecord, to_json_default
+
+
+__author__ = "Jonathan Sage"
+__email__ = "jsage8@gmail.com"
+
+
+# Bytes collected before each write to the underlying file
+BUFFER_SIZE = 1 << 20
+# Trades a slightly larger file for much faster compression than the default of 9
+GZIP_LEVEL = 6
+
+
+def open_output(path, compress=None, append=False):
+    """
+    Open an output file for buffered binary writing.
+
+    :param path: The path of the file to write to.
+    :ptype path: str
+    :param compress: Gzip compress the output. Defaults to compressing paths ending in .gz.
+    :ptype compress: bool
+    :param append: Append to the file rather than replacing it. Compressed output is appended as
+        a new gzip member.
+    :ptype append: bool
+    :return: A writable file object.
+    :rtype: file
+    """
+    if compress is None:
+        compress = path.endswith('.gz')
+    mode = 'ab' if append else 'wb'
+    if compress:
+        return io.BufferedWriter(gzip.open(path, mode, GZIP_LEVEL), BUFFER_SIZE)
+    return io.open(path, mode, buffering=BUFFER_SIZE)
+
+
+@contextmanager
+def atomic_write(path, mode='w', sync=False):
+    """
+    Write a file through a temporary file in the same directory, which replaces the file once the
+    block completes, so a reader never sees it half written. The temporary file is removed if the
+    block raises.
+
+    :param path: The path of the file to replace.
+    :ptype path: str
+    :param mode: The mode to open the temporary file with, 'w' or 'wb'.
+    :ptype mode: str
+    :param sync: Flush the file to disk before replacing, so it survives a crash.
+    :ptype sync: bool
+    :return: The temporary file, open for writing.
+    :rtype: file
+    """
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(handle, mode) as temp_out:
+            yield temp_out
+            if sync:
+                temp_out.flush()
+                os.fsync(temp_out.fileno())
+        # mkstemp creates the file readable by its owner only, unlike the outputs written directly
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def write_json(obj, out, depth=3):
+    """
+    Encode obj as compact json and write it to out in chunks. Dicts and lists are walked down to
+    depth levels and everything below that is encoded one value at a time, so the full document
+    never exists as a single string. The output is identical to json.dumps(obj).
+
+    :param obj: The object to encode.
+    :ptype obj: dict
+    :param out: A writable file object.
+    :ptype out: file
+    :param depth: How many levels of containers to walk before encoding values whole.
+    :ptype depth: int
+    :rtype: void
+    """
+    if depth and isinstance(obj, (dict, CompactRecord)) and obj and \
+            all(isinstance(key, basestring) for key in obj):
+        out.write('{')
+        for index, (key, value) in enumerate(obj.iteritems()):
+            if index:
+                out.write(', ')
+            out.write(json.dumps(key))
+            out.write(': ')
+            write_json(value, out, depth - 1)
+        out.write('}')
+    elif depth and isinstance(obj, list) and obj:
+        out.write('[')
+        for index, value in enumerate(obj):
+            if index:
+                out.write(', ')
+            write_json(value, out, depth - 1)
+        out.write(']')
+    else:
+        out.write(json.dumps(obj, default=to_json_default))
+
+
+class CountingWriter(object):
+    """
+    Wrap a writable file object and count the bytes written through it.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        self.out.write(data)
+
+
+class NDJSONWriter(object):
+    """
+    A newline delimited json writer. Each record is written to the output as soon as it is
+    received, one compact json document per line, so records never accumulate in memory.
+    """
+
+    def __init__(self, json_file, compress=None, stats=None, append=False, index=None):
+        """
+        :param json_file: The path of the ndjson file to write to.
+        :ptype json_file: str
+        :param compress: Gzip compress the output. Defaults to compressing paths ending in .gz.
+        :ptype compress: bool
+        :param stats: If provided, write time and bytes are reported to it.
+        :ptype stats: ParserStats
+        :param append: Append to the file rather than replacing it.
+        :ptype append: bool
+        :param index: If provided, every line is added to this sidecar index. Requires an
+            uncompressed output that is written from scratch, so offsets can be seeked to.
+        :ptype index: RecordIndexWriter
+        """
+        if compress is None:
+            compress = json_file.endswith('.gz')
+        if index is not None and (compress or append):
+            raise ValueError("An index requires an uncompressed output that is not appended to")
+        self.json_file = json_file
+        self.compress = compress
+        self.stats = stats
+        self.append = append
+        self.index = index
+        self.records = 0
+        self.bytes_written = 0
+        self._out = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.index is not None:
+            self.index.discard()
+        self.close()
+
+    def open(self):
+        """
+        Open the output file for writing.
+
+        :rtype: void
+        """
+        self._out = open_output(self.json_file, self.compress, self.append)
+
+    def close(self):
+        """
+        Close the output file and finish the index, if there is one.
+
+        :rtype: void
+        """
+        self._close_output()
+        if self.index is not None:
+            self.index.close()
+
+    def _close_output(self):
+        """
+        Close the output file.
+
+        :rtype: void
+        """
+        if self._out is not None:
+            if self.stats is None:
+                self._out.close()
+            else:
+                with self.stats.timer('write'):
+                    self._out.close()
+            self._out = None
+
+    def sync(self):
+        """
+        Make everything written so far durable. Compressed output ends its gzip member, so the
+        file is complete up to the returned size and can later be truncated back to it and
+        appended to.
+
+        :return: The size of the output file.
+        :rtype: int
+        """
+        self._close_output()
+        with open(self.json_file, 'ab') as json_out:
+            os.fsync(json_out.fileno())
+        self._out = open_output(self.json_file, self.compress, append=True)
+        return os.path.getsize(self.json_file)
+
+    def write(self, record):
+        """
+        Write a single record to the output as one line of json.
+
+        :param record: The record to write.
+        :ptype record: dict
+        :rtype: void
+        """
+        # Index the record by its own top level key, not a same named key nested in it
+        key = record.get(self.index.id_tag) if self.index is not None else None
+        if self.stats is None:
+            self.write_line(json.dumps(record), key)
+            return
+        start = time.time()
+        self.write_line(json.dumps(record), key)
+        self.stats.add_time('write', time.time() - start)
+
+    def write_line(self, line, key=None):
+        """
+        Write a record that has already been encoded as json.
+
+        :param line: The json encoded record.
+        :ptype line: str
+        :param key: The value of the record's id_tag key, required when writing an index.
+        :ptype key: str
+        :rtype: void
+        """
+        if self.index is not None:
+            self.index.add(key, self.bytes_written, len(line))
+        self._out.write(line)
+        self._out.write('\n')
+        self.records += 1
+        self.bytes_written += len(line) + 1
+        if self.stats is not None:
+            self.stats.incr('bytes_written', len(line) + 1)
+
+
+class ShardedNDJSONWriter(object):
+    """
+    A newline delimited json writer that splits its output into shards, so downstream loaders can
+    read them in parallel. A new shard is started once the current one holds max_records records
+    or max_bytes bytes, before compression, whichever comes first. Shards are named part-00000.ndjson
+    and so on in the output directory, so the same input and limits always give the same shards.
+
+    Once every record is written a manifest listing each shard with its record and byte counts is
+    written to manifest.json in the output directory. Shards left over from a previous run into the
+    same directory are removed when the writer is opened, so the directory always matches its
+    manifest, and a directory without a manifest holds an unfinished conversion.
+    """
+
+    manifest_name = 'manifest.json'
+    version = 1
+
+    def __init__(self, output_dir, max_records=None, max_bytes=None, compress=False, stats=None):
+        """
+        :param output_dir: The directory to write the shards to. Created if it does not exist.
+        :ptype output_dir: str
+        :param max_records: The most records per shard.
+        :ptype max_records: int
+        :param max_bytes: The most bytes per shard. A record is never split, so a shard ends with
+            the record that reaches the limit.
+        :ptype max_bytes: int
+        :param compress: Gzip compress the shards.
+        :ptype compress: bool
+        :param stats: If provided, write time and bytes are reported to it.
+        :ptype stats: ParserStats
+        """
+        if not max_records and not max_bytes:
+            raise ValueError("Sharded output requires a maximum number of records or bytes per shard")
+        self.output_dir = output_dir
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.stats = stats
+        self.records = 0
+        self.bytes_written = 0
+        self.shards = []
+        self._writer = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._close_shard()
+
+    def open(self):
+        """
+        Create the output directory and remove the shards and manifest of a previous run.
+
+        :rtype: void
+        """
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        for name in os.listdir(self.output_dir):
+            if name == self.manifest_name or (name.startswith('part-') and '.ndjson' in name):
+                os.remove(os.path.join(self.output_dir, name))
+
+    def close(self):
+        """
+        Close the last shard and write the manifest.
+
+        :rtype: void
+        """
+        self._close_shard()
+        self.write_manifest()
+
+    def shard_path(self, number):
+        """
+        The path of a shard.
+
+        :param number: The shard's number, counting from 0.
+        :ptype number: int
+        :rtype: str
+        """
+        return os.path.join(
+            self.output_dir, 'part-%05d.ndjson%s' % (number, '.gz' if self.compress else '')
+        )
+
+    def write(self, record):
+        """
+        Write a single record to the current shard as one line of json.
+
+        :param record: The record to write.
+        :ptype record: dict
+        :rtype: void
+        """
+        if self.stats is None:
+            self.write_line(json.dumps(record))
+            return
+        start = time.time()
+        self.write_line(json.dumps(record))
+        self.stats.add_time('write', time.time() - start)
+
+    def write_line(self, line):
+        """
+        Write a record that has already been encoded as json, starting a new shard first if the
+        current one is full.
+
+        :param line: The json encoded record.
+        :ptype line: str
+        :rtype: void
+        """
+        writer = self._writer
+        if writer is None:
+            writer = self._open_shard()
+        writer.write_line(line)
+        self.records += 1
+        self.bytes_written += len(line) + 1
+        if (self.max_records and writer.records >= self.max_records) or \
+                (self.max_bytes and writer.bytes_written >= self.max_bytes):
+            self._close_shard()
+
+    def write_manifest(self):
+        """
+        Write the manifest, replacing it atomically.
+
+        :rtype: void
+        """
+        with atomic_write(os.path.join(self.output_dir, self.manifest_name)) as manifest_out:
+            json.dump({
+                'version': self.version,
+                'records': self.records,
+                'bytes': self.bytes_written,
+                'compressed': self.compress,
+                'shards': self.shards
+            }, manifest_out, indent=2, sort_keys=True)
+
+    def _open_shard(self):
+        """
+        Start the next shard.
+
+        :rtype: NDJSONWriter
+        """
+        self._writer = NDJSONWriter(self.shard_path(len(self.shards)), self.compress, self.stats)
+        self._writer.open()
+        return self._writer
+
+    def _close_shard(self):
+        """
+        Close the current shard, if one is open, and add it to the manifest.
+
+        :rtype: void
+        """
+        writer = self._writer
+        if writer is None:
+            return
+        self._writer = None
+        writer.close()
+        self.shards.append({
+            'file': os.path.basename(writer.json_file),
+            'records': writer.records,
+            'bytes': writer.bytes_written
+        })
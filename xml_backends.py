@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+import time
+from xml.etree import cElementTree as ElementTree
+from xml.parsers import expat
+from parser_interface import XMLBackend
+from parser_stats import stage_timer
+from readers import iter_documents, open_single_document
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+
+__author__ = "Jonathan Sage"
+__email__ = "jsage8@gmail.com"
+
+
+class EtreeBackend(XMLBackend):
+    """
+    Parse with cElementTree and convert the resulting elements with XMLDocParser._tree_to_dict.
+    """
+
+    name = 'etree'
+
+    def iterparse(self, xml_file, events):
+        return ElementTree.iterparse(xml_file, events=events)
+
+    def fromstring(self, document):
+        return ElementTree.fromstring(document)
+
+    def parse_tree(self, xml_file):
+        return ElementTree.parse(xml_file).getroot()
+
+    def release(self, element, parent):
+        """
+        Free an element yielded by iterparse once it has been converted.
+
+        :param element: The converted element.
+        :ptype element: Element
+        :param parent: The element's parent, if any.
+        :ptype parent: Element
+        :rtype: void
+        """
+        element.clear()
+        if parent is not None:
+            parent.remove(element)
+
+    def iter_records(self, xml_parser, xml_file, search_tag):
+        """
+        Yield the record of each element in an xml file that matches the search tag.
+
+        :param xml_parser: The parser the records are for.
+        :ptype xml_parser: XMLDocParser
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :return: A generator of record dicts.
+        :rtype: generator
+        """
+        for element in xml_parser._iter_elements(xml_file, search_tag):
+            record = xml_parser._convert_element(element, search_tag)
+            if record is not None:
+                yield record
+
+    def iter_tagged_records(self, xml_parser, xml_file, search_tags):
+        """
+        Yield the tag and record of each element in an xml file that matches one of the search
+        tags, in a single pass. See XMLDocParser._iter_tagged_elements for how nested matches are
+        handled.
+
+        :param xml_parser: The parser the records are for.
+        :ptype xml_parser: XMLDocParser
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param search_tags: The tags of the records.
+        :ptype search_tags: iterable
+        :return: A generator of (tag, record) tuples.
+        :rtype: generator
+        """
+        for tag, element in xml_parser._iter_tagged_elements(xml_file, search_tags):
+            record = xml_parser._convert_element(element, tag)
+            if record is not None:
+                yield tag, record
+
+    def convert_document(self, xml_parser, document, search_tag):
+        """
+        Convert every child of the root of an xml document, such as a batch produced by
+        XMLRecordSplitter.
+
+        :param xml_parser: The parser the records are for.
+        :ptype xml_parser: XMLDocParser
+        :param document: The xml document.
+        :ptype document: str
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :return: The records, or None for elements that are empty or filtered out.
+        :rtype: list
+        """
+        stats = xml_parser.stats
+        with stage_timer(stats, 'parse'):
+            root = self.fromstring(document)
+        if stats is not None:
+            stats.incr('elements', sum(1 for _ in root.iter()) - 1)
+        return [xml_parser._convert_element(element, search_tag) for element in root]
+
+    def parse(self, xml_parser, xml_file):
+        """
+        Parse a whole xml file into memory and convert it to a dict.
+
+        :param xml_parser: The parser the dict is for.
+        :ptype xml_parser: XMLDocParser
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :rtype: dict
+        """
+        stats = xml_parser.stats
+        with stage_timer(stats, 'parse'):
+            with open_single_document(xml_file) as xml_in:
+                root = self.parse_tree(xml_in)
+        if stats is None:
+            return xml_parser._tree_to_dict(root, xml_parser.class_parser)
+        stats.incr('elements', sum(1 for _ in root.iter()))
+        return xml_parser._timed_tree_to_dict(root)
+
+
+class LxmlBackend(EtreeBackend):
+    """
+    Parse with lxml, if it is installed, and convert the resulting elements like EtreeBackend.
+    Comments and processing instructions are dropped, as cElementTree does.
+    """
+
+    name = 'lxml'
+
+    def __init__(self):
+        if lxml_etree is None:
+            raise ImportError("The lxml backend requires lxml. Try pip install lxml")
+        self._parser = lxml_etree.XMLParser(remove_comments=True, remove_pis=True, huge_tree=True)
+
+    def iterparse(self, xml_file, events):
+        return lxml_etree.iterparse(
+            xml_file, events=events, remove_comments=True, remove_pis=True, huge_tree=True
+        )
+
+    def fromstring(self, document):
+        return lxml_etree.fromstring(document, self._parser)
+
+    def parse_tree(self, xml_file):
+        return lxml_etree.parse(xml_file, self._parser).getroot()
+
+    def release(self, element, parent):
+        # libxml2 may still append text to the element while parsing, so it is only removed once
+        # the next element has been converted
+        element.clear()
+        if parent is not None:
+            while element.getprevious() is not None:
+                del parent[0]
+
+
+class ExpatBackend(XMLBackend):
+    """
+    Build record dicts straight from expat's callbacks without creating any elements. The dicts
+    are the same as XMLDocParser._tree_to_dict produces, with one exception: an element nested in
+    a record that also matches the search tag is part of the outer record, as with
+    XMLRecordSplitter, rather than a record of its own. Record filters need elements and are not
+    supported.
+    """
+
+    name = 'expat'
+
+    # The number of bytes fed to expat at a time
+    read_size = 1 << 16
+
+    def iter_records(self, xml_parser, xml_file, search_tag):
+        """
+        Yield the record of each element in an xml file that matches the search tag.
+
+        :param xml_parser: The parser the records are for.
+        :ptype xml_parser: XMLDocParser
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :return: A generator of record dicts.
+        :rtype: generator
+        """
+        return self._iter_built(xml_parser, xml_file, lambda: _RecordBuilder(xml_parser, search_tag))
+
+    def iter_tagged_records(self, xml_parser, xml_file, search_tags):
+        """
+        Yield the tag and record of each element in an xml file that matches one of the search
+        tags, in a single pass. An element nested in a record of another tag is part of that
+        record and also a record of its own. One nested in a record of the same tag is only part
+        of the outer record, as with iter_records.
+
+        :param xml_parser: The parser the records are for.
+        :ptype xml_parser: XMLDocParser
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param search_tags: The tags of the records.
+        :ptype search_tags: iterable
+        :return: A generator of (tag, record) tuples.
+        :rtype: generator
+        """
+        return self._iter_built(
+            xml_parser, xml_file, lambda: _RecordBuilder(xml_parser, None, search_tags)
+        )
+
+    def _iter_built(self, xml_parser, xml_file, create_builder):
+        """
+        Feed each document of an xml file to a record builder and yield its records as they are
+        completed.
+
+        :param xml_parser: The parser the records are for.
+        :ptype xml_parser: XMLDocParser
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :param create_builder: Creates a _RecordBuilder. Each document needs one of its own.
+        :ptype create_builder: callable
+        :return: A generator of the builder's records.
+        :rtype: generator
+        """
+        builder = create_builder()
+        stats = xml_parser.stats
+        # Building records is timed as parsing, apart from injection
+        parsing = 0
+        for index, xml_in in enumerate(iter_documents(xml_file)):
+            if index:
+                # Each document of a zip archive needs a parser of its own
+                builder = create_builder()
+            while True:
+                injecting = stats.seconds['inject'] if stats is not None else 0
+                start = time.time()
+                data = xml_in.read(self.read_size)
+                builder.feed(data, not data)
+                if stats is not None:
+                    parsing += time.time() - start - (stats.seconds['inject'] - injecting)
+                for record in builder.records:
+                    yield record
+                del builder.records[:]
+                if not data:
+                    break
+            if stats is not None:
+                stats.incr('elements', builder.elements)
+                stats.incr('records', builder.count)
+        if stats is not None:
+            stats.add_time('parse', parsing)
+
+    def convert_document(self, xml_parser, document, search_tag):
+        """
+        Convert every child of the root of an xml document, such as a batch produced by
+        XMLRecordSplitter.
+
+        :param xml_parser: The parser the records are for.
+        :ptype xml_parser: XMLDocParser
+        :param document: The xml document.
+        :ptype document: str
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :return: The records.
+        :rtype: list
+        """
+        builder = _RecordBuilder(xml_parser, search_tag)
+        stats = xml_parser.stats
+        with stage_timer(stats, 'parse'):
+            builder.feed(document, True)
+        if stats is not None:
+            stats.incr('elements', builder.elements - 1)
+            stats.incr('records', builder.count)
+        return builder.records
+
+    def parse(self, xml_parser, xml_file):
+        """
+        Convert a whole xml file to a dict.
+
+        :param xml_parser: The parser the dict is for.
+        :ptype xml_parser: XMLDocParser
+        :param xml_file: The path to the xml file to parse.
+        :ptype xml_file: str
+        :rtype: dict
+        """
+        builder = _RecordBuilder(xml_parser, None)
+        with stage_timer(xml_parser.stats, 'parse'):
+            with open_single_document(xml_file) as xml_in:
+                builder.parser.ParseFile(xml_in)
+        if xml_parser.stats is not None:
+            xml_parser.stats.incr('elements', builder.elements)
+        return builder.records[0] if builder.records else {}
+
+
+class _RecordBuilder(object):
+    """
+    Expat handlers that group each record's children into dicts as they are parsed.
+    """
+
+    def __init__(self, xml_parser, search_tag, search_tags=None):
+        """
+        :param xml_parser: The parser the records are for.
+        :ptype xml_parser: XMLDocParser
+        :param search_tag: The tag of the records, or None to convert the whole document into a
+            single dict keyed by the root's tag.
+        :ptype search_tag: str
+        :param search_tags: Instead of a search_tag, the tags of several kinds of records. Records
+            are then collected as (tag, record) tuples.
+        :ptype search_tags: iterable
+        """
+        if xml_parser.record_filter is not None:
+            raise ValueError("Record filters are not supported by the expat backend")
+        self.normalize = xml_parser._normalize_tag
+        # Keys by raw tag, saving a trip through the shared tag cache per element
+        self._keys = {}
+        self.group = xml_parser._group
+        self.class_parser = xml_parser.class_parser
+        self.search_tag = search_tag
+        self.tagged = search_tags is not None
+        if self.tagged:
+            self._matches = frozenset(search_tags)
+        else:
+            self._matches = frozenset((search_tag,)) if search_tag is not None else None
+        self.records = []
+        self.count = 0
+        self.elements = 0
+        # Each frame holds an element's key, attributes, text, grouped children and whether it has any
+        # children, for every open element of the current record
+        self._stack = []
+        self.parser = expat.ParserCreate(None, '}')
+        self.parser.buffer_text = True
+        # Hand over utf-8 encoded str rather than decoding everything to unicode. The json output
+        # is the same either way.
+        self.parser.returns_unicode = False
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.parser.CharacterDataHandler = self._data
+
+    def feed(self, data, final):
+        self.parser.Parse(data, final)
+
+    def _start(self, tag, attributes):
+        self.elements += 1
+        key = self._keys.get(tag)
+        if key is None:
+            key = self._keys[tag] = self.normalize(tag)
+        stack = self._stack
+        if stack:
+            stack[-1][4] = True
+        elif self._matches is not None and key not in self._matches:
+            # Outside of a record
+            return
+        if attributes:
+            for name in [name for name in attributes if '}' in name]:
+                # Match cElementTree's {namespace}name
+                attributes['{' + name] = attributes.pop(name)
+        # [key, attributes, text, grouped children, has children]
+        stack.append([key, attributes, None, {}, False])
+
+    def _data(self, data):
+        stack = self._stack
+        if stack:
+            frame = stack[-1]
+            # Only text before the first child counts, as with Element.text
+            if not frame[4]:
+                frame[2] = data if frame[2] is None else frame[2] + data
+
+    def _end(self, tag):
+        stack = self._stack
+        if not stack:
+            return
+        snake_tag, attributes, text, grouped, has_children = stack.pop()
+        if stack:
+            parent = stack[-1][3]
+        else:
+            # The record is done. Group it into a holder so the record itself gets classification
+            # information injected like any other subtree.
+            parent = {}
+        value = None
+        if not has_children and not attributes:
+            # Omit empty elements
+            if text is not None:
+                value = text.strip()
+                existing = parent.get(snake_tag)
+                if existing is None:
+                    parent[snake_tag] = value
+                elif isinstance(existing, list):
+                    existing.append(value)
+                else:
+                    parent[snake_tag] = [existing, value]
+        else:
+            value = grouped
+            if attributes:
+                # Sorted like _tree_to_dict does, which makes the key order match
+                value['attribs'] = dict(sorted(attributes.items()))
+            if text:
+                strip_text = text.strip()
+                if strip_text:
+                    value['text'] = strip_text
+            self.group(parent, snake_tag, value, self.class_parser)
+        if stack:
+            if self.tagged and value is not None and snake_tag in self._matches and \
+                    snake_tag != stack[0][0]:
+                # Nested in a record of another tag, so also a record of its own
+                self.records.append((snake_tag, value))
+                self.count += 1
+            return
+        if self._matches is None:
+            self.records.append(parent)
+            return
+        record = parent.get(snake_tag)
+        if record is not None:
+            self.records.append((snake_tag, record) if self.tagged else record)
+            self.count += 1
+
+
+BACKENDS = {backend.name: backend for backend in (EtreeBackend, LxmlBackend, ExpatBackend)}
+
+
+def get_backend(name):
+    """
+    Create a backend by name.
+
+    :param name: One of BACKENDS.
+    :ptype name: str
+    :rtype: XMLBackend
+    """
+    if name not in BACKENDS:
+        raise ValueError("Unknown xml backend %s. Expected one of %s" % (name, ', '.join(sorted(BACKENDS))))
+    return BACKENDS[name]()
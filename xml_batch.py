@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+import glob
+import multiprocessing
+import os
+import shutil
+import time
+import doc_parser
+
+
+__author__ = "Jonathan Sage"
+__email__ = "jsage8@gmail.com"
+
+
+# The files of a directory that are converted, plain or compressed
+INPUT_PATTERNS = ('*.xml', '*.xml.gz', '*.zip')
+
+
+def is_batch(xml_path):
+    """
+    Check whether an --xml argument names a batch of files rather than a single file.
+
+    :param xml_path: A path, directory or glob pattern.
+    :ptype xml_path: str
+    :rtype: bool
+    """
+    if os.path.isdir(xml_path):
+        return True
+    return glob.has_magic(xml_path) and not os.path.isfile(xml_path)
+
+
+def expand_inputs(xml_path):
+    """
+    Expand a directory or glob pattern into a sorted list of xml files.
+
+    :param xml_path: A directory, whose .xml, .xml.gz and .zip files are used, or a glob pattern.
+    :ptype xml_path: str
+    :rtype: list
+    """
+    if os.path.isdir(xml_path):
+        paths = []
+        for pattern in INPUT_PATTERNS:
+            paths.extend(glob.glob(os.path.join(xml_path, pattern)))
+    else:
+        paths = glob.glob(xml_path)
+    return sorted(path for path in paths if os.path.isfile(path))
+
+
+class BatchConverter(object):
+    """
+    Convert many xml files, e.g. the part files of a GUDID release, with a pool of worker
+    processes. The parser, along with its classification index, is set up once in the parent and
+    inherited by every worker. Each file is streamed to newline delimited json.
+    """
+
+    def __init__(self, xml_parser, search_tag, workers=1):
+        """
+        :param xml_parser: The parser to convert each file with.
+        :ptype xml_parser: XMLDocParser
+        :param search_tag: The tag we know about apriori.
+        :ptype search_tag: str
+        :param workers: The number of files converted at a time.
+        :ptype workers: int
+        """
+        self.xml_parser = xml_parser
+        self.search_tag = search_tag
+        self.workers = workers
+
+    def convert(self, xml_files, output, merge=False, compress=None):
+        """
+        Convert each xml file to newline delimited json.
+
+        :param xml_files: The xml files to convert.
+        :ptype xml_files: list
+        :param output: A directory to write one output per input to, or the merged output file.
+        :ptype output: str
+        :param merge: Concatenate all records into the output file in input order.
+        :ptype merge: bool
+        :param compress: Gzip compress the output. Defaults to compressing a merged output path
+            ending in .gz.
+        :ptype compress: bool
+        :return: A summary per input file, in input order.
+        :rtype: list
+        """
+        if compress is None:
+            compress = merge and output.endswith('.gz')
+        if merge:
+            parts_dir = os.path.dirname(os.path.abspath(output))
+            json_files = [
+                os.path.join(parts_dir, '.%s.part%05d' % (os.path.basename(output), index))
+                for index in range(len(xml_files))
+            ]
+        else:
+            json_files = self.output_paths(xml_files, output, compress)
+            for json_dir in set(os.path.dirname(json_file) for json_file in json_files):
+                if not os.path.isdir(json_dir):
+                    os.makedirs(json_dir)
+        tasks = [
+            (xml_file, json_file, self.search_tag, compress)
+            for xml_file, json_file in zip(xml_files, json_files)
+        ]
+        pool = multiprocessing.Pool(self.workers, doc_parser._init_worker, (self.xml_parser,))
+        try:
+            summaries = []
+            for summary, stats_dict in pool.imap(_convert_file, tasks):
+                if stats_dict is not None:
+                    self.xml_parser.stats.merge(stats_dict)
+                summaries.append(summary)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        if merge:
+            # Gzip members can simply be concatenated as well
+            with open(output, 'wb') as merged:
+                for json_file in json_files:
+                    with open(json_file, 'rb') as part:
+                        shutil.copyfileobj(part, merged, 1 << 20)
+                    os.remove(json_file)
+            for summary in summaries:
+                summary['json_file'] = output
+        return summaries
+
+    @classmethod
+    def output_paths(cls, xml_files, output_dir, compress=False):
+        """
+        The per file output paths of a batch of xml files. Inputs in subdirectories of the
+        directory the batch has in common keep those subdirectories in the output directory, so
+        inputs that only share a file name, e.g. 2023/part.xml and 2024/part.xml, do not overwrite
+        each other. Inputs that would still share an output, such as part.xml and part.xml.gz,
+        raise a ValueError.
+
+        :param xml_files: The xml files.
+        :ptype xml_files: list
+        :param output_dir: The output directory.
+        :ptype output_dir: str
+        :param compress: Whether the outputs are gzip compressed.
+        :ptype compress: bool
+        :return: The output paths, in input order.
+        :rtype: list
+        """
+        if not xml_files:
+            return []
+        # commonprefix compares lists item by item, so this is the deepest directory in common
+        input_root = os.sep.join(os.path.commonprefix([
+            os.path.dirname(os.path.abspath(xml_file)).split(os.sep) for xml_file in xml_files
+        ])) or os.sep
+        json_files = [cls.output_path(xml_file, output_dir, compress, input_root) for xml_file in xml_files]
+        # Compression suffixes are dropped, so e.g. part.xml and part.xml.gz would share an output
+        sources = {}
+        for xml_file, json_file in zip(xml_files, json_files):
+            if json_file in sources:
+                raise ValueError(
+                    "%s and %s would both be converted to %s" % (sources[json_file], xml_file, json_file)
+                )
+            sources[json_file] = xml_file
+        return json_files
+
+    @classmethod
+    def output_path(cls, xml_file, output_dir, compress=False, input_root=None):
+        """
+        The per file output path of an xml file.
+
+        :param xml_file: The xml file.
+        :ptype xml_file: str
+        :param output_dir: The output directory.
+        :ptype output_dir: str
+        :param compress: Whether the output is gzip compressed.
+        :ptype compress: bool
+        :param input_root: If provided, the xml file's path relative to it is kept in the output
+            directory. Otherwise only its file name is.
+        :ptype input_root: str
+        :rtype: str
+        """
+        if input_root is not None:
+            name = os.path.relpath(os.path.abspath(xml_file), input_root)
+        else:
+            name = os.path.basename(xml_file)
+        if name.endswith('.gz'):
+            name = name[:-len('.gz')]
+        name = os.path.splitext(name)[0]
+        return os.path.join(output_dir, name + ('.ndjson.gz' if compress else '.ndjson'))
+
+    @classmethod
+    def format_summary(cls, summaries):
+        """
+        Render per file and total throughput as a table.
+
+        :param summaries: The summaries returned by convert.
+        :ptype summaries: list
+        :rtype: str
+        """
+        lines = []
+        records = 0
+        size = 0
+        seconds = 0.0
+        for summary in summaries:
+            lines.append('%-40s %9d records %8.2fs %10.0f records/s %8.1f MB/s' % (
+                os.path.basename(summary['xml_file']), summary['records'], summary['seconds'],
+                summary['records_per_sec'], summary['mb_per_sec']
+            ))
+            records += summary['records']
+            size += summary['bytes_read']
+            seconds += summary['seconds']
+        lines.append('%-40s %9d records %8.2fs of work across %d files, %.1f MB read' % (
+            'total', records, seconds, len(summaries), size / float(1 << 20)
+        ))
+        return '\n'.join(lines)
+
+
+def _convert_file(task):
+    """
+    Convert one xml file in a worker process.
+
+    :param task: The xml file, json file, search tag and whether to compress.
+    :ptype task: tuple
+    :return: The file's summary and stats, if the parser keeps stats.
+    :rtype: tuple
+    """
+    xml_file, json_file, search_tag, compress = task
+    # Set by the pool initializer, doc_parser._init_worker
+    xml_parser = doc_parser._worker_parser
+    stats = xml_parser.stats
+    if stats is not None:
+        stats.reset()
+    start = time.time()
+    records = xml_parser.stream_to_file(xml_file, json_file, search_tag, compress=compress)
+    seconds = time.time() - start
+    bytes_read = os.path.getsize(xml_file)
+    summary = {
+        'xml_file': xml_file,
+        'json_file': json_file,
+        'records': records,
+        'bytes_read': bytes_read,
+        'seconds': seconds,
+        'records_per_sec': records / seconds if seconds else 0.0,
+        'mb_per_sec': bytes_read / float(1 << 20) / seconds if seconds else 0.0
+    }
+    return summary, stats.to_dict() if stats is not None else None
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from xml.etree import cElementTree as ElementTree
+from xml.sax.saxutils import escape
+
+from doc_parser import XMLDocParser
+from foi import FDAClassificationParser
+from xml_backends import BACKENDS
+
+
+__author__ = "Jonathan Sage"
+__email__ = "jsage8@gmail.com"
+
+
+SIZES = {'10MB': 10 << 20, '100MB': 100 << 20, '1GB': 1 << 30}
+STAGES = ['iterparse', 'tree_to_dict', 'records', 'rec_inject', 'iter_parse', 'std_parse', 'stream']
+# Stages that are run once per --backends, the rest always use etree
+BACKEND_STAGES = ['records', 'iter_parse', 'std_parse', 'stream']
+SEARCH_TAG = 'device'
+NAMESPACE = 'http://www.fda.gov/cdrh/gudid'
+
+DEVICE_TEMPLATE = (
+    '<device>'
+    '<publicDeviceRecordKey>%(key)s</publicDeviceRecordKey>'
+    '<publicVersionStatus>New</publicVersionStatus>'
+    '<publicVersionNumber>%(version)d</publicVersionNumber>'
+    '<publicVersionDate>2016-0%(month)d-1%(day)d</publicVersionDate>'
+    '<deviceRecordStatus>Published</deviceRecordStatus>'
+    '<devicePublishDate>2015-0%(month)d-2%(day)d</devicePublishDate>'
+    '<deviceCommDistributionStatus>In Commercial Distribution</deviceCommDistributionStatus>'
+    '<brandName>%(brand)s</brandName>'
+    '<versionModelNumber>%(model)s</versionModelNumber>'
+    '<catalogNumber>%(model)s</catalogNumber>'
+    '<companyName>%(company)s</companyName>'
+    '<deviceCount>1</deviceCount>'
+    '<deviceDescription>%(description)s</deviceDescription>'
+    '<DMExempt>false</DMExempt>'
+    '<premarketExempt>false</premarketExempt>'
+    '<deviceHCTP>false</deviceHCTP>'
+    '<deviceKit>false</deviceKit>'
+    '<deviceCombinationProduct>false</deviceCombinationProduct>'
+    '<singleUse>true</singleUse>'
+    '<lotBatch>true</lotBatch>'
+    '<serialNumber>false</serialNumber>'
+    '<manufacturingDate>false</manufacturingDate>'
+    '<expirationDate>true</expirationDate>'
+    '<donationIdNumber>false</donationIdNumber>'
+    '<labeledContainsNRL>false</labeledContainsNRL>'
+    '<labeledNoNRL>false</labeledNoNRL>'
+    '<MRISafetyStatus>Labeling does not contain MRI Safety Information</MRISafetyStatus>'
+    '<rx>true</rx>'
+    '<otc>false</otc>'
+    '<contacts><customerContact><phone>+1(800)555-%(phone)04d</phone>'
+    '<email>support@example.com</email></customerContact></contacts>'
+    '<identifiers>%(identifiers)s</identifiers>'
+    '<productCodes>%(product_codes)s</productCodes>'
+    '<deviceSizes><deviceSize><sizeType>Length</sizeType>'
+    '<size unit="Millimeter" value="%(size)d"/></deviceSize></deviceSizes>'
+    '<environmentalConditions><storageHandling><storageHandlingType>Storage Environment '
+    'Temperature</storageHandlingType><storageHandlingHigh unit="Degrees Celsius" value="30"/>'
+    '<storageHandlingLow unit="Degrees Celsius" value="-10"/></storageHandling>'
+    '</environmentalConditions>'
+    '<sterilization><deviceSterile>%(sterile)s</deviceSterile>'
+    '<sterilizationPriorToUse>false</sterilizationPriorToUse></sterilization>'
+    '</device>\n'
+)
+IDENTIFIER_TEMPLATE = (
+    '<identifier><deviceId>%(device_id)014d</deviceId><deviceIdType>%(type)s</deviceIdType>'
+    '<deviceIdIssuingAgency>GS1</deviceIdIssuingAgency><pkgQuantity>%(quantity)d</pkgQuantity>'
+    '</identifier>'
+)
+PRODUCT_CODE_TEMPLATE = (
+    '<fdaProductCode><productCode>%(code)s</productCode>'
+    '<productCodeName>%(name)s</productCodeName></fdaProductCode>'
+)
+
+
+def load_product_codes(class_file):
+    """
+    Collect product codes and names to sample from. Rows that are not plain ascii are skipped so
+    the synthetic records can always be encoded as json.
+
+    :param class_file: The path to an FDA classification file.
+    :ptype class_file: str
+    :rtype: list
+    """
+    with open(class_file, 'r') as class_in:
+        fields = next(class_in).rstrip('\r\n').split('|')
+        code, name = fields.index('PRODUCTCODE'), fields.index('DEVICENAME')
+        rows = [line.rstrip('\r\n').split('|') for line in class_in]
+    return [(row[code], row[name]) for row in rows if all(ord(char) < 128 for char in ''.join(row))]
+
+
+def generate(xml_file, size, product_codes, seed=0):
+    """
+    Write a synthetic UDI-shaped xml file of at least size bytes. The same seed always produces
+    the same file.
+
+    :param xml_file: The path of the xml file to write.
+    :ptype xml_file: str
+    :param size: The minimum file size in bytes.
+    :ptype size: int
+    :param product_codes: The (code, name) pairs to sample product codes from.
+    :ptype product_codes: list
+    :param seed: The random seed.
+    :ptype seed: int
+    :return: The number of device records written.
+    :rtype: int
+    """
+    rand = random.Random(seed)
+    written = 0
+    records = 0
+    with open(xml_file, 'w') as xml_out:
+        head = '<?xml version="1.0" encoding="UTF-8"?>\n<gudid xmlns="%s">\n' % NAMESPACE
+        head += '<header><fileName>synthetic</fileName><recordCount>0</recordCount></header>\n'
+        xml_out.write(head)
+        written += len(head)
+        while written < size:
+            identifiers = ''.join(
+                IDENTIFIER_TEMPLATE % {
+                    'device_id': rand.randint(0, 10 ** 14 - 1),
+                    'type': 'Primary' if index == 0 else 'Package',
+                    'quantity': 1 if index == 0 else rand.choice([5, 10, 50])
+                }
+                for index in range(rand.randint(1, 3))
+            )
+            product_codes_xml = ''.join(
+                PRODUCT_CODE_TEMPLATE % {'code': code, 'name': escape(name)}
+                for code, name in rand.sample(product_codes, rand.randint(1, 3))
+            )
+            device = DEVICE_TEMPLATE % {
+                'key': '%08x-%04x-%04x' % (rand.getrandbits(32), records % 0xFFFF, rand.getrandbits(16)),
+                'version': rand.randint(1, 9),
+                'month': rand.randint(1, 9),
+                'day': rand.randint(0, 9),
+                'brand': 'Brand %d' % rand.randint(0, 50000),
+                'model': 'M-%06d' % rand.randint(0, 999999),
+                'company': 'Company %d' % rand.randint(0, 5000),
+                'description': 'Synthetic device %d for benchmarking' % records,
+                'phone': rand.randint(0, 9999),
+                'identifiers': identifiers,
+                'product_codes': product_codes_xml,
+                'size': rand.randint(1, 500),
+                'sterile': rand.choice(['true', 'false'])
+            }
+            xml_out.write(device)
+            written += len(device)
+            records += 1
+        xml_out.write('</gudid>\n')
+    return records
+
+
+def run_stage(stage, xml_file, class_file, workers=1, backend='etree'):
+    """
+    Time a single stage of the pipeline in this process.
+
+    :param stage: One of STAGES.
+    :ptype stage: str
+    :param xml_file: The path to the xml file to convert.
+    :ptype xml_file: str
+    :param class_file: The path to an FDA classification file.
+    :ptype class_file: str
+    :param workers: The number of processes used by the stream stage.
+    :ptype workers: int
+    :param backend: The xml backend used by BACKEND_STAGES.
+    :ptype backend: str
+    :return: The stage's elapsed seconds, record count and peak rss.
+    :rtype: dict
+    """
+    class_parser = FDAClassificationParser()
+    class_parser.parse(class_file)
+    records = 0
+    if stage == 'iterparse':
+        start = time.time()
+        for _, element in ElementTree.iterparse(xml_file):
+            if XMLDocParser._normalize_tag(element.tag) == SEARCH_TAG:
+                records += 1
+                element.clear()
+        elapsed = time.time() - start
+    elif stage == 'tree_to_dict':
+        # Only count time spent converting elements, not parsing them
+        elapsed = 0
+        for element in XMLDocParser()._iter_elements(xml_file, SEARCH_TAG):
+            start = time.time()
+            XMLDocParser._tree_to_dict(element)
+            elapsed += time.time() - start
+            records += 1
+    elif stage == 'records':
+        # Building each record's dict without classification, the part backends differ in
+        start = time.time()
+        for _ in XMLDocParser(backend=backend).iter_parse(xml_file, SEARCH_TAG):
+            records += 1
+        elapsed = time.time() - start
+    elif stage == 'rec_inject':
+        xml_parser = XMLDocParser()
+        xml_parser.parse(xml_file, search_tag=SEARCH_TAG)
+        records = len(xml_parser.dict['data'][SEARCH_TAG])
+        start = time.time()
+        class_parser.rec_inject(xml_parser.dict)
+        elapsed = time.time() - start
+    elif stage == 'iter_parse':
+        xml_parser = XMLDocParser(class_parser, backend=backend)
+        start = time.time()
+        xml_parser.parse(xml_file, search_tag=SEARCH_TAG)
+        elapsed = time.time() - start
+        records = len(xml_parser.dict['data'][SEARCH_TAG])
+    elif stage == 'std_parse':
+        xml_parser = XMLDocParser(class_parser, backend=backend)
+        start = time.time()
+        xml_parser.parse(xml_file)
+        elapsed = time.time() - start
+        records = len(xml_parser.dict['gudid'][SEARCH_TAG])
+    elif stage == 'stream':
+        handle, json_file = tempfile.mkstemp(suffix='.ndjson')
+        os.close(handle)
+        xml_parser = XMLDocParser(class_parser, backend=backend)
+        start = time.time()
+        records = xml_parser.stream_to_file(xml_file, json_file, SEARCH_TAG, workers)
+        elapsed = time.time() - start
+        os.remove(json_file)
+    else:
+        raise ValueError("Unknown stage %s" % stage)
+    return {
+        'seconds': elapsed,
+        'records': records,
+        'records_per_sec': records / elapsed if elapsed else None,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+def run(sizes, stages, data_dir, class_file, workers=1, backends=('etree',)):
+    """
+    Generate any missing inputs and run each stage on each input in a fresh process, so peak rss
+    is measured per stage.
+
+    :param sizes: Keys of SIZES to benchmark.
+    :ptype sizes: list
+    :param stages: Stages to benchmark.
+    :ptype stages: list
+    :param data_dir: Where synthetic inputs are kept between runs.
+    :ptype data_dir: str
+    :param class_file: The path to an FDA classification file.
+    :ptype class_file: str
+    :param workers: The number of processes used by the stream stage.
+    :ptype workers: int
+    :param backends: The xml backends to run BACKEND_STAGES with. Results of backends other than
+        etree are keyed as stage:backend.
+    :ptype backends: list
+    :return: Results keyed by size and stage.
+    :rtype: dict
+    """
+    product_codes = load_product_codes(class_file)
+    results = {}
+    for size in sizes:
+        xml_file = os.path.join(data_dir, 'synthetic_udi_%s.xml' % size)
+        if not os.path.exists(xml_file):
+            generate(xml_file, SIZES[size], product_codes)
+        results[size] = {}
+        for stage in stages:
+            for backend in (backends if stage in BACKEND_STAGES else ['etree']):
+                output = subprocess.check_output([
+                    sys.executable, os.path.abspath(__file__), '--run_stage', stage, '--xml', xml_file,
+                    '--classification', class_file, '--workers', str(workers), '--backends', backend
+                ])
+                key = stage if backend == 'etree' else '%s:%s' % (stage, backend)
+                results[size][key] = json.loads(output)
+                print_result(size, key, results[size][key])
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results to a baseline run. A stage regresses when it took more than threshold longer.
+
+    :param results: The current results.
+    :ptype results: dict
+    :param baseline: The baseline results.
+    :ptype baseline: dict
+    :param threshold: The allowed relative slowdown, e.g. 0.1 for 10%.
+    :ptype threshold: float
+    :return: The (size, stage, ratio) of each regression.
+    :rtype: list
+    """
+    regressions = []
+    for size, stages in sorted(results.iteritems()):
+        for stage, result in sorted(stages.iteritems()):
+            base = baseline.get(size, {}).get(stage)
+            if not base or not base['seconds']:
+                continue
+            ratio = result['seconds'] / base['seconds']
+            print('%-6s %-18s %6.2fx time %6.2fx rss' % (
+                size, stage, ratio, float(result['peak_rss_kb']) / base['peak_rss_kb']
+            ))
+            if ratio > 1 + threshold:
+                regressions.append((size, stage, ratio))
+    return regressions
+
+
+def print_result(size, stage, result):
+    """
+    Print one stage's result as a table row.
+    """
+    print('%-6s %-18s %9.2fs %9d records %11.0f records/s %9d KB peak rss' % (
+        size, stage, result['seconds'], result['records'], result['records_per_sec'] or 0,
+        result['peak_rss_kb']
+    ))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Benchmark the xml to json pipeline.')
+    arg_parser.add_argument(
+        '--sizes',
+        help='Comma separated synthetic input sizes. Any of %s.' % ', '.join(sorted(SIZES)),
+        default='10MB'
+    )
+    arg_parser.add_argument(
+        '--stages',
+        help='Comma separated stages to run. Any of %s.' % ', '.join(STAGES),
+        default=','.join(STAGES)
+    )
+    arg_parser.add_argument(
+        '--data_dir',
+        help='Where synthetic inputs are generated and reused.',
+        default=tempfile.gettempdir()
+    )
+    arg_parser.add_argument(
+        '--classification',
+        help='Expects the path to an FDA classification file.',
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'foiclass.txt')
+    )
+    arg_parser.add_argument('--workers', help='Processes used by the stream stage.', type=int, default=1)
+    arg_parser.add_argument(
+        '--backends',
+        help='Comma separated xml backends to run the %s stages with. Any of %s.' % (
+            ', '.join(BACKEND_STAGES), ', '.join(sorted(BACKENDS))
+        ),
+        default='etree'
+    )
+    arg_parser.add_argument('--output', help='Write the results as json to this path.')
+    arg_parser.add_argument('--compare', help='Expects the path of a previous --output to compare to.')
+    arg_parser.add_argument(
+        '--threshold',
+        help='Allowed relative slowdown before a stage counts as a regression.',
+        type=float,
+        default=0.1
+    )
+    arg_parser.add_argument('--run_stage', help=argparse.SUPPRESS)
+    arg_parser.add_argument('--xml', help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+    # Child process running a single stage
+    if args.run_stage:
+        print(json.dumps(run_stage(
+            args.run_stage, args.xml, args.classification, args.workers, args.backends
+        )))
+        sys.exit(0)
+    sizes = args.sizes.split(',')
+    stages = args.stages.split(',')
+    for size in sizes:
+        if size not in SIZES:
+            arg_parser.error('Unknown size %s' % size)
+    for stage in stages:
+        if stage not in STAGES:
+            arg_parser.error('Unknown stage %s' % stage)
+    backends = args.backends.split(',')
+    for backend in backends:
+        if backend not in BACKENDS:
+            arg_parser.error('Unknown backend %s' % backend)
+    results = run(sizes, stages, args.data_dir, args.classification, args.workers, backends)
+    if args.output:
+        with open(args.output, 'w') as json_out:
+            json.dump(results, json_out, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as json_in:
+            baseline = json.load(json_in)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            for size, stage, ratio in regressions:
+                print('REGRESSION %s %s %.2fx slower' % (size, stage, ratio))
+            sys.exit(1)
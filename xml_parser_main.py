@@ -1,37 +1,139 @@
 #!/usr/bin/env python
 import argparse
+import sys
 from doc_parser import XMLDocParser
 from foi import FDAClassificationParser
+from parser_stats import ParserStats
+from record_filter import RecordFilter
+from xml_backends import BACKENDS
+from xml_batch import BatchConverter, expand_inputs, is_batch
 
 
 __author__ = "Jonathan Sage"
 __email__ = "jsage8@gmail.com"
 
 
-def main(xml_file, json_file, class_file, index_field, search, tag):
+class UsageError(ValueError):
+    """
+    Raised by main for arguments that can only be found to be wrong once the input is looked at,
+    so the CLI can report them like any other bad argument.
+    """
+
+
+def main(xml_file, json_file, class_file, index_field, search, tag, ndjson=False, workers=1,
+         class_cache=None, compact=False, stats=None, merge=False, manifest=None, id_tag=None,
+         fields=None, where=None, backend='etree', checkpoint=None, csv=False, repeated=(), index=False,
+         compact_records=False, shard_records=None, shard_bytes=None):
+    xml_files = expand_inputs(xml_file) if is_batch(xml_file) else None
+    if xml_files == []:
+        raise UsageError("No input files match %s" % xml_file)
     if class_file is not None:
-        class_parser = FDAClassificationParser(index_field)
-        class_parser.parse(class_file)
+        class_parser = FDAClassificationParser(index_field, stats=stats)
+        class_parser.parse(class_file, cache_file=class_cache)
     else:
         class_parser = None
     if not search:
         tag = None
-    xml_parser = XMLDocParser(class_parser)
-    xml_parser.parse(xml_file, search_tag=tag)
-    xml_parser.inject_project_code()
-    json_out = xml_parser.json
-    xml_parser.to_json_file(json_file, pretty=True)
+    record_filter = None
+    if fields or where:
+        record_filter = RecordFilter(XMLDocParser._normalize_tag, fields, where)
+    xml_parser = XMLDocParser(
+        class_parser, stats=stats, record_filter=record_filter, backend=backend,
+        compact_records=compact_records
+    )
+    if tag == 'auto':
+        sample_file = xml_files[0] if xml_files else xml_file
+        tag = xml_parser.detect_record_tag(sample_file)
+        if tag is not None:
+            sys.stderr.write('Detected record tag %s\n' % tag)
+        # Only a plain json conversion can do without a tag
+        elif is_batch(xml_file) or manifest or checkpoint or ndjson or csv or shard_records or \
+                shard_bytes or workers > 1:
+            raise UsageError("No repeating record tag found in %s. Try passing --tag" % sample_file)
+    if isinstance(tag, list):
+        if ndjson:
+            counts = xml_parser.stream_tags_to_files(xml_file, json_file, tag, compress=compact)
+            sys.stderr.write(', '.join('%d %s' % (counts[name], name) for name in tag) + '\n')
+        else:
+            xml_parser.parse(xml_file, search_tag=tag)
+            xml_parser.to_json_file(json_file, pretty=not compact)
+    elif is_batch(xml_file):
+        # One file per worker process, each streamed to ndjson
+        summaries = BatchConverter(xml_parser, tag, workers).convert(xml_files, json_file, merge)
+        sys.stderr.write(BatchConverter.format_summary(summaries) + '\n')
+    elif manifest is not None:
+        counts = xml_parser.stream_changes_to_file(xml_file, json_file, tag, id_tag, manifest)
+        sys.stderr.write(
+            '%(added)d added, %(changed)d changed, %(deleted)d deleted, %(unchanged)d unchanged\n'
+            % counts
+        )
+    elif csv:
+        xml_parser.stream_to_tables(
+            xml_file, json_file, tag, workers, compress=compact, repeated=repeated
+        )
+    elif shard_records or shard_bytes:
+        shards = xml_parser.stream_to_shards(
+            xml_file, json_file, tag, workers, shard_records, shard_bytes, compress=compact
+        )
+        sys.stderr.write('Wrote %d shards\n' % len(shards))
+    elif checkpoint is not None:
+        xml_parser.checkpointed_stream_to_file(xml_file, json_file, tag, checkpoint, workers)
+    elif ndjson:
+        xml_parser.stream_to_file(xml_file, json_file, tag, workers, id_tag=id_tag if index else None)
+    else:
+        xml_parser.parse(xml_file, search_tag=tag, workers=workers)
+        xml_parser.to_json_file(json_file, pretty=not compact)
+    if stats is not None:
+        stats.emit()
+
+
+def write_stats(stats_file):
+    """
+    Build a stats hook that writes the stats as json to a file, or to stdout for '-'.
+
+    :param stats_file: The path to write to.
+    :ptype stats_file: str
+    :rtype: callable
+    """
+    def hook(stats_dict):
+        stats_json = ParserStats.dict_to_json(stats_dict)
+        if stats_file == '-':
+            sys.stdout.write(stats_json + '\n')
+        else:
+            with open(stats_file, 'w') as stats_out:
+                stats_out.write(stats_json + '\n')
+    return hook
+
 
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser(description='CLI argument parser.')
-    arg_parser.add_argument('--xml', help='Expects the path to an xml file.', required=True)
-    arg_parser.add_argument('--json', help='Expects the path to an output json file.', required=True)
+    arg_parser.add_argument(
+        '--xml',
+        help='Expects the path to an xml file, or a directory or glob of xml files to batch convert. '
+             'Files ending in .gz or .zip are decompressed while they are parsed, and every .xml '
+             'member of a zip archive is converted.',
+        required=True
+    )
+    arg_parser.add_argument(
+        '--json',
+        help='Expects the path to an output json file, or an output directory when batch converting.',
+        required=True
+    )
+    arg_parser.add_argument(
+        '--merge',
+        help='When batch converting, write all records to the single --json file in input order.',
+        action='store_true'
+    )
     arg_parser.add_argument('--classification', help='Expects the path to an FDA classification file.')
     arg_parser.add_argument(
         '--class_field',
         help='Expects the classification field used to index each classification line.',
         default="PRODUCTCODE"
     )
+    arg_parser.add_argument(
+        '--class_cache',
+        help='Expects the path of a compiled classification index. Reused while it is up to date.'
+    )
     arg_parser.add_argument(
         '--no_search',
         help='Assume nothing about the xml data structure. Increases memory usage.',
@@ -39,14 +141,188 @@ if __name__ == '__main__':
     )
     arg_parser.add_argument(
         '--tag',
-        help='If --search use this arg to provide the tag to search by. Defaults to device.',
+        help='If --search use this arg to provide the tag to search by. Defaults to device. Use auto '
+             'to detect the repeating record tag and stream by it, falling back to parsing the '
+             'whole document if nothing repeats. Comma separated tags, e.g. header,device, are '
+             'extracted in a single pass, each to its own key of the json, or with --ndjson to '
+             '<tag>.ndjson in the --json directory.',
         default="device"
     )
+    arg_parser.add_argument(
+        '--ndjson', '--stream',
+        help='Stream each tag match to the output as newline delimited json. Keeps memory flat.',
+        dest='ndjson',
+        action='store_true'
+    )
+    arg_parser.add_argument(
+        '--manifest',
+        help='Expects the path of a manifest of record hashes from the previous run. Only records '
+             'added, changed or deleted since then are written, as newline delimited json, and '
+             'the manifest is updated.'
+    )
+    arg_parser.add_argument(
+        '--id_tag',
+        help='If --manifest or --index use this arg to provide the tag that identifies each record.',
+        default='public_device_record_key'
+    )
+    arg_parser.add_argument(
+        '--checkpoint',
+        help='Expects the path of a checkpoint file. Stream newline delimited json, committing '
+             'progress to the checkpoint, and resume from it if a previous run died.'
+    )
+    arg_parser.add_argument(
+        '--index',
+        help='With --ndjson, also write a sidecar index of each record\'s offset to <json>.idx, '
+             'keyed by --id_tag, for looking up single records with record_index.RecordReader.',
+        action='store_true'
+    )
+    arg_parser.add_argument(
+        '--shard_records',
+        help='Stream newline delimited json to the --json path as a directory of shards, starting '
+             'a new shard after this many records, with a manifest.json listing the shards. '
+             'Combine with --compact to gzip them.',
+        type=int
+    )
+    arg_parser.add_argument(
+        '--shard_bytes',
+        help='Like --shard_records, starting a new shard once a shard holds this many bytes before '
+             'compression. May be combined with --shard_records.',
+        type=int
+    )
+    arg_parser.add_argument(
+        '--fields',
+        help='Comma separated dotted paths of the fields to keep from each record, e.g. '
+             'brand_name,product_codes. Everything else is dropped before conversion.'
+    )
+    arg_parser.add_argument(
+        '--where',
+        help='Only keep records with a value among the given ones at a dotted path, e.g. '
+             'product_codes.fda_product_code.product_code=JEY,LLZ. May be repeated.',
+        action='append',
+        default=[]
+    )
+    arg_parser.add_argument(
+        '--backend',
+        help='The xml backend. etree and lxml build elements, expat builds dicts directly and is '
+             'the fastest but does not support --fields or --where.',
+        choices=sorted(BACKENDS),
+        default='etree'
+    )
+    arg_parser.add_argument(
+        '--csv',
+        help='Write flattened csv tables, one per repeated element, to the --json path as a '
+             'directory. Combine with --compact to gzip them.',
+        action='store_true'
+    )
+    arg_parser.add_argument(
+        '--repeated',
+        help='With --csv, comma separated dotted paths to always write as their own table, e.g. '
+             'identifiers.identifier.'
+    )
+    arg_parser.add_argument(
+        '--compact',
+        help='Write json without indentation. Output paths ending in .gz are gzip compressed.',
+        action='store_true'
+    )
+    arg_parser.add_argument(
+        '--compact_records',
+        help='Keep records in memory in a compact read-only form while converting to a single json '
+             'document. Uses much less memory for large files.',
+        action='store_true'
+    )
+    arg_parser.add_argument(
+        '--stats', '--profile',
+        help='Write per stage timings and counters as json to this path, or - for stdout.',
+        dest='stats'
+    )
+    arg_parser.add_argument(
+        '--workers',
+        help='The number of processes used to convert elements, or files when batch converting. '
+             'Requires a search tag.',
+        type=int,
+        default=1
+    )
     args = arg_parser.parse_args()
+    if args.ndjson and args.no_search:
+        arg_parser.error('--ndjson requires a search tag and cannot be combined with --no_search')
+    if args.workers < 1:
+        arg_parser.error('--workers must be at least 1')
+    if args.workers > 1 and args.no_search:
+        arg_parser.error('--workers requires a search tag and cannot be combined with --no_search')
+    if (args.fields or args.where) and args.no_search:
+        arg_parser.error('--fields and --where require a search tag and cannot be combined with --no_search')
+    if (args.fields or args.where) and args.backend == 'expat':
+        arg_parser.error('--fields and --where cannot be combined with --backend expat')
+    try:
+        where = RecordFilter.parse_where(args.where)
+    except ValueError as error:
+        arg_parser.error(str(error))
+    if args.csv and args.no_search:
+        arg_parser.error('--csv requires a search tag and cannot be combined with --no_search')
+    if args.csv and (args.ndjson or args.manifest or args.checkpoint or is_batch(args.xml)):
+        arg_parser.error('--csv cannot be combined with --ndjson, --manifest, --checkpoint or batch conversion')
+    if args.checkpoint and args.no_search:
+        arg_parser.error('--checkpoint requires a search tag and cannot be combined with --no_search')
+    if args.checkpoint and (args.manifest or is_batch(args.xml)):
+        arg_parser.error('--checkpoint converts a single file and cannot be combined with --manifest')
+    if args.manifest and args.no_search:
+        arg_parser.error('--manifest requires a search tag and cannot be combined with --no_search')
+    if args.manifest and (args.workers > 1 or is_batch(args.xml)):
+        arg_parser.error('--manifest converts a single file and cannot be combined with --workers')
+    if args.index and (not args.ndjson or args.manifest or args.checkpoint or args.csv or is_batch(args.xml)):
+        arg_parser.error('--index requires --ndjson and cannot be combined with --manifest, --checkpoint, --csv or batch conversion')
+    if args.index and args.json.endswith('.gz'):
+        arg_parser.error('--index requires an uncompressed output')
+    if (args.shard_records is not None and args.shard_records < 1) or \
+            (args.shard_bytes is not None and args.shard_bytes < 1):
+        arg_parser.error('--shard_records and --shard_bytes must be at least 1')
+    sharded = args.shard_records or args.shard_bytes
+    if sharded and args.no_search:
+        arg_parser.error('Sharded output requires a search tag and cannot be combined with --no_search')
+    if sharded and (args.manifest or args.checkpoint or args.csv or args.index or is_batch(args.xml)):
+        arg_parser.error('Sharded output cannot be combined with --manifest, --checkpoint, --csv, --index or batch conversion')
+    # Each tag once, in the order given
+    if args.compact_records and (args.ndjson or args.manifest or args.checkpoint or args.csv or sharded or
+                                 is_batch(args.xml)):
+        arg_parser.error('--compact_records only applies to a single json document and cannot be combined '
+                         'with --ndjson, --manifest, --checkpoint, --csv, sharded output or batch conversion')
+    tags = sorted(set(args.tag.split(',')), key=args.tag.split(',').index)
+    if len(tags) > 1 and ('auto' in tags or args.workers > 1 or args.manifest or args.checkpoint or
+                          args.csv or args.index or sharded or args.fields or args.where or
+                          is_batch(args.xml)):
+        arg_parser.error('Several --tag values cannot be combined with auto, --workers, --manifest, '
+                         '--checkpoint, --csv, --index, --fields, --where, sharded output or batch '
+                         'conversion')
+    if is_batch(args.xml) and args.no_search:
+        arg_parser.error('Batch conversion requires a search tag and cannot be combined with --no_search')
     xml_file = args.xml
     json_file = args.json
     class_file = args.classification
     index_field = args.class_field
     search = not args.no_search
-    tag = args.tag
-    main(xml_file, json_file, class_file, index_field, search, tag)
+    tag = tags if len(tags) > 1 else tags[0]
+    ndjson = args.ndjson
+    workers = args.workers
+    class_cache = args.class_cache
+    compact = args.compact
+    stats = ParserStats(hook=write_stats(args.stats)) if args.stats else None
+    merge = args.merge
+    manifest = args.manifest
+    id_tag = args.id_tag
+    fields = args.fields.split(',') if args.fields else None
+    backend = args.backend
+    checkpoint = args.checkpoint
+    csv = args.csv
+    repeated = args.repeated.split(',') if args.repeated else ()
+    index = args.index
+    compact_records = args.compact_records
+    shard_records = args.shard_records
+    shard_bytes = args.shard_bytes
+    try:
+        main(
+            xml_file, json_file, class_file, index_field, search, tag, ndjson, workers, class_cache,
+            compact, stats, merge, manifest, id_tag, fields, where, backend, checkpoint, csv,
+            repeated, index, compact_records, shard_records, shard_bytes
+        )
+    except UsageError as error:
+        arg_parser.error(str(error))
@@ -1,13 +1,28 @@
 import unittest
 import argparse
+import csv
+import gzip
 import tempfile
 import json
 import os
+import shutil
+import sys
+import zipfile
 from mock import MagicMock, PropertyMock, patch
+from xml.etree import ElementTree
 from xml.etree.ElementTree import Element, SubElement, tostring
 
-from doc_parser import XMLDocParser
+from compact import CompactRecord, RecordCompactor
+from doc_parser import XMLDocParser, TagCache
 from foi import FDAClassificationParser
+from parser_stats import ParserStats
+from record_filter import RecordFilter
+from record_index import RecordIndexWriter, RecordReader
+from writers import atomic_write
+from xml_backends import lxml_etree
+from xml_batch import BatchConverter, expand_inputs, is_batch
+from xml_parser_main import UsageError, main
+from xml_splitter import XMLRecordSplitter
 
 
 __author__ = "Jonathan Sage"
@@ -110,6 +125,26 @@ class TestXMLParser(unittest.TestCase):
         """
         self.assertEqual(XMLDocParser._camel_to_snake("TestTest"), "test_test")
 
+    def test_normalize_tag_cache(self):
+        """
+        Repeated tags should be served from the shared cache and the counters should say so.
+        """
+        XMLDocParser._tag_cache.clear()
+        self.assertEqual(XMLDocParser._normalize_tag("{urn:gudid}fdaProductCode"), "fda_product_code")
+        self.assertEqual(XMLDocParser._normalize_tag("{urn:gudid}fdaProductCode"), "fda_product_code")
+        info = XMLDocParser.tag_cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['size']), (1, 1, 1))
+
+    def test_tag_cache_bounded(self):
+        """
+        The cache should never grow past its maximum size.
+        """
+        cache = TagCache(maxsize=2)
+        for tag in ("a", "b", "c", "d"):
+            self.assertEqual(cache.get(tag, str.upper), tag.upper())
+        self.assertTrue(cache.info()['size'] <= 2)
+        self.assertEqual(cache.info()['misses'], 4)
+
     def test_dict_to_json_file(self):
         """
         Make sure the dict is correctly written to file as json.
@@ -121,6 +156,33 @@ class TestXMLParser(unittest.TestCase):
             result = json_out.read()
         self.assertEqual(result, expected)
 
+    def test_to_json_file_compact(self):
+        """
+        The incrementally encoded compact json should match json.dumps exactly.
+        """
+        expected = json.dumps(self.dict_obj)
+        temp_path = tempfile.mkstemp()[1]
+        xml_parser = XMLDocParser()
+        xml_parser._dict = self.dict_obj
+        xml_parser.to_json_file(temp_path)
+        with open(temp_path, 'r') as json_out:
+            result = json_out.read()
+        os.remove(temp_path)
+        self.assertEqual(result, expected)
+
+    def test_to_json_file_gzip(self):
+        """
+        Paths ending in .gz should be written gzip compressed.
+        """
+        temp_path = tempfile.mkstemp(suffix='.gz')[1]
+        xml_parser = XMLDocParser()
+        xml_parser._dict = self.dict_obj
+        xml_parser.to_json_file(temp_path, pretty=True)
+        with gzip.open(temp_path, 'rb') as json_out:
+            result = json.load(json_out)
+        os.remove(temp_path)
+        self.assertEqual(result, self.dict_obj)
+
     def test_tree_to_dict(self):
         """
         Create an XML document and parse it with tree_to_dict. The output should match our expected
@@ -142,6 +204,64 @@ class TestXMLParser(unittest.TestCase):
         os.remove(temp_path)
         self.assertEqual(xml_parser.dict, expected)
 
+    def test_parse_compact_records(self):
+        """
+        Compact records should read, compare and encode to json like the dicts they replace, with
+        shared values staying shared.
+        """
+        temp_path = tempfile.mkstemp()[1]
+        with open(temp_path, 'w') as xml_out:
+            xml_out.write(tostring(self.root))
+        xml_parser = XMLDocParser(compact_records=True)
+        xml_parser.parse(temp_path, search_tag='country')
+        countries = xml_parser.dict['data']['country']
+        self.assertEqual(xml_parser.dict, self.dict_obj)
+        self.assertEqual(json.loads(xml_parser.json), self.dict_obj)
+        self.assertTrue(isinstance(countries[0], CompactRecord))
+        self.assertEqual(countries[1]['neighbor']['attribs'].get('name'), 'Malaysia')
+        self.assertEqual(countries[1].get('missing', 'default'), 'default')
+        self.assertEqual(sorted(countries[0]), ['attribs', 'gdppc', 'neighbor', 'rank_number', 'year'])
+        self.assertTrue('year' in countries[0] and len(countries[0]) == 5)
+        self.assertEqual(countries[0].to_dict(), self.dict_obj['data']['country'][0])
+        self.assertEqual(type(countries[0].to_dict()['neighbor'][0]), dict)
+        xml_parser.to_json_file(temp_path)
+        with open(temp_path, 'r') as json_in:
+            self.assertEqual(json_in.read(), json.dumps(self.dict_obj))
+        os.remove(temp_path)
+        # Same keys share a layout, and shared values and repeated strings stay shared
+        openfda = [{'productcode': 'JEY'}]
+        records = RecordCompactor().compact([
+            {'product_code': 'JEY', 'openfda': openfda}, {'product_code': ''.join(['J', 'EY']), 'openfda': openfda}
+        ])
+        self.assertTrue(records[0]._layout is records[1]._layout)
+        self.assertTrue(records[0]['openfda'] is records[1]['openfda'])
+        self.assertTrue(records[0]['product_code'] is records[1]['product_code'])
+        self.assertRaises(TypeError, hash, records[0])
+
+    def test_parse_detect_record_tag(self):
+        """
+        Parsing with an auto search tag should detect the repeating element and stream by it, or
+        parse the whole document if nothing repeats.
+        """
+        temp_path = tempfile.mkstemp()[1]
+        with open(temp_path, 'w') as xml_out:
+            xml_out.write(tostring(self.root))
+        xml_parser = XMLDocParser()
+        self.assertEqual(xml_parser.detect_record_tag(temp_path), 'country')
+        xml_parser.parse(temp_path, search_tag='auto')
+        self.assertEqual(xml_parser.dict, self.dict_obj)
+        # Records one level further down
+        with open(temp_path, 'w') as xml_out:
+            xml_out.write('<data><header/><items><item>1</item><item>2</item></items></data>')
+        self.assertEqual(XMLDocParser().detect_record_tag(temp_path), 'item')
+        with open(temp_path, 'w') as xml_out:
+            xml_out.write('<data><a>1</a><b>2</b></data>')
+        xml_parser = XMLDocParser()
+        self.assertEqual(xml_parser.detect_record_tag(temp_path), None)
+        xml_parser.parse(temp_path, search_tag='auto')
+        os.remove(temp_path)
+        self.assertEqual(xml_parser.dict, {'data': {'a': '1', 'b': '2'}})
+
     def test_parse_standard(self):
         """
         Test parsing without apriori knowledge of the xml structure.
@@ -155,6 +275,485 @@ class TestXMLParser(unittest.TestCase):
         os.remove(temp_path)
         self.assertEqual(xml_parser.dict, expected)
 
+    def test_iter_parse(self):
+        """
+        Test lazily parsing records with apriori knowledge of the xml structure. Nothing should be
+        stored in the dict property.
+        """
+        expected = self.dict_obj['data']['country']
+        temp_path = tempfile.mkstemp()[1]
+        with open(temp_path, 'w') as xml_out:
+            xml_out.write(tostring(self.root))
+        xml_parser = XMLDocParser()
+        result = list(xml_parser.iter_parse(temp_path, "country"))
+        os.remove(temp_path)
+        self.assertEqual(result, expected)
+        self.assertEqual(xml_parser._dict, {})
+
+    def test_stream_to_file(self):
+        """
+        Make sure each record is written to file as one line of json.
+        """
+        expected = self.dict_obj['data']['country']
+        xml_path = tempfile.mkstemp()[1]
+        json_path = tempfile.mkstemp()[1]
+        with open(xml_path, 'w') as xml_out:
+            xml_out.write(tostring(self.root))
+        xml_parser = XMLDocParser()
+        count = xml_parser.stream_to_file(xml_path, json_path, "country")
+        with open(json_path, 'r') as json_in:
+            result = [json.loads(line) for line in json_in]
+        os.remove(xml_path)
+        os.remove(json_path)
+        self.assertEqual(count, 2)
+        self.assertEqual(result, expected)
+
+    def test_iter_parse_workers(self):
+        """
+        Parsing with a pool of workers should yield the same records in the same order.
+        """
+        expected = self.dict_obj['data']['country']
+        temp_path = tempfile.mkstemp()[1]
+        with open(temp_path, 'w') as xml_out:
+            xml_out.write(tostring(self.root))
+        xml_parser = XMLDocParser()
+        xml_parser.parallel_batch_size = 1
+        result = list(xml_parser.iter_parse(temp_path, "country", workers=2))
+        os.remove(temp_path)
+        self.assertEqual(result, expected)
+
+    def test_stream_to_file_workers(self):
+        """
+        Make sure records encoded by the workers are written to file in input order.
+        """
+        expected = self.dict_obj['data']['country']
+        xml_path = tempfile.mkstemp()[1]
+        json_path = tempfile.mkstemp()[1]
+        with open(xml_path, 'w') as xml_out:
+            xml_out.write(tostring(self.root))
+        xml_parser = XMLDocParser()
+        xml_parser.parallel_batch_size = 1
+        count = xml_parser.stream_to_file(xml_path, json_path, "country", workers=2)
+        with open(json_path, 'r') as json_in:
+            result = [json.loads(line) for line in json_in]
+        os.remove(xml_path)
+        os.remove(json_path)
+        self.assertEqual(count, 2)
+        self.assertEqual(result, expected)
+
+    def test_stream_to_file_stats(self):
+        """
+        Stats should count elements, records, lookups and bytes and time each stage.
+        """
+        xml_path = tempfile.mkstemp()[1]
+        json_path = tempfile.mkstemp()[1]
+        root = Element('data')
+        for code in ('JEY', 'NOT A CODE'):
+            device = SubElement(root, 'device')
+            product = SubElement(SubElement(device, 'productCodes'), 'fdaProductCode')
+            SubElement(product, 'productCode').text = code
+        with open(xml_path, 'w') as xml_out:
+            xml_out.write(tostring(root))
+        hook = MagicMock()
+        stats = ParserStats(hook=hook)
+        class_parser = FDAClassificationParser(stats=stats)
+        class_parser.parse('foiclass.txt')
+        xml_parser = XMLDocParser(class_parser, stats=stats)
+        xml_parser.stream_to_file(xml_path, json_path, "device")
+        stats.emit()
+        size = os.path.getsize(json_path)
+        os.remove(xml_path)
+        os.remove(json_path)
+        stats_dict = hook.call_args[0][0]
+        self.assertEqual(stats_dict['counters'], {
+            'elements': 9,
+            'records': 2,
+            'classification_lookups': 2,
+            'classification_misses': 1,
+            'bytes_written': size
+        })
+        for stage in ('classification', 'parse', 'tree_to_dict', 'inject', 'write'):
+            self.assertTrue(stage in stats_dict['stages'])
+        self.assertEqual(json.loads(stats.to_json())['counters'], stats_dict['counters'])
+
+    def test_backends(self):
+        """
+        Every backend should produce the same records, with and without a search tag, including
+        namespaces, attributes, comments and mixed text.
+        """
+        document = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<g:data xmlns:g="urn:g" xmlns:x="urn:x"><!-- comment -->'
+            '<g:country name="Liechtenstein"> text <g:year>2008</g:year><g:gdppc x:unit="chf">141100</g:gdppc>'
+            '<g:neighbor name="Austria" direction="E" unit="km" value="1"/><g:neighbor name="Switzerland"/>'
+            '<g:size value="406" unit="mm" type="h"><g:x/></g:size><g:empty/><g:blank> </g:blank></g:country>'
+            '<g:country name="Singapore"><g:year>2011 &amp; on</g:year><!-- c --><g:rankNumber>4</g:rankNumber></g:country>'
+            '<g:country/></g:data>'
+        )
+        temp_path = tempfile.mkstemp()[1]
+        with open(temp_path, 'w') as xml_out:
+            xml_out.write(document)
+        # lxml is optional
+        backends = ['etree', 'expat'] + (['lxml'] if lxml_etree is not None else [])
+        expected = XMLDocParser._tree_to_dict(ElementTree.fromstring(document))
+        for backend in backends:
+            xml_parser = XMLDocParser(backend=backend)
+            records = list(xml_parser.iter_parse(temp_path, 'country'))
+            self.assertEqual(records, expected['data']['country'])
+            # Attributes should be encoded in the same order by every backend too
+            self.assertEqual(json.dumps(records), json.dumps(expected['data']['country']))
+            xml_parser.parse(temp_path)
+            self.assertEqual(xml_parser.dict, expected)
+        os.remove(temp_path)
+        self.assertRaises(ValueError, XMLDocParser, backend='sax')
+        xml_parser = XMLDocParser(record_filter=RecordFilter(XMLDocParser._normalize_tag), backend='expat')
+        self.assertRaises(ValueError, list, xml_parser.iter_parse(temp_path, 'country'))
+
+    def test_pipeline(self):
+        """
+        A pipeline should hand over the same records as iter_parse, stop early when closed and
+        re-raise parse errors in the consumer.
+        """
+        expected = self.dict_obj['data']['country']
+        temp_path = tempfile.mkstemp()[1]
+        with open(temp_path, 'w') as xml_out:
+            xml_out.write(tostring(self.root))
+        xml_parser = XMLDocParser(stats=ParserStats())
+        with xml_parser.pipeline(temp_path, 'country', maxsize=1, batch_size=1) as pipeline:
+            result = list(pipeline)
+        self.assertEqual(result, expected)
+        self.assertTrue('backpressure' in xml_parser.stats.seconds)
+        pipeline = xml_parser.pipeline(temp_path, 'country', maxsize=1, batch_size=1)
+        self.assertEqual(pipeline.get_batch(), expected[:1])
+        pipeline.close()
+        self.assertEqual(pipeline.get_batch(), [])
+        os.remove(temp_path)
+        with xml_parser.pipeline(temp_path, 'country') as pipeline:
+            self.assertRaises(IOError, pipeline.get_batch)
+
+    def test_iter_parse_record_filter(self):
+        """
+        Records failing a predicate should be skipped and the rest projected to the given fields,
+        with and without workers.
+        """
+        root = Element('gudid')
+        for brand, code in (('A', 'JEY'), ('B', 'LLZ'), ('C', 'JEY')):
+            device = SubElement(root, 'device')
+            SubElement(device, 'brandName').text = brand
+            SubElement(device, 'catalogNumber').text = brand.lower()
+            product_codes = SubElement(device, 'productCodes')
+            product = SubElement(product_codes, 'fdaProductCode')
+            SubElement(product, 'productCode').text = code
+            SubElement(product, 'productCodeName').text = 'name'
+        temp_path = tempfile.mkstemp()[1]
+        with open(temp_path, 'w') as xml_out:
+            xml_out.write(tostring(root))
+        record_filter = RecordFilter(
+            XMLDocParser._normalize_tag,
+            fields=['brand_name', 'product_codes.fda_product_code.product_code'],
+            where={'product_codes.fda_product_code.product_code': ['JEY']}
+        )
+        xml_parser = XMLDocParser(record_filter=record_filter)
+        xml_parser.parallel_batch_size = 1
+        xml_parser.parallel_range_size = 1
+        result = list(xml_parser.iter_parse(temp_path, 'device'))
+        # Small blocks, so the workers get a range per record or so
+        with patch.object(XMLRecordSplitter, 'block_size', 64):
+            parallel_result = list(xml_parser.iter_parse(temp_path, 'device', workers=2))
+        os.remove(temp_path)
+        expected = [
+            {'brand_name': brand, 'product_codes': {'fda_product_code': {'product_code': 'JEY'}}}
+            for brand in ('A', 'C')
+        ]
+        self.assertEqual(result, expected)
+        self.assertEqual(parallel_result, expected)
+        self.assertEqual(
+            RecordFilter.parse_where(['a.b=1,2', 'a.b=3']), {'a.b': set(['1', '2', '3'])}
+        )
+
+    def test_stream_to_tables(self):
+        """
+        Records should be flattened into a table of their own and a linked table per repeated
+        element, a repeated element that occurs once included.
+        """
+        temp_dir = tempfile.mkdtemp()
+        xml_path = os.path.join(temp_dir, 'devices.xml')
+        with open(xml_path, 'w') as xml_out:
+            xml_out.write(
+                '<gudid><device><brandName>A</brandName><size unit="mm">4</size>'
+                '<identifier><id>1</id></identifier><identifier><id>2</id></identifier></device>'
+                '<device><brandName>B,\xc3\xa9</brandName><identifier><id>3</id></identifier></device></gudid>'
+            )
+        # A part left over from a bigger previous run
+        os.makedirs(os.path.join(temp_dir, 'device.identifier'))
+        with open(os.path.join(temp_dir, 'device.identifier', 'part-00005.csv'), 'w') as stale_out:
+            stale_out.write('_id\n9\n')
+        xml_parser = XMLDocParser()
+        count = xml_parser.stream_to_tables(xml_path, temp_dir, 'device', batch_size=1)
+        tables = {}
+        for table in ('device', 'device.identifier'):
+            tables[table] = []
+            for part in sorted(os.listdir(os.path.join(temp_dir, table))):
+                with open(os.path.join(temp_dir, table, part), 'rb') as csv_in:
+                    tables[table].append(list(csv.reader(csv_in)))
+        shutil.rmtree(temp_dir)
+        self.assertEqual(count, 2)
+        self.assertEqual(tables['device'], [
+            [['_id', 'brand_name', 'size.attribs.unit', 'size.text'], ['0', 'A', 'mm', '4']],
+            [['_id', 'brand_name'], ['1', 'B,\xc3\xa9']]
+        ])
+        self.assertEqual(tables['device.identifier'], [
+            [['_id', '_record', '_parent', '_index', 'id'], ['0', '0', '0', '0', '1'], ['1', '0', '0', '1', '2']],
+            [['_id', '_record', '_parent', '_index', 'id'], ['2', '1', '1', '0', '3']]
+        ])
+
+    def test_iter_parse_tags(self):
+        """
+        Several tags should be extracted in one pass with every backend, each routed to its own
+        collection, with a match nested in a record of another tag also kept in that record.
+        """
+        temp_dir = tempfile.mkdtemp()
+        xml_path = os.path.join(temp_dir, 'gudid.xml')
+        with open(xml_path, 'w') as xml_out:
+            xml_out.write(
+                '<gudid><header><fileName>f</fileName></header>'
+                '<device><brandName>A</brandName><identifier><id>1</id></identifier>'
+                '<identifier><id>2</id></identifier></device>'
+                '<device><brandName>B</brandName><identifier type="p"><id>3</id></identifier></device></gudid>'
+            )
+        identifiers = [{'id': '1'}, {'id': '2'}, {'attribs': {'type': 'p'}, 'id': '3'}]
+        devices = [
+            {'brand_name': 'A', 'identifier': identifiers[:2]},
+            {'brand_name': 'B', 'identifier': identifiers[2]}
+        ]
+        # lxml is optional
+        backends = ['etree', 'expat'] + (['lxml'] if lxml_etree is not None else [])
+        for backend in backends:
+            xml_parser = XMLDocParser(backend=backend)
+            records = list(xml_parser.iter_parse_tags(xml_path, ['header', 'device', 'identifier']))
+            self.assertEqual(records, [
+                ('header', {'file_name': 'f'}), ('identifier', identifiers[0]), ('identifier', identifiers[1]),
+                ('device', devices[0]), ('identifier', identifiers[2]), ('device', devices[1])
+            ])
+            xml_parser.parse(xml_path, search_tag=['header', 'device', 'missing'])
+            self.assertEqual(xml_parser.dict, {
+                'data': {'header': [{'file_name': 'f'}], 'device': devices, 'missing': []}
+            })
+        output_dir = os.path.join(temp_dir, 'out')
+        # A repeated tag is written once
+        counts = XMLDocParser().stream_tags_to_files(xml_path, output_dir, ['device', 'identifier', 'device'])
+        with open(os.path.join(output_dir, 'identifier.ndjson'), 'r') as json_in:
+            self.assertEqual([json.loads(line) for line in json_in], identifiers)
+        with open(os.path.join(output_dir, 'device.ndjson'), 'r') as json_in:
+            self.assertEqual([json.loads(line) for line in json_in], devices)
+        shutil.rmtree(temp_dir)
+        self.assertEqual(counts, {'device': 2, 'identifier': 3})
+        self.assertRaises(ValueError, XMLDocParser().parse, xml_path, ['header', 'device'], 2)
+        filtered_parser = XMLDocParser(record_filter=RecordFilter(XMLDocParser._normalize_tag, ['brand_name']))
+        self.assertRaises(ValueError, filtered_parser.iter_parse_tags, xml_path, ['device', 'identifier'])
+        self.assertRaises(ValueError, filtered_parser.stream_tags_to_files, xml_path, output_dir, ['device'])
+        self.assertFalse(os.path.exists(output_dir))
+
+    def test_stream_to_shards(self):
+        """
+        Records should roll over to a new shard at either limit, with a manifest of the shards, and
+        a second run should replace the shards of the first.
+        """
+        temp_dir = tempfile.mkdtemp()
+        xml_path = os.path.join(temp_dir, 'devices.xml')
+        with open(xml_path, 'w') as xml_out:
+            xml_out.write('<gudid>%s</gudid>' % ''.join(
+                '<device><brandName>%s</brandName></device>' % name for name in ('A', 'B', 'C', 'DDDDDDDDDD')
+            ))
+        output_dir = os.path.join(temp_dir, 'shards')
+        xml_parser = XMLDocParser()
+        xml_parser.stream_to_shards(xml_path, output_dir, 'device', max_records=3)
+        shards = xml_parser.stream_to_shards(xml_path, output_dir, 'device', max_records=3, max_bytes=40)
+        with open(os.path.join(output_dir, 'manifest.json'), 'r') as manifest_in:
+            manifest = json.load(manifest_in)
+        records = []
+        for shard in manifest['shards']:
+            with open(os.path.join(output_dir, shard['file']), 'r') as shard_in:
+                records.append([json.loads(line)['brand_name'] for line in shard_in])
+        files = sorted(os.listdir(output_dir))
+        shutil.rmtree(temp_dir)
+        # The short lines are 20 bytes each, so the second line of a shard reaches 40 bytes
+        self.assertEqual(records, [['A', 'B'], ['C', 'DDDDDDDDDD']])
+        self.assertEqual(files, ['manifest.json', 'part-00000.ndjson', 'part-00001.ndjson'])
+        self.assertEqual(manifest['shards'], shards)
+        self.assertEqual([shard['records'] for shard in shards], [2, 2])
+        self.assertEqual((manifest['records'], manifest['bytes']), (4, 89))
+        self.assertRaises(ValueError, xml_parser.stream_to_shards, xml_path, output_dir, 'device')
+
+    def test_compressed_input(self):
+        """
+        Gzip compressed files and zip archives should parse to the same records as plain files,
+        with the xml members of a zip archive parsed one after the other.
+        """
+        temp_dir = tempfile.mkdtemp()
+        document = tostring(self.root)
+        xml_path = os.path.join(temp_dir, 'data.xml')
+        with open(xml_path, 'w') as xml_out:
+            xml_out.write(document)
+        with gzip.open(xml_path + '.gz', 'wb') as gz_out:
+            gz_out.write(document)
+        zip_path = os.path.join(temp_dir, 'data.zip')
+        archive = zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED)
+        archive.writestr('part1.xml', document)
+        archive.writestr('readme.txt', 'not xml')
+        archive.writestr('part2.xml', document)
+        # The resource forks macOS adds are not documents
+        archive.writestr('__MACOSX/._part1.xml', 'not xml')
+        archive.writestr('data/._part2.xml', 'not xml')
+        archive.close()
+        countries = self.dict_obj['data']['country']
+        for backend in ('etree', 'expat'):
+            xml_parser = XMLDocParser(backend=backend)
+            self.assertEqual(list(xml_parser.iter_parse(xml_path + '.gz', 'country')), countries)
+            self.assertEqual(list(xml_parser.iter_parse(zip_path, 'country')), countries * 2)
+            self.assertEqual(list(xml_parser.iter_parse(zip_path, 'country', workers=2)), countries * 2)
+            xml_parser.parse(xml_path + '.gz')
+            self.assertEqual(xml_parser.dict, self.dict_obj)
+            self.assertRaises(ValueError, xml_parser.parse, zip_path)
+        # Offsets into compressed input count decompressed bytes
+        splitter = XMLRecordSplitter('country', XMLDocParser._normalize_tag)
+        records = list(splitter.iter_records(xml_path))
+        self.assertEqual(list(splitter.iter_records(xml_path + '.gz', records[0][1])), records[1:])
+        self.assertEqual(list(splitter.iter_records(zip_path, records[1][1]))[0][2], records[0][2])
+        shutil.rmtree(temp_dir)
+
+    def test_stream_to_file_index(self):
+        """
+        An indexed ndjson output should let single records be looked up by their top level key,
+        whether or not the index had to be sorted in several runs or the records were converted by
+        worker processes.
+        """
+        temp_dir = tempfile.mkdtemp()
+        xml_path = os.path.join(temp_dir, 'devices.xml')
+        json_path = os.path.join(temp_dir, 'devices.ndjson')
+        root = Element('gudid')
+        for key in ('k3', 'k1', u'k\xe9', 'k2', 'k1'):
+            device = SubElement(root, 'device')
+            # A same named key nested in the record must not be indexed
+            SubElement(SubElement(device, 'identifiers'), 'publicDeviceRecordKey').text = 'nested'
+            SubElement(device, 'publicDeviceRecordKey').text = key
+            SubElement(device, 'brandName').text = 'brand %s' % len(root)
+        with open(xml_path, 'w') as xml_out:
+            xml_out.write(tostring(root, encoding='utf-8'))
+        xml_parser = XMLDocParser()
+        for sort_size, workers in ((100, 1), (2, 1), (2, 2)):
+            with patch.object(RecordIndexWriter, 'sort_size', sort_size):
+                xml_parser.stream_to_file(
+                    xml_path, json_path, 'device', workers=workers, id_tag='public_device_record_key'
+                )
+            self.assertEqual(sorted(os.listdir(temp_dir)), ['devices.ndjson', 'devices.ndjson.idx', 'devices.xml'])
+            self.assertEqual(os.stat(json_path + '.idx').st_mode & 0o777, 0o644)
+            with RecordReader(json_path) as reader:
+                self.assertEqual(reader.get('k2')['brand_name'], 'brand 4')
+                self.assertEqual(reader[u'k\xe9']['brand_name'], 'brand 3')
+                # The first of duplicate keys is found
+                self.assertEqual(reader.get('k1')['brand_name'], 'brand 2')
+                self.assertEqual(reader.get('k3')['brand_name'], 'brand 1')
+                self.assertTrue(reader.get('k0') is None)
+                self.assertFalse('k4' in reader)
+                self.assertFalse('nested' in reader)
+                self.assertRaises(KeyError, reader.__getitem__, 'k9')
+        self.assertRaises(
+            ValueError, xml_parser.stream_to_file, xml_path, json_path + '.gz', 'device', id_tag='public_device_record_key'
+        )
+        self.assertEqual(sorted(os.listdir(temp_dir)), ['devices.ndjson', 'devices.ndjson.idx', 'devices.xml'])
+        # A failed conversion removes the index of the output it replaced
+        self.assertRaises(ValueError, xml_parser.stream_to_file, xml_path, json_path, 'device', id_tag='missing_tag')
+        self.assertEqual(sorted(os.listdir(temp_dir)), ['devices.ndjson', 'devices.xml'])
+        shutil.rmtree(temp_dir)
+
+    def test_checkpointed_stream_to_file(self):
+        """
+        A conversion that dies should resume from its last checkpoint, dropping anything written
+        after it, and produce the same output as an uninterrupted one.
+        """
+        root = Element('gudid')
+        for index in range(10):
+            SubElement(SubElement(root, 'device'), 'brandName').text = str(index)
+        temp_dir = tempfile.mkdtemp()
+        xml_path = os.path.join(temp_dir, 'devices.xml')
+        json_path = os.path.join(temp_dir, 'devices.ndjson.gz')
+        checkpoint_path = os.path.join(temp_dir, 'devices.checkpoint')
+        with open(xml_path, 'w') as xml_out:
+            xml_out.write(tostring(root))
+        xml_parser = XMLDocParser()
+        xml_parser.parallel_batch_size = 2
+        xml_parser.checkpoint_interval = 4
+        convert_document = xml_parser._convert_document
+        calls = []
+
+        def dying_convert_document(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 4:
+                raise RuntimeError('died')
+            return convert_document(*args, **kwargs)
+
+        with patch.object(xml_parser, '_convert_document', side_effect=dying_convert_document):
+            self.assertRaises(
+                RuntimeError, xml_parser.checkpointed_stream_to_file, xml_path, json_path, 'device',
+                checkpoint_path
+            )
+            with open(checkpoint_path, 'r') as checkpoint_in:
+                self.assertEqual(json.load(checkpoint_in)['records'], 4)
+            with open(json_path, 'ab') as json_out:
+                json_out.write('garbage')
+            count = xml_parser.checkpointed_stream_to_file(xml_path, json_path, 'device', checkpoint_path)
+        # Only the three batches after the checkpoint are converted again
+        self.assertEqual(len(calls), 7)
+        with gzip.open(json_path, 'rb') as json_in:
+            result = [json.loads(line) for line in json_in]
+        self.assertFalse(os.path.exists(checkpoint_path))
+        shutil.rmtree(temp_dir)
+        self.assertEqual(count, 10)
+        self.assertEqual(result, [{'brand_name': str(index)} for index in range(10)])
+
+    def test_stream_changes_to_file(self):
+        """
+        Only records added, changed or deleted since the previous run should be written.
+        """
+        def write_devices(xml_path, devices):
+            root = Element('gudid')
+            for key, brand in devices:
+                device = SubElement(root, 'device')
+                SubElement(device, 'publicDeviceRecordKey').text = key
+                SubElement(device, 'brandName').text = brand
+            with open(xml_path, 'w') as xml_out:
+                xml_out.write(tostring(root))
+
+        def read_changes(json_path):
+            with open(json_path, 'r') as json_in:
+                return [json.loads(line) for line in json_in]
+
+        temp_dir = tempfile.mkdtemp()
+        xml_path = os.path.join(temp_dir, 'devices.xml')
+        json_path = os.path.join(temp_dir, 'changes.ndjson')
+        manifest_path = os.path.join(temp_dir, 'manifest.json')
+        xml_parser = XMLDocParser()
+        write_devices(xml_path, [('a', 'A'), ('b', 'B'), ('c', 'C')])
+        first = xml_parser.stream_changes_to_file(
+            xml_path, json_path, 'device', 'public_device_record_key', manifest_path
+        )
+        first_changes = read_changes(json_path)
+        write_devices(xml_path, [('a', 'A'), ('c', 'C2'), ('d', 'D')])
+        second = xml_parser.stream_changes_to_file(
+            xml_path, json_path, 'device', 'public_device_record_key', manifest_path
+        )
+        second_changes = read_changes(json_path)
+        shutil.rmtree(temp_dir)
+        self.assertEqual(first, {'added': 3, 'changed': 0, 'deleted': 0, 'unchanged': 0})
+        self.assertEqual([change['op'] for change in first_changes], ['add'] * 3)
+        self.assertEqual(second, {'added': 1, 'changed': 1, 'deleted': 1, 'unchanged': 1})
+        self.assertEqual(second_changes, [
+            {'op': 'change', 'id': 'c', 'record': {'public_device_record_key': 'c', 'brand_name': 'C2'}},
+            {'op': 'add', 'id': 'd', 'record': {'public_device_record_key': 'd', 'brand_name': 'D'}},
+            {'op': 'delete', 'id': 'b'}
+        ])
+
     def test_tree_to_dict_omit_empty_element(self):
         """
         Test omission of empty elements. Note that the parent element, which then becomes empty,
@@ -164,6 +763,38 @@ class TestXMLParser(unittest.TestCase):
         catalog_number = SubElement(root, 'catalogNumber') # Empty element
         self.assertEqual(XMLDocParser._tree_to_dict(root), {'data': {}})
 
+    def test_tree_to_dict_deep(self):
+        """
+        Deeply nested documents should not hit the recursion limit.
+        """
+        root = Element('data')
+        element = root
+        for _ in range(sys.getrecursionlimit() + 100):
+            element = SubElement(element, 'nested')
+        element.text = 'bottom'
+        result = XMLDocParser._tree_to_dict(root)['data']
+        while isinstance(result, dict):
+            result = result['nested']
+        self.assertEqual(result, 'bottom')
+
+    def test_tree_to_dict_text_and_attributes(self):
+        """
+        Whitespace only text is dropped next to attributes or children, but kept on its own.
+        """
+        root = Element('data')
+        SubElement(root, 'blank').text = ' '
+        SubElement(root, 'sub', attrib={"name": "Austria"}).text = ' text '
+        SubElement(root, 'empty', attrib={"name": "Austria"}).text = ' '
+        root.text = ' '
+        expected = {
+            'data': {
+                'blank': '',
+                'sub': {'attribs': {'name': 'Austria'}, 'text': 'text'},
+                'empty': {'attribs': {'name': 'Austria'}}
+            }
+        }
+        self.assertEqual(XMLDocParser._tree_to_dict(root), expected)
+
     def test_tree_to_dict_attributes(self):
         """
         Test element attributes.
@@ -309,6 +940,46 @@ class TestXMLParser(unittest.TestCase):
         fda_class.rec_inject(mock_dict)
         self.assertTrue('openfda' in mock_dict['product_codes']['fda_product_code'])
 
+    def test_tree_to_dict_inject(self):
+        """
+        Classification information should be injected while the tree is converted, without a
+        second walk over the result.
+        """
+        root = Element('device')
+        codes = SubElement(root, 'productCodes')
+        for code in ('JEY', 'MNI'):
+            product = SubElement(codes, 'fdaProductCode')
+            SubElement(product, 'productCode').text = code
+        fda_class = FDAClassificationParser()
+        fda_class.get = MagicMock(side_effect=lambda code: code.lower())
+        fda_class.rec_inject = MagicMock()
+        result = XMLDocParser._tree_to_dict(root, fda_class)
+        products = result['device']['product_codes']['fda_product_code']
+        self.assertEqual([product['openfda'] for product in products], [['jey'], ['mni']])
+        self.assertFalse(fda_class.rec_inject.called)
+
+    def test_inject_memoized(self):
+        """
+        Products with the same codes should share one openfda list, each code should only be
+        looked up once and unknown codes should be counted.
+        """
+        fda_class = FDAClassificationParser()
+        fda_class.get = MagicMock(side_effect=lambda code: None if code == 'XXX' else {'code': code})
+        products = [
+            {'product_code': 'JEY'},
+            {'product_code': 'JEY'},
+            {'product_code': 'XXX'},
+            {'codes': [{'product_code': 'JEY'}, {'product_code': 'XXX'}]}
+        ]
+        for product in products:
+            fda_class.inject(product)
+        self.assertTrue(products[0]['openfda'] is products[1]['openfda'])
+        self.assertEqual(products[2]['openfda'], [None])
+        self.assertEqual(products[3]['openfda'], [{'code': 'JEY'}, None])
+        self.assertTrue(products[3]['openfda'][0] is products[0]['openfda'][0])
+        self.assertEqual(fda_class.get.call_count, 2)
+        self.assertEqual(fda_class.unknown_codes, {'XXX': 2})
+
     def test_foi_get(self):
         mock_dict = {'JEY': 'TEST'}
         index_field = "PRODUCTCODE"
@@ -317,13 +988,273 @@ class TestXMLParser(unittest.TestCase):
         class_parser.parse(class_file)
         self.assertTrue('JEY' in class_parser._dict)
 
+    def test_foi_get_record(self):
+        """
+        Lookups should return structured records keyed by the lowercase header fields, with empty
+        fields omitted.
+        """
+        class_parser = FDAClassificationParser()
+        class_parser.parse('foiclass.txt')
+        record = class_parser.get('JEY')
+        self.assertEqual(record['devicename'], 'Plate, Bone')
+        self.assertEqual(record['deviceclass'], '2')
+        self.assertEqual(record['regulationnumber'], '872.4760')
+        self.assertFalse('definition' in record)
+        self.assertEqual(class_parser.get('NOT A CODE'), None)
+
+    def test_foi_secondary_index(self):
+        """
+        Secondary fields should be indexed in the same pass and support batched lookups.
+        """
+        class_parser = FDAClassificationParser(secondary_fields=("REGULATIONNUMBER", "REVIEW_PANEL"))
+        class_parser.parse('foiclass.txt')
+        records = class_parser.get_by("REGULATIONNUMBER", "872.4760")
+        self.assertTrue('JEY' in [record['productcode'] for record in records])
+        self.assertTrue(all(record['regulationnumber'] == "872.4760" for record in records))
+        result = class_parser.get_many(["DE", "NOT A PANEL"], field="REVIEW_PANEL")
+        self.assertTrue(len(result["DE"]) > 1)
+        self.assertEqual(result["NOT A PANEL"], [])
+        result = class_parser.get_many(["JEY", "NOT A CODE"])
+        self.assertEqual(result["JEY"]['devicename'], 'Plate, Bone')
+        self.assertEqual(result["NOT A CODE"], None)
+        self.assertRaises(ValueError, class_parser.get_by, "DEVICENAME", "Plate, Bone")
+
+    def test_foi_reparse(self):
+        """
+        Parsing another file should replace the index of the previous one rather than add to it.
+        """
+        with open('foiclass.txt', 'r') as class_in:
+            header = next(class_in)
+            row = next(class_in)
+        temp_path = tempfile.mkstemp()[1]
+        with open(temp_path, 'w') as class_out:
+            class_out.write(header + row)
+        class_parser = FDAClassificationParser(secondary_fields=("REVIEW_PANEL",))
+        class_parser.parse('foiclass.txt')
+        class_parser.parse(temp_path)
+        os.remove(temp_path)
+        # The first row is BRW, so JEY is gone
+        self.assertEqual(class_parser._dict, {'BRW': 0})
+        self.assertEqual(class_parser.get('JEY'), None)
+        self.assertEqual(class_parser.get('BRW')['devicename'], 'Protector, Dental')
+        self.assertEqual(sum(len(rows) for rows in class_parser._indexes["REVIEW_PANEL"].values()), 1)
+
+    def test_atomic_write(self):
+        """
+        A file should be replaced only once it is completely written, readable by everyone, and
+        left as it was if writing fails.
+        """
+        temp_dir = tempfile.mkdtemp()
+        path = os.path.join(temp_dir, 'out.json')
+        for sync in (False, True):
+            with atomic_write(path, sync=sync) as temp_out:
+                temp_out.write('new')
+                self.assertFalse(os.path.exists(path))
+            with open(path, 'r') as json_in:
+                self.assertEqual(json_in.read(), 'new')
+            os.remove(path)
+        with atomic_write(path) as temp_out:
+            temp_out.write('old')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+        with self.assertRaises(KeyError):
+            with atomic_write(path) as temp_out:
+                temp_out.write('new')
+                raise KeyError('failed')
+        with open(path, 'r') as json_in:
+            self.assertEqual(json_in.read(), 'old')
+        self.assertEqual(os.listdir(temp_dir), ['out.json'])
+        shutil.rmtree(temp_dir)
+
+    def test_foi_cache(self):
+        """
+        A second parse should load the compiled index from the cache instead of reparsing, unless
+        the index fields changed.
+        """
+        cache_path = tempfile.mkstemp()[1]
+        class_parser = FDAClassificationParser()
+        class_parser.parse('foiclass.txt', cache_file=cache_path)
+        cached_parser = FDAClassificationParser()
+        cached_parser._parse = MagicMock()
+        cached_parser.parse('foiclass.txt', cache_file=cache_path)
+        self.assertFalse(cached_parser._parse.called)
+        self.assertEqual(cached_parser.get('JEY'), class_parser.get('JEY'))
+        stale_parser = FDAClassificationParser(secondary_fields=("REVIEW_PANEL",))
+        stale_parser.parse('foiclass.txt', cache_file=cache_path)
+        os.remove(cache_path)
+        self.assertEqual(len(stale_parser.get_by("REVIEW_PANEL", "DE")), len(stale_parser._indexes["REVIEW_PANEL"]["DE"]))
+
+    def test_foi_memory_usage(self):
+        """
+        The parsed columns should take less memory than keeping each raw line around.
+        """
+        class_parser = FDAClassificationParser()
+        class_parser.parse('foiclass.txt')
+        with open('foiclass.txt', 'r') as class_file:
+            next(class_file)
+            raw = sum(sys.getsizeof(line.strip()) for line in class_file)
+        self.assertTrue(class_parser.memory_usage() < raw)
+
+class TestBatchConverter(unittest.TestCase):
+    def setUp(self):
+        """
+        Write a directory of small xml part files.
+        """
+        self.xml_dir = tempfile.mkdtemp()
+        self.out_dir = tempfile.mkdtemp()
+        self.expected = []
+        for part in range(3):
+            root = Element('gudid')
+            for index in range(part + 1):
+                SubElement(SubElement(root, 'device'), 'brandName').text = '%d-%d' % (part, index)
+                self.expected.append({'brand_name': '%d-%d' % (part, index)})
+            with open(os.path.join(self.xml_dir, 'part%d.xml' % part), 'w') as xml_out:
+                xml_out.write(tostring(root))
+
+    def tearDown(self):
+        shutil.rmtree(self.xml_dir)
+        shutil.rmtree(self.out_dir)
+
+    def read_ndjson(self, json_file):
+        with open(json_file, 'r') as json_in:
+            return [json.loads(line) for line in json_in]
+
+    def test_expand_inputs(self):
+        """
+        Directories and glob patterns should expand to sorted xml files.
+        """
+        expected = [os.path.join(self.xml_dir, 'part%d.xml' % part) for part in range(3)]
+        self.assertEqual(BatchConverter.output_path('gudid/part1.xml.gz', 'out'), 'out/part1.ndjson')
+        self.assertTrue(is_batch(self.xml_dir))
+        self.assertTrue(is_batch(os.path.join(self.xml_dir, 'part*.xml')))
+        self.assertFalse(is_batch(expected[0]))
+        self.assertEqual(expand_inputs(self.xml_dir), expected)
+        self.assertEqual(expand_inputs(os.path.join(self.xml_dir, 'part[12].xml')), expected[1:])
+        output_dir = os.path.join(self.xml_dir, 'out')
+        for tag in ('device', 'auto'):
+            self.assertRaises(
+                UsageError, main, os.path.join(self.xml_dir, 'none*.xml'), output_dir, None, 'PRODUCTCODE', True, tag
+            )
+        self.assertFalse(os.path.exists(output_dir))
+
+    def test_convert_per_file(self):
+        """
+        Each input should get its own ndjson output and a summary.
+        """
+        xml_files = expand_inputs(self.xml_dir)
+        summaries = BatchConverter(XMLDocParser(), 'device', workers=2).convert(xml_files, self.out_dir)
+        self.assertEqual([summary['records'] for summary in summaries], [1, 2, 3])
+        result = []
+        for summary in summaries:
+            result.extend(self.read_ndjson(summary['json_file']))
+        self.assertEqual(result, self.expected)
+        self.assertTrue('total' in BatchConverter.format_summary(summaries))
+
+    def test_convert_same_file_names(self):
+        """
+        Inputs in different directories that share a file name should get outputs of their own.
+        """
+        for part, year in enumerate(('2023', '2024')):
+            os.mkdir(os.path.join(self.xml_dir, year))
+            shutil.copy(os.path.join(self.xml_dir, 'part%d.xml' % part), os.path.join(self.xml_dir, year, 'part.xml'))
+        xml_files = expand_inputs(os.path.join(self.xml_dir, '*', 'part.xml'))
+        summaries = BatchConverter(XMLDocParser(), 'device', workers=2).convert(xml_files, self.out_dir)
+        self.assertEqual(
+            [summary['json_file'] for summary in summaries],
+            [os.path.join(self.out_dir, year, 'part.ndjson') for year in ('2023', '2024')]
+        )
+        self.assertEqual(self.read_ndjson(summaries[1]['json_file']), self.expected[1:3])
+        with gzip.open(os.path.join(self.xml_dir, 'part0.xml.gz'), 'wb') as xml_out:
+            xml_out.write('<gudid/>')
+        output_dir = os.path.join(self.out_dir, 'clash')
+        xml_files = expand_inputs(self.xml_dir)
+        self.assertRaises(ValueError, BatchConverter(XMLDocParser(), 'device').convert, xml_files, output_dir)
+        self.assertFalse(os.path.exists(output_dir))
+
+    def test_convert_merged(self):
+        """
+        Merged output should hold every record in input order.
+        """
+        xml_files = expand_inputs(self.xml_dir)
+        json_file = os.path.join(self.out_dir, 'merged.ndjson')
+        BatchConverter(XMLDocParser(), 'device', workers=2).convert(xml_files, json_file, merge=True)
+        self.assertEqual(self.read_ndjson(json_file), self.expected)
+        self.assertEqual(os.listdir(self.out_dir), ['merged.ndjson'])
+
+
+class TestXMLRecordSplitter(unittest.TestCase):
+    def split(self, document, search_tag, block_size=None):
+        """
+        Write the document to a temp file and split it.
+        """
+        temp_path = tempfile.mkstemp()[1]
+        with open(temp_path, 'w') as xml_out:
+            xml_out.write(document)
+        splitter = XMLRecordSplitter(search_tag, XMLDocParser._normalize_tag)
+        if block_size is not None:
+            splitter.block_size = block_size
+        records = list(splitter.iter_records(temp_path))
+        os.remove(temp_path)
+        return splitter, records
+
+    def test_split_offsets(self):
+        """
+        Each record should be returned along with its byte range in the file.
+        """
+        document = '<data><fdaDevice><a>1</a></fdaDevice><fdaDevices/><fdaDevice a="2"/></data>'
+        splitter, records = self.split(document, 'fda_device')
+        self.assertEqual([raw for _, _, raw in records], ['<fdaDevice><a>1</a></fdaDevice>', '<fdaDevice a="2"/>'])
+        for start, end, raw in records:
+            self.assertEqual(document[start:end], raw)
+
+    def test_split_nested(self):
+        """
+        An element nested inside a matching element of the same name belongs to the outer record.
+        """
+        document = '<data><device><device>1</device></device><device>2</device></data>'
+        _, records = self.split(document, 'device')
+        self.assertEqual([raw for _, _, raw in records], ['<device><device>1</device></device>', '<device>2</device>'])
+
+    def test_split_across_blocks(self):
+        """
+        Tags cut in half at a block boundary must still be found.
+        """
+        document = '<data>%s</data>' % ''.join('<device id="%d"><x>y</x></device>' % i for i in range(50))
+        _, records = self.split(document, 'device', block_size=7)
+        self.assertEqual(len(records), 50)
+        self.assertEqual(records[-1][2], '<device id="49"><x>y</x></device>')
+
+    def test_split_ranges(self):
+        """
+        Splitting consecutive byte ranges, cut anywhere, should give each record exactly once.
+        """
+        document = '<data>%s</data>' % ''.join('<device id="%d"><x>y</x></device>' % i for i in range(20))
+        splitter, records = self.split(document, 'device')
+        temp_path = tempfile.mkstemp()[1]
+        with open(temp_path, 'w') as xml_out:
+            xml_out.write(document)
+        for range_size in (1, 7, 33, len(document)):
+            ranges = []
+            for start in range(0, len(document), range_size):
+                ranges.extend(splitter.iter_range(temp_path, start, start + range_size))
+            self.assertEqual(ranges, records)
+        os.remove(temp_path)
+
+    def test_wrap_namespaces(self):
+        """
+        Batches should carry the namespace declarations of the root element.
+        """
+        document = '<?xml version="1.0" encoding="UTF-8"?><g:data xmlns:g="urn:g" xmlns="urn:d"><g:device>1</g:device></g:data>'
+        splitter, records = self.split(document, 'device')
+        wrapped = splitter.wrap([raw for _, _, raw in records])
+        self.assertEqual(XMLDocParser._tree_to_dict(ElementTree.fromstring(wrapped)), {'split': {'device': '1'}})
+
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser(description='CLI argument parser.')
     arg_parser.add_argument('--verbose', help='Run in verbose mode.', action='store_true')
     arg_parser.set_defaults(verbose=False)
     args = arg_parser.parse_args()
     if args.verbose:
-        suite = unittest.TestLoader().loadTestsFromTestCase(TestXMLParser)
+        suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
         unittest.TextTestRunner(verbosity=2).run(suite)
     else:
         unittest.main()
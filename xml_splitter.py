@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+import re
+from readers import open_input
+
+
+__author__ = "Jonathan Sage"
+__email__ = "jsage8@gmail.com"
+
+
+class XMLRecordSplitter(object):
+    """
+    Split an xml document into the raw bytes of each element that matches a search tag without
+    parsing it. Matching elements can then be handed off and parsed independently, e.g. by a pool
+    of worker processes.
+
+    The splitter is deliberately simple. It does not understand comments, CDATA sections or
+    entities declared in a DTD, so tags hidden inside those will confuse it. Namespace declarations
+    are only picked up from the root element.
+
+    Compressed input is split as it is decompressed, see readers.open_input. The members of a zip
+    archive are split one after the other as if they were a single file, and offsets count bytes
+    of that decompressed stream.
+
+    An uncompressed file can also be split as independent byte ranges with iter_range, which is
+    how worker processes share the scanning of a large file. A range that starts inside an element
+    resyncs at the next start tag, so an element nested in another element of the search tag is
+    mistaken for a record of its own if a range starts between the two start tags.
+    """
+
+    block_size = 1 << 20
+    # Bytes kept between blocks in case a tag is split across them
+    _tail = 256
+
+    _root_pattern = re.compile(r'<(?![?!])[^>]*>')
+    _declaration_pattern = re.compile(r'<\?xml[^>]*\?>')
+    _namespace_pattern = re.compile(r'''xmlns(?::[\w.-]+)?\s*=\s*(?:"[^"]*"|'[^']*')''')
+
+    def __init__(self, search_tag, normalize):
+        """
+        :param search_tag: The snake_case tag to split on.
+        :ptype search_tag: str
+        :param normalize: Converts a raw, possibly namespace prefixed, tag name to snake_case.
+        :ptype normalize: callable
+        """
+        self.search_tag = search_tag
+        self.normalize = normalize
+        self.declaration = ''
+        self.namespaces = ''
+        # Underscores may or may not be present in the raw tag name and case is lost by snake
+        # casing, so match loosely here and confirm candidates with normalize
+        name = ''.join('_?' if char == '_' else re.escape(char) for char in search_tag)
+        self._tag_pattern = re.compile(r'<(/?)((?:[\w.-]+:)?%s)(?=[\s/>])' % name, re.I)
+        self._matches = {}
+
+    def iter_records(self, xml_file, offset=0):
+        """
+        Yield the raw bytes of each element that matches the search tag.
+
+        :param xml_file: The path to the xml file to split.
+        :ptype xml_file: str
+        :param offset: The byte offset to start splitting at. It must fall between elements.
+        :ptype offset: int
+        :return: A generator of (start offset, end offset, raw element) tuples.
+        :rtype: generator
+        """
+        self.read_prolog(xml_file)
+        with open_input(xml_file, offset) as xml_in:
+            for record in self._split(xml_in, offset):
+                yield record
+
+    def iter_range(self, xml_file, start, end):
+        """
+        Yield the raw bytes of each element whose start tag begins within a byte range, reading on
+        past the end of the range to finish the last one. Consecutive ranges of a file split it
+        into the same elements as iter_records, each in exactly one range, so the ranges can be
+        split independently. Call read_prolog first if the elements are going to be wrapped.
+
+        :param xml_file: The path to the uncompressed xml file to split.
+        :ptype xml_file: str
+        :param start: The offset of the start of the range. It may fall anywhere.
+        :ptype start: int
+        :param end: The offset just past the end of the range.
+        :ptype end: int
+        :return: A generator of (start offset, end offset, raw element) tuples.
+        :rtype: generator
+        """
+        with open_input(xml_file, start) as xml_in:
+            for record in self._split(xml_in, start):
+                if record[0] >= end:
+                    return
+                yield record
+
+    def read_prolog(self, xml_file):
+        """
+        Read the xml declaration and the namespace declarations of the root element, which wrap
+        adds to each batch.
+
+        :param xml_file: The path to the xml file to split.
+        :ptype xml_file: str
+        :rtype: void
+        """
+        with open_input(xml_file) as xml_in:
+            self._read_prolog(xml_in)
+
+    def iter_batches(self, xml_file, batch_size, offset=0):
+        """
+        Yield batches of matching elements, each wrapped in a synthetic root element that carries
+        the namespace declarations of the document, so each batch is a well formed document.
+
+        :param xml_file: The path to the xml file to split.
+        :ptype xml_file: str
+        :param batch_size: The maximum number of elements per batch.
+        :ptype batch_size: int
+        :param offset: The byte offset to start splitting at. It must fall between elements.
+        :ptype offset: int
+        :return: A generator of (start offset, end offset, element count, document) tuples.
+        :rtype: generator
+        """
+        batch = []
+        start = offset
+        end = offset
+        for record_start, end, raw in self.iter_records(xml_file, offset):
+            if not batch:
+                start = record_start
+            batch.append(raw)
+            if len(batch) >= batch_size:
+                yield start, end, len(batch), self.wrap(batch)
+                batch = []
+        if batch:
+            yield start, end, len(batch), self.wrap(batch)
+
+    def wrap(self, records):
+        """
+        Wrap raw elements in a synthetic root element.
+
+        :param records: The raw elements.
+        :ptype records: list
+        :return: A well formed xml document.
+        :rtype: str
+        """
+        return '%s<split %s>%s</split>' % (self.declaration, self.namespaces, ''.join(records))
+
+    def _read_prolog(self, xml_in):
+        """
+        Read the xml declaration and the namespace declarations of the root element.
+
+        :param xml_in: The open xml file.
+        :ptype xml_in: file
+        :rtype: void
+        """
+        head = xml_in.read(self.block_size)
+        declaration = self._declaration_pattern.match(head.lstrip())
+        self.declaration = declaration.group(0) if declaration else ''
+        position = 0
+        while True:
+            root = self._root_pattern.search(head, position)
+            if root is None:
+                break
+            # Skip over comments and the doctype declaration
+            if head.startswith('<!', root.start()):
+                position = root.end()
+                continue
+            self.namespaces = ' '.join(self._namespace_pattern.findall(root.group(0)))
+            break
+
+    def _is_match(self, raw_tag):
+        """
+        Check whether a candidate raw tag name normalizes to the search tag.
+
+        :param raw_tag: The raw tag name.
+        :ptype raw_tag: str
+        :rtype: bool
+        """
+        if raw_tag not in self._matches:
+            self._matches[raw_tag] = self.normalize(raw_tag.split(':')[-1]) == self.search_tag
+        return self._matches[raw_tag]
+
+    def _split(self, xml_in, offset):
+        """
+        Scan the file block by block, keeping only the unfinished element in the buffer.
+
+        :param xml_in: The open xml file positioned at offset.
+        :ptype xml_in: file
+        :param offset: The byte offset of the current position in the file.
+        :ptype offset: int
+        :return: A generator of (start offset, end offset, raw element) tuples.
+        :rtype: generator
+        """
+        buf = ''
+        base = offset
+        position = 0
+        start = None
+        depth = 0
+        while True:
+            block = xml_in.read(self.block_size)
+            buf += block
+            while True:
+                match = self._tag_pattern.search(buf, position)
+                if match is None:
+                    # A tag may be cut off at the end of the buffer
+                    position = max(position, len(buf) - self._tail)
+                    break
+                tag_end = buf.find('>', match.end())
+                if tag_end == -1:
+                    position = match.start()
+                    break
+                position = tag_end + 1
+                if not self._is_match(match.group(2)):
+                    continue
+                if match.group(1):
+                    if start is None:
+                        continue
+                    depth -= 1
+                elif buf[tag_end - 1] != '/':
+                    if start is None:
+                        start = match.start()
+                    depth += 1
+                elif start is None:
+                    # A self closing element is a complete record
+                    yield base + match.start(), base + position, buf[match.start():position]
+                    continue
+                if start is not None and depth == 0:
+                    yield base + start, base + position, buf[start:position]
+                    start = None
+            if not block:
+                break
+            # Drop everything that can no longer be part of a record
+            keep = position if start is None else start
+            buf = buf[keep:]
+            base += keep
+            position -= keep
+            if start is not None:
+                start -= keep